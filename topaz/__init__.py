@@ -33,6 +33,9 @@ import pyworkflow.utils as pwutils
 import pyworkflow as pw
 
 from .constants import *
+from .worker import WORKER_JOBS, WORKER_SCRIPT, getProtocolWorker
+from .scheduler import getProtocolScheduler
+from .profiling import stage
 
 
 __version__ = '3.1.0'
@@ -119,8 +122,59 @@ class Plugin(pwem.Plugin):
                        vars=installEnvVars)
 
     @classmethod
-    def runTopaz(cls, protocol, program, args, cwd=None):
-        """ Run Topaz command from a given protocol. """
-        fullProgram = '%s %s && %s' % (cls.getCondaActivationCmd(),
-                                       cls.getTopazEnvActivation(), program)
-        protocol.runJob(fullProgram, args, env=cls.getEnviron(), cwd=cwd)
+    def getWorkerCommand(cls):
+        """ Command to launch a persistent topaz worker. """
+        return '%s %s && python %s serve' % (cls.getCondaActivationCmd(),
+                                             cls.getTopazEnvActivation(),
+                                             WORKER_SCRIPT)
+
+    @classmethod
+    def runTopaz(cls, protocol, program, args, cwd=None, stageInfo=None):
+        """ Run Topaz command from a given protocol. If the protocol uses
+        a persistent worker, the supported commands are sent to it instead
+        of launching a new process. If the protocol limits the number of
+        jobs per GPU, the device is chosen by the plugin scheduler.
+        The run is recorded in the protocol stages log, with the extra
+        fields in stageInfo (e.g. mics and batch).
+        """
+        jobsPerGpu = protocol.getAttributeValue('jobsPerGpu', 0)
+        if jobsPerGpu and protocol.getGpuList() and '%(GPU)s' in args:
+            scheduler = getProtocolScheduler(protocol, jobsPerGpu)
+            with scheduler.device() as device:
+                protocol.info("Scheduled on GPU %s (running jobs per GPU: %s)"
+                              % (device, scheduler.getLoad()))
+                cls._runTopaz(protocol, program,
+                              args.replace('%(GPU)s', device), cwd=cwd,
+                              device=device, stageInfo=stageInfo)
+        else:
+            cls._runTopaz(protocol, program, args, cwd=cwd,
+                          stageInfo=stageInfo)
+
+    @classmethod
+    def _runTopaz(cls, protocol, program, args, cwd=None, device=None,
+                  stageInfo=None):
+        job = WORKER_JOBS.get(program)
+        # Stage named after the topaz command (e.g. 'topaz extract')
+        with stage(protocol, program.split()[-1], **(stageInfo or {})):
+            if job is not None and protocol.getAttributeValue('useWorker', False):
+                cls.runTopazWorker(protocol, job, args, cwd=cwd, device=device)
+            else:
+                fullProgram = '%s %s && %s' % (cls.getCondaActivationCmd(),
+                                               cls.getTopazEnvActivation(),
+                                               program)
+                protocol.runJob(fullProgram, args, env=cls.getEnviron(),
+                                cwd=cwd)
+
+    @classmethod
+    def runTopazWorker(cls, protocol, job, args, cwd=None, device=None):
+        """ Run a Topaz job in the protocol worker for the given device
+        or the GPU assigned to the current step (CPU if there is none). """
+        if device is None:
+            gpus = protocol._stepsExecutor.getGpuList()
+            device = str(gpus[0]) if gpus else '-1'
+        args = args.replace('%(GPU)s', device)
+        protocol.info("** Running in topaz worker (device %s): **\n"
+                      "topaz %s %s" % (device, job, args))
+        worker = getProtocolWorker(protocol, device, cls.getWorkerCommand(),
+                                   env=cls.getEnviron())
+        worker.run(job, args, cwd=cwd)
@@ -0,0 +1,135 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+
+import math
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+# Tolerance for the sizes computed from fitted costs
+EPSILON = 1e-6
+
+class BatchSizeController:
+    """ Choose the size of the next streaming batch from the measured cost
+    of the previous ones, modelled as a fixed overhead per batch (process
+    start, model loading...) plus a cost per micrograph.
+
+    With a target latency, the batch is the largest one that can be filled
+    (at the measured arrival rate) and processed within that time. Without
+    it, the batch is the smallest one that keeps the overhead below the
+    given fraction of the batch time, maximizing throughput.
+    """
+    def __init__(self, minSize, maxSize, initialSize=None, targetLatency=0,
+                 overheadFraction=0.1, history=20):
+        self.minSize = max(1, minSize)
+        self.maxSize = max(self.minSize, maxSize)
+        self.targetLatency = targetLatency
+        self.overheadFraction = overheadFraction
+        self._batches = deque(maxlen=history)
+        self._arrivals = deque(maxlen=history)
+        self._seen = set()
+        self._size = self._clamp(initialSize or self.minSize)
+        self._lock = threading.Lock()
+        self.reason = 'initial size'
+
+    def _clamp(self, size):
+        return int(min(self.maxSize, max(self.minSize, size)))
+
+    def addBatch(self, size, seconds):
+        """ Register the processing time of a batch of the given size. """
+        with self._lock:
+            self._batches.append((size, seconds))
+
+    def addArrivals(self, itemIds, when=None):
+        """ Register the arrival of the given items at time when. Items
+        already seen (e.g. offered again because they did not fill
+        a batch) are not counted. """
+        with self._lock:
+            newIds = set(itemIds) - self._seen
+            if newIds:
+                self._seen.update(newIds)
+                self._arrivals.append((time.time() if when is None else when,
+                                       len(newIds)))
+
+    def getArrivalRate(self):
+        """ Micrographs per second arrived in the recorded period,
+        None if unknown. """
+        if len(self._arrivals) < 2:
+            return None
+        elapsed = self._arrivals[-1][0] - self._arrivals[0][0]
+        if elapsed <= 0:
+            return None
+        # The first arrival only marks the beginning of the period
+        return sum(c for _, c in list(self._arrivals)[1:]) / elapsed
+
+    def getCost(self):
+        """ Return (overhead, perMic) seconds fitted to the recorded
+        batches, or None if they do not allow to estimate both. """
+        sizes = np.array([b[0] for b in self._batches], dtype=float)
+        if len(np.unique(sizes)) < 2:
+            return None
+        seconds = np.array([b[1] for b in self._batches], dtype=float)
+        perMic, overhead = np.polyfit(sizes, seconds, 1)
+        return max(0., overhead), max(1e-6, perMic)
+
+    def getBatchSize(self):
+        """ Return the size for the next batch. The attribute reason
+        explains the last decision. """
+        with self._lock:
+            if not self._batches:
+                return self._size
+
+            cost = self.getCost()
+            if cost is None:
+                # All batches had the same size: try another one to be able
+                # to separate the overhead from the cost per micrograph
+                size = self._batches[-1][0]
+                other = self._clamp(size * 2 if size < self.maxSize else size // 2)
+                self.reason = 'exploring (only batches of %d measured)' % size
+                self._size = other
+                return self._size
+
+            overhead, perMic = cost
+            rate = self.getArrivalRate()
+            info = ('overhead %0.1fs, %0.2fs/micrograph, arrival %s'
+                    % (overhead, perMic,
+                       '%0.2f mics/s' % rate if rate else 'unknown'))
+
+            if self.targetLatency > 0:
+                # latency(n) = (n - 1) / rate + overhead + n * perMic
+                wait = 1. / rate if rate else 0.
+                n = (self.targetLatency - overhead + wait) / (wait + perMic)
+                n = math.floor(n + EPSILON)
+                self.reason = ('target latency %0.1fs, %s'
+                               % (self.targetLatency, info))
+            else:
+                f = self.overheadFraction
+                n = math.ceil(overhead * (1 - f) / (f * perMic) - EPSILON)
+                self.reason = ('overhead below %d%%, %s' % (f * 100, info))
+
+            self._size = self._clamp(n)
+            return self._size
@@ -0,0 +1,118 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+
+class PreprocessCache:
+    """ Cache of preprocessed micrographs shared by all protocols of a project.
+
+    Each file is stored under a key computed from the identity of the input
+    micrograph (real path, size and modification time) and the parameters
+    used to process it. Files are hard-linked (or copied if not possible)
+    in and out of the cache, so an evicted entry never breaks the folders
+    of a running protocol. When the total size exceeds maxSize (in bytes),
+    the least recently used entries are removed.
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, path, maxSize):
+        self.path = path
+        self.maxSize = maxSize
+
+    @staticmethod
+    def getKey(micFn, params):
+        """ Return the cache key for the given micrograph file
+        (links are followed) and processing parameters (a dict). """
+        realFn = os.path.realpath(micFn)
+        stat = os.stat(realFn)
+        identity = {'file': realFn, 'size': stat.st_size,
+                    'mtime': stat.st_mtime, 'params': params}
+        content = json.dumps(identity, sort_keys=True).encode()
+        return hashlib.sha1(content).hexdigest()
+
+    def getFile(self, key):
+        return os.path.join(self.path, key[:2], key + '.mrc')
+
+    def fetch(self, key, outputFn):
+        """ Place the cached file for this key in outputFn.
+        Return False if the key is not in the cache. """
+        cachedFn = self.getFile(key)
+        try:
+            _linkOrCopy(cachedFn, outputFn)
+        except FileNotFoundError:
+            return False
+        # Update the modification time to keep track of the last use
+        os.utime(cachedFn)
+        return True
+
+    def store(self, key, inputFn):
+        """ Add inputFn to the cache with the given key. """
+        cachedFn = self.getFile(key)
+        os.makedirs(os.path.dirname(cachedFn), exist_ok=True)
+        tmpFn = '%s.%d.tmp' % (cachedFn, os.getpid())
+        _linkOrCopy(inputFn, tmpFn)
+        os.replace(tmpFn, cachedFn)
+
+    def evict(self):
+        """ Remove least recently used entries until the cache
+        size is below the maximum. """
+        with self._lock:
+            entries = []
+            totalSize = 0
+            for root, _, files in os.walk(self.path):
+                for fn in files:
+                    path = os.path.join(root, fn)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+                    totalSize += stat.st_size
+
+            for _, size, path in sorted(entries):
+                if totalSize <= self.maxSize:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                totalSize -= size
+
+
+def _linkOrCopy(src, dst):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        shutil.copy(src, dst)
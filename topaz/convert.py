@@ -27,7 +27,17 @@
 # **************************************************************************
 
 import csv
+import itertools
+import json
+import logging
 import os
+from glob import glob
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import mrcfile
+import numpy as np
 
 import pyworkflow.utils as pwutils
 from pyworkflow.object import Float
@@ -35,6 +45,9 @@ from pwem.emlib.image import ImageHandler
 from pwem.objects import Coordinate
 
 from topaz import constants
+from topaz.evaluation import suppressNonMaxima
+
+logger = logging.getLogger(__name__)
 
 
 class CsvImageList:
@@ -53,6 +66,9 @@ class CsvImageList:
     def _addRow(self, *values):
         self.__writer.writerow(values)
 
+    def _addRows(self, rows):
+        self.__writer.writerows(rows)
+
     def close(self):
         self.__file.close()
 
@@ -70,7 +86,7 @@ class CsvMicrographList(CsvImageList):
                               columns=['image_name', 'path'])
 
     def addMic(self, micId, micPath):
-        self._addRow('%06d' % micId, micPath)
+        self._addRow(micId2MicName(micId), micPath)
 
 
 class CsvCoordinateList(CsvImageList):
@@ -85,71 +101,466 @@ class CsvCoordinateList(CsvImageList):
     def addCoord(self, micId, x, y):
         self._addRow(micId2MicName(micId), x, y)
 
+    def addCoords(self, coords, scale=1):
+        """ Add (micId, x, y) tuples at once, dividing the positions
+        by the given scale. """
+        self._addRows((micId2MicName(micId),
+                       int(round(float(x) / scale)),
+                       int(round(float(y) / scale)))
+                      for micId, x, y in coords)
+
 
 def micId2MicName(micId):
     return '%06d' % micId
 
-def convertMicrographs(micList, micDir):
+
+def getMicCoordinatesName(micId):
+    """ Name of the file with the coordinates of a single micrograph, as
+    written by the topaz worker from the names in the image list. """
+    return micId2MicName(micId) + '.txt'
+
+
+def convertMicrographs(micList, micDir, numberOfThreads=1):
     """ Convert (or simply link) input micrographs into the given directory
     in a format that is compatible with Topaz.
     """
-    ih = ImageHandler()
     ext = pwutils.getExt(micList[0].getFileName())
 
-    def _convert(mic, newName):
-        ih.convert(mic, os.path.join(micDir, newName))
-
-    def _link(mic, newName):
-        pwutils.createAbsLink(os.path.abspath(mic.getFileName()),
-                              os.path.join(micDir, newName))
-
     if ext in constants.TOPAZ_SUPPORTED_FORMATS:
-        func = _link
+        for mic in micList:
+            pwutils.createAbsLink(os.path.abspath(mic.getFileName()),
+                                  os.path.join(micDir, getMicIdName(mic, ext)))
     else:
-        func = _convert
-        ext = '.mrc'
-
-    for mic in micList:
-        func(mic, getMicIdName(mic, suffix=ext))
-
-
-def readSetOfCoordinates(coordinatesCsvFn, micSet, coordSet, scale):
+        convertImages([(mic.getFileName(),
+                        os.path.join(micDir, getMicIdName(mic, '.mrc')))
+                       for mic in micList], numberOfThreads)
+
+
+def convertImages(fileList, numberOfThreads=1, convertFunc=None):
+    """ Convert a list of (inputFn, outputFn) pairs using a pool of threads.
+    All the files are processed even if some of them fail, then an
+    exception reporting every failed file is raised.
+    Params:
+        fileList: list of (inputFn, outputFn) tuples.
+        numberOfThreads: size of the pool.
+        convertFunc: function(inputFn, outputFn) doing the conversion, by
+            default ImageHandler.convert (one handler per thread).
+    """
+    local = threading.local()
+
+    def _convert(inputFn, outputFn):
+        if convertFunc is not None:
+            return convertFunc(inputFn, outputFn)
+        if not hasattr(local, 'ih'):
+            local.ih = ImageHandler()
+        local.ih.convert(inputFn, outputFn)
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, numberOfThreads)) as executor:
+        futures = {executor.submit(_convert, inputFn, outputFn): inputFn
+                   for inputFn, outputFn in fileList}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                errors.append('%s: %s' % (futures[future], e))
+
+    if errors:
+        raise Exception("Could not convert %d of %d micrographs:\n%s"
+                        % (len(errors), len(fileList),
+                           '\n'.join(sorted(errors))))
+
+
+# Maximum number of coordinates parsed and inserted at once
+COORDINATES_CHUNK_SIZE = 100000
+# Maximum number of micrographs kept in memory by a MicrographIndex
+MICROGRAPH_INDEX_SIZE = 1024
+
+
+class MicrographIndex:
+    """ Map micrograph ids to micrographs of a set, loading from the set
+    only the ids that are requested and keeping a bounded LRU cache of the
+    cloned micrographs. It can be kept during a whole streaming session
+    so the cost of each batch does not depend on the size of the set.
+    """
+    def __init__(self, micSet=None, maxSize=MICROGRAPH_INDEX_SIZE):
+        self._micSet = micSet
+        self._mics = OrderedDict()
+        self.maxSize = maxSize
+        self.loaded = 0  # Number of micrographs read from the set
+
+    def setMicrographs(self, micSet):
+        """ Update the set (e.g. refreshed in streaming) to load from. """
+        self._micSet = micSet
+
+    def load(self, micIds):
+        """ Read from the set, in a single query, the given ids
+        that are not already in the index. """
+        missing = [int(micId) for micId in micIds if micId not in self._mics]
+        if not missing:
+            return
+        where = 'id IN (%s)' % ','.join(str(micId) for micId in missing)
+        for mic in self._micSet.iterItems(where=where):
+            self._add(mic.getObjId(), mic.clone())
+            self.loaded += 1
+
+    def _add(self, micId, mic):
+        self._mics[micId] = mic
+        if len(self._mics) > self.maxSize:
+            self._mics.popitem(last=False)
+
+    def get(self, micId):
+        """ Return the micrograph with this id or None if not in the set. """
+        if micId not in self._mics:
+            self.load([micId])
+        mic = self._mics.get(micId)
+        if mic is not None:
+            self._mics.move_to_end(micId)
+        return mic
+
+
+def iterCoordinatesChunks(coordinatesCsvFn, chunkSize=COORDINATES_CHUNK_SIZE):
+    """ Parse a Topaz coordinates file column-wise, in chunks of at most
+    chunkSize rows to keep memory bounded for very large files.
+    Yields tuples of arrays: (micIds, x, y, scores).
+    The coordinates can also be given as a coordinate store.
+    """
+    if isCoordinateStore(coordinatesCsvFn):
+        for chunk in CoordinateStore(coordinatesCsvFn).iterChunks(chunkSize):
+            yield chunk
+        return
+
+    with open(coordinatesCsvFn) as f:
+        next(f, None)  # skip the header
+        while True:
+            lines = list(itertools.islice(f, chunkSize))
+            if not lines:
+                break
+            data = np.loadtxt(lines, delimiter='\t', ndmin=2)
+            yield (data[:, 0].astype(int), data[:, 1], data[:, 2],
+                   data[:, 3])
+
+
+def iterMicrographRuns(micIds):
+    """ Iterate over (micId, start, end) for each run of consecutive
+    equal micrograph ids in the given array. """
+    if not len(micIds):
+        return
+    bounds = np.flatnonzero(np.diff(micIds)) + 1
+    starts = np.concatenate(([0], bounds))
+    ends = np.concatenate((bounds, [len(micIds)]))
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        yield int(micIds[start]), start, end
+
+
+def readSetOfCoordinates(coordinatesCsvFn, micSet, coordSet, scale,
+                         chunkSize=COORDINATES_CHUNK_SIZE):
     """ Read coordinates produced by Topaz.
     Coordinates are expected in a single csv file, with the following columns:
      first: image_name (mic id)
      second: x_coord
      third:  y_coord
      forth:  score
+    The file is parsed and scaled in chunks of chunkSize rows; the
+    coordinates of each chunk are committed to coordSet in one transaction.
+    micSet can be a set of micrographs or a MicrographIndex, that should
+    be preferred when reading many files from the same set.
     """
-    csv = CsvCoordinateList(coordinatesCsvFn, score=True)
+    # Only the micrographs present in the file are read from the set
+    if isinstance(micSet, MicrographIndex):
+        micIndex = micSet
+    else:
+        micIndex = MicrographIndex(micSet)
 
-    lastMicId = None
+    for micIds, xs, ys, scores in iterCoordinatesChunks(coordinatesCsvFn,
+                                                        chunkSize):
+        appendCoordinates(coordSet, micIndex, micIds,
+                          scaleCoordinates(xs, scale),
+                          scaleCoordinates(ys, scale), scores)
+
+
+def scaleCoordinates(values, scale):
+    """ Scale (and round) coordinates from Topaz to the micrographs. """
+    return np.rint(values * scale).astype(np.int32)
+
+
+def appendCoordinates(coordSet, micIndex, micIds, xs, ys, scores):
+    """ Append to coordSet the coordinates given as arrays (sorted by
+    micrograph) and commit them in one transaction. """
     coord = Coordinate()
     coord._topazScore = Float()
 
-    micDict = {}
-    # loop to generate a dictionary --> micBaseName : Micrograph
-    for mic in micSet:
-        micNew = mic.clone()
-        micDict[mic.getObjId()] = micNew
-
-    #loop the Topaz outputfile
-    for row in csv:
-        micId = int(row[0])
-        if micId != lastMicId:
-            mic = micDict[micId]
-            if mic is None:
-                print("Missing id: ", micId)
-            else:
-                coord.setMicrograph(mic)
-                lastMicId = micId
-
-        coord.setPosition(int(round(float(row[1])*scale)), int(round(float(row[2])*scale)))
-        coord._topazScore.set(float(row[3]))
-        coord.setObjId(None)
-        coordSet.append(coord)
-
-    csv.close()
+    xs, ys, scores = xs.tolist(), ys.tolist(), scores.tolist()
+    micIndex.load(np.unique(micIds).tolist())
+
+    missing = []
+    for micId, start, end in iterMicrographRuns(micIds):
+        mic = micIndex.get(micId)
+        if mic is None:
+            missing.append(micId)
+            continue
+        coord.setMicrograph(mic)
+
+        for i in range(start, end):
+            coord.setPosition(xs[i], ys[i])
+            coord._topazScore.set(scores[i])
+            coord.setObjId(None)
+            coordSet.append(coord)
+
+    if missing:
+        logger.warning("Skipped the coordinates of %d micrographs not found "
+                       "in the set: %s" % (len(missing),
+                                           ' '.join(map(str, missing))))
+    coordSet.write(properties=False)
+
+
+def readCoordinates(coordinatesCsvFn, scale):
+    """ Read a whole Topaz coordinates file into arrays
+    (micIds, x, y, scores), with the positions scaled. """
+    chunks = list(iterCoordinatesChunks(coordinatesCsvFn))
+    if not chunks:
+        return emptyCoordinates()
+    micIds, xs, ys, scores = [np.concatenate(c) for c in zip(*chunks)]
+    return (micIds.astype(np.int32), scaleCoordinates(xs, scale),
+            scaleCoordinates(ys, scale), scores.astype(np.float32))
+
+
+def filterPicks(micIds, xs, ys, scores, minDistance=0, maxPerMic=0):
+    """ Remove near-duplicate picks and cap the picks per micrograph.
+    Params:
+        micIds, xs, ys, scores: arrays with the picks, sorted by micrograph.
+        minDistance: picks closer than this to another one with a higher
+            score are removed (0 to disable).
+        maxPerMic: keep at most this number of picks, the ones with the
+            highest scores, per micrograph (0 to disable).
+    Returns the filtered arrays.
+    """
+    if not len(scores):
+        return micIds, xs, ys, scores
+
+    keep = np.ones(len(scores), dtype=bool)
+
+    if minDistance > 0:
+        xy = np.column_stack((xs, ys))
+        for _, start, end in iterMicrographRuns(micIds):
+            keep[start:end] = suppressNonMaxima(xy[start:end], scores[start:end],
+                                                minDistance)
+
+    if maxPerMic > 0:
+        # Rank of each remaining pick inside its micrograph, by score
+        index = np.flatnonzero(keep)
+        order = index[np.lexsort((-scores[index], micIds[index]))]
+        sortedIds = micIds[order]
+        firsts = np.flatnonzero(np.diff(sortedIds, prepend=sortedIds[:1] - 1))
+        starts = np.repeat(firsts, np.diff(np.append(firsts, len(order))))
+        keep[order[np.arange(len(order)) - starts >= maxPerMic]] = False
+
+    return micIds[keep], xs[keep], ys[keep], scores[keep]
+
+
+def emptyCoordinates():
+    return (np.empty(0, np.int32), np.empty(0, np.int32),
+            np.empty(0, np.int32), np.empty(0, np.float32))
+
+
+# Columns of a coordinate store (name and type), in the order of the
+# Topaz coordinates files
+STORE_COLUMNS = [('micId', np.int32), ('x', np.int32), ('y', np.int32),
+                 ('score', np.float32)]
+STORE_INDEX = 'index.npy'
+COORDINATE_STORE_EXT = '.cols'
+
+
+def isCoordinateStore(path):
+    return os.path.isdir(path)
+
+
+def writeCoordinateStore(storePath, micIds, xs, ys, scores):
+    """ Write picks as a coordinate store: a folder with one .npy file per
+    column (int32 micrograph ids and positions, float32 scores), sorted by
+    micrograph, and an index with the (micId, start, end) rows of each
+    micrograph. The folder is renamed into place once complete. """
+    order = np.argsort(micIds, kind='stable')
+    columns = [np.asarray(values)[order].astype(dtype) for values, (_, dtype)
+               in zip([micIds, xs, ys, scores], STORE_COLUMNS)]
+    index = np.array(list(iterMicrographRuns(columns[0])) if len(order) else [],
+                     dtype=np.int64).reshape(-1, 3)
+
+    tmpPath = storePath + '.tmp'
+    pwutils.cleanPath(tmpPath)
+    pwutils.makePath(tmpPath)
+    for values, (name, _) in zip(columns, STORE_COLUMNS):
+        np.save(os.path.join(tmpPath, name + '.npy'), values)
+    np.save(os.path.join(tmpPath, STORE_INDEX), index)
+    pwutils.cleanPath(storePath)
+    os.rename(tmpPath, storePath)
+
+
+class CoordinateStore:
+    """ Read a coordinate store written by writeCoordinateStore (or by
+    the topaz worker). The columns are memory mapped, so the picks of a
+    micrograph are read without loading the rest of them. """
+    def __init__(self, storePath):
+        self.path = storePath
+        self._index = np.load(os.path.join(storePath, STORE_INDEX))
+
+    def __len__(self):
+        return int(self._index[-1, 2]) if len(self._index) else 0
+
+    def _column(self, name):
+        return np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+
+    def getMicIds(self):
+        """ Ids of the micrographs with picks, sorted. """
+        return self._index[:, 0]
+
+    def readMicrograph(self, micId):
+        """ Return the (x, y, scores) arrays of the picks of a micrograph. """
+        i = np.searchsorted(self._index[:, 0], micId)
+        if i == len(self._index) or self._index[i, 0] != micId:
+            start, end = 0, 0
+        else:
+            start, end = self._index[i, 1:]
+        return tuple(np.array(self._column(name)[start:end])
+                     for name, _ in STORE_COLUMNS[1:])
+
+    def read(self, minScore=None):
+        """ Return all the picks (micIds, x, y, scores), only those with
+        score >= minScore if given. """
+        values = [np.array(self._column(name)) for name, _ in STORE_COLUMNS]
+        if minScore is not None:
+            mask = values[3] >= minScore
+            values = [v[mask] for v in values]
+        return tuple(values)
+
+    def iterChunks(self, chunkSize=COORDINATES_CHUNK_SIZE):
+        """ Iterate over the picks in chunks of at most chunkSize rows,
+        with the same types as the parsed coordinates files. """
+        columns = [self._column(name) for name, _ in STORE_COLUMNS]
+        for start in range(0, len(self), chunkSize):
+            micIds, xs, ys, scores = [c[start:start + chunkSize]
+                                      for c in columns]
+            yield (micIds.astype(int), xs.astype(float), ys.astype(float),
+                   scores.astype(float))
+
+
+def convertCoordinatesToStore(coordinatesCsvFn, storePath):
+    """ Convert a Topaz coordinates file into a coordinate store. """
+    chunks = list(iterCoordinatesChunks(coordinatesCsvFn))
+    picks = ([np.concatenate(c) for c in zip(*chunks)] if chunks
+             else emptyCoordinates())
+    micIds, xs, ys, scores = picks
+    writeCoordinateStore(storePath, micIds, np.rint(xs), np.rint(ys), scores)
+
+
+def convertStoreToCoordinates(storePath, coordinatesCsvFn):
+    """ Convert a coordinate store into a Topaz coordinates file. """
+    with open(coordinatesCsvFn, 'w') as f:
+        f.write('image_name\tx_coord\ty_coord\tscore\n')
+        for micIds, xs, ys, scores in CoordinateStore(storePath).iterChunks():
+            np.savetxt(f, np.column_stack((micIds, xs, ys, scores)),
+                       fmt=['%d', '%d', '%d', '%.7g'], delimiter='\t')
+
+
+SCORED_PICKS_FOLDER = 'scored_picks'
+
+
+def getScoredPicksFile(extraDir, suffix='*'):
+    """ Coordinate stores with the scored picks of a picking run, one
+    per batch. """
+    return os.path.join(extraDir, SCORED_PICKS_FOLDER,
+                        'picks_%s%s' % (suffix, COORDINATE_STORE_EXT))
+
+
+def getScoredPicksFiles(extraDir):
+    """ Scored picks stored by a picking run, also those of older runs
+    (npz files). """
+    pattern = getScoredPicksFile(extraDir)
+    return sorted(glob(pattern) +
+                  glob(pattern.replace(COORDINATE_STORE_EXT, '.npz')))
+
+
+SCORED_PICKS_FILTER = 'filter.json'
+
+
+def writeScoredPicksFilter(extraDir, minDistance=0, maxPerMic=0):
+    """ Store the settings of filterPicks applied to the output of a
+    picking run (minDistance in micrograph pixels), so they are applied
+    again when re-thresholding its scored picks. """
+    filterFn = os.path.join(extraDir, SCORED_PICKS_FOLDER, SCORED_PICKS_FILTER)
+    pwutils.makeFilePath(filterFn)
+    with open(filterFn, 'w') as f:
+        json.dump({'minDistance': minDistance, 'maxPerMic': maxPerMic}, f)
+
+
+def readScoredPicksFilter(extraDir):
+    """ Return the filterPicks settings (minDistance and maxPerMic) stored
+    by a picking run, disabled if it did not store them. """
+    filterFn = os.path.join(extraDir, SCORED_PICKS_FOLDER, SCORED_PICKS_FILTER)
+    settings = {'minDistance': 0, 'maxPerMic': 0}
+    if os.path.exists(filterFn):
+        with open(filterFn) as f:
+            settings.update(json.load(f))
+    return settings
+
+
+def writeScoredPicks(picksFn, micIds, xs, ys, scores):
+    """ Store scored picks as compact columns (int32 micrograph ids and
+    positions, float32 scores) sorted by micrograph, so sets of coordinates
+    at any threshold can be derived later without picking again. They are
+    written as a coordinate store, or as a single npz file if the file
+    name ends with .npz. """
+    if not picksFn.endswith('.npz'):
+        writeCoordinateStore(picksFn, micIds, xs, ys, scores)
+        return
+
+    order = np.argsort(micIds, kind='stable')
+    tmpFn = picksFn + '.tmp.npz'
+    np.savez(tmpFn, micId=micIds[order].astype(np.int32),
+             x=xs[order].astype(np.int32), y=ys[order].astype(np.int32),
+             score=scores[order].astype(np.float32))
+    os.replace(tmpFn, picksFn)
+
+
+def readScoredPicks(picksFns, minScore=None):
+    """ Read and concatenate the picks of the given files (coordinate
+    stores or npz files), keeping only those with score >= minScore.
+    Returns (micIds, x, y, scores) sorted by micrograph. """
+    columns = [[], [], [], []]
+    for fn in picksFns:
+        if isCoordinateStore(fn):
+            values = list(CoordinateStore(fn).read())
+        else:
+            with np.load(fn) as picks:
+                values = [picks['micId'], picks['x'], picks['y'],
+                          picks['score']]
+        if minScore is not None:
+            mask = values[3] >= minScore
+            values = [v[mask] for v in values]
+        for column, v in zip(columns, values):
+            column.append(v)
+
+    if not picksFns:
+        return emptyCoordinates()
+
+    micIds, xs, ys, scores = [np.concatenate(c) for c in columns]
+    order = np.argsort(micIds, kind='stable')
+    return micIds[order], xs[order], ys[order], scores[order]
+
+
+def isCompleteMrc(filename):
+    """ Check that an mrc file exists and is as large as its header says,
+    to detect the files left half-written by an interrupted job. """
+    try:
+        with mrcfile.open(filename, header_only=True, permissive=True) as mrc:
+            header = mrc.header
+            dtype = mrcfile.utils.data_dtype_from_header(header)
+            expected = (header.nbytes + int(header.nsymbt) +
+                        int(header.nx) * int(header.ny) * int(header.nz) *
+                        dtype.itemsize)
+    except Exception:
+        return False
+    return os.path.getsize(filename) >= expected
 
 
 def getMicIdName(mic, suffix=''):
@@ -0,0 +1,196 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+
+import os
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def readTargets(filename):
+    """ Read a topaz particles file (image_name, x_coord, y_coord) into
+    a dict micId -> xy array. """
+    data = np.loadtxt(filename, skiprows=1, ndmin=2)
+    if not len(data):
+        return {}
+    micIds = data[:, 0].astype(int)
+    return {int(micId): data[micIds == micId, 1:3]
+            for micId in np.unique(micIds)}
+
+
+def suppressNonMaxima(xy, scores, radius):
+    """ Greedy non-maximum suppression over a list of picks: going from the
+    highest score down, keep a pick unless it is closer than radius to
+    a pick already kept. Returns a boolean mask over the input picks.
+    """
+    n = len(scores)
+    keep = np.ones(n, dtype=bool)
+    if n < 2 or radius <= 0:
+        return keep
+
+    pairs = cKDTree(xy).query_pairs(radius, output_type='ndarray')
+    if not len(pairs):
+        return keep
+
+    # Orient each pair from the higher to the lower score and group them
+    # by the higher one, so each kept pick suppresses its neighbours at once
+    rank = np.empty(n, dtype=int)
+    rank[np.argsort(-scores, kind='stable')] = np.arange(n)
+    swap = rank[pairs[:, 0]] > rank[pairs[:, 1]]
+    pairs[swap] = pairs[swap][:, ::-1]
+    pairs = pairs[np.argsort(rank[pairs[:, 0]], kind='stable')]
+    starts = np.flatnonzero(np.diff(pairs[:, 0], prepend=-1))
+    ends = np.append(starts[1:], len(pairs))
+
+    for start, end in zip(starts, ends):
+        if keep[pairs[start, 0]]:
+            keep[pairs[start:end, 1]] = False
+    return keep
+
+
+def matchPicks(picksXy, picksScores, targetsXy, matchRadius):
+    """ Match the picks of a micrograph one-to-one with its target
+    coordinates: going from the highest score down, each pick is matched
+    to the closest target within matchRadius not matched yet. The picks
+    above any threshold are then matched as if picked at that threshold.
+    Returns:
+        pickMatched: for each pick, if it was matched to a target.
+        targetScores: for each target, the score of the pick matched to it
+            (-inf if none), so it is recovered at any threshold below that
+            score.
+    """
+    pickMatched = np.zeros(len(picksScores), dtype=bool)
+    targetScores = np.full(len(targetsXy), -np.inf)
+    if not len(picksScores) or not len(targetsXy):
+        return pickMatched, targetScores
+
+    pairs = cKDTree(picksXy).sparse_distance_matrix(
+        cKDTree(targetsXy), matchRadius, output_type='ndarray')
+    # Candidate pairs by pick score (then pick) and distance
+    order = np.lexsort((pairs['v'], pairs['i'], -picksScores[pairs['i']]))
+    targetMatched = np.zeros(len(targetsXy), dtype=bool)
+    for i, j in zip(pairs['i'][order].tolist(), pairs['j'][order].tolist()):
+        if not pickMatched[i] and not targetMatched[j]:
+            pickMatched[i] = targetMatched[j] = True
+            targetScores[j] = picksScores[i]
+    return pickMatched, targetScores
+
+
+def precisionRecall(pickScores, pickMatched, targetScores, thresholds):
+    """ Precision, recall and F1 at each threshold (vectorized) given the
+    scores of all the picks, whether each one matches a target and the best
+    matching score of every target. """
+    thresholds = np.asarray(thresholds, dtype=float)
+    order = np.sort(pickScores)
+    matchedScores = np.sort(pickScores[pickMatched])
+    sortedTargets = np.sort(targetScores)
+
+    nPicks = len(order) - np.searchsorted(order, thresholds, side='left')
+    nTrue = (len(matchedScores) -
+             np.searchsorted(matchedScores, thresholds, side='left'))
+    nFound = (len(sortedTargets) -
+              np.searchsorted(sortedTargets, thresholds, side='left'))
+
+    precision = np.divide(nTrue, nPicks, out=np.zeros(len(thresholds)),
+                          where=nPicks > 0)
+    recall = np.divide(nFound, max(len(targetScores), 1),
+                       out=np.zeros(len(thresholds)))
+    denom = precision + recall
+    f1 = np.divide(2 * precision * recall, denom,
+                   out=np.zeros(len(thresholds)), where=denom > 0)
+    return precision, recall, f1
+
+
+def sweepThresholds(picks, targets, radii, thresholds, matchRadius):
+    """ Evaluate picking on a grid of extraction radii and thresholds.
+    Params:
+        picks: dict micName -> (xy, scores) extracted with the smallest
+            radius and the lowest threshold.
+        targets: dict micName -> xy of the true particles.
+        radii: extraction radii, larger radii are emulated by suppressing
+            picks closer than the radius (greedy, by score).
+        thresholds: score thresholds.
+        matchRadius: maximum distance between a pick and its target.
+    Returns a structured array with the columns radius, threshold,
+    precision, recall and f1.
+    """
+    rows = []
+    for radius in radii:
+        pickScores, pickMatched, targetScores = [], [], []
+        for micName in sorted(set(picks) | set(targets)):
+            xy, scores = picks.get(micName, (np.empty((0, 2)), np.empty(0)))
+            keep = suppressNonMaxima(xy, scores, radius)
+            micTargets = targets.get(micName, np.empty((0, 2)))
+            matched, tScores = matchPicks(xy[keep], scores[keep], micTargets,
+                                          matchRadius)
+            pickScores.append(scores[keep])
+            pickMatched.append(matched)
+            targetScores.append(tScores)
+
+        precision, recall, f1 = precisionRecall(np.concatenate(pickScores),
+                                                np.concatenate(pickMatched),
+                                                np.concatenate(targetScores),
+                                                thresholds)
+        for row in zip(thresholds, precision, recall, f1):
+            rows.append((radius,) + row)
+
+    return np.array(rows, dtype=[('radius', int), ('threshold', float),
+                                 ('precision', float), ('recall', float),
+                                 ('f1', float)])
+
+
+def getBestOperatingPoint(sweep):
+    """ Row of the sweep with the highest F1 (the highest threshold and
+    then the smallest radius among ties). """
+    order = np.lexsort((sweep['radius'], -sweep['threshold'], -sweep['f1']))
+    return sweep[order[0]]
+
+
+SWEEP_COLUMNS = ['radius', 'threshold', 'precision', 'recall', 'f1']
+
+
+def writeSweep(filename, sweep):
+    """ Write the sweep as a text table with a header line. """
+    np.savetxt(filename, sweep, fmt=['%d', '%0.2f', '%0.4f', '%0.4f', '%0.4f'],
+               delimiter='\t', header='\t'.join(SWEEP_COLUMNS), comments='')
+
+
+def readSweep(filename):
+    """ Read a sweep table written by writeSweep. """
+    return np.atleast_1d(np.genfromtxt(filename, names=True, delimiter='\t',
+                                       dtype=[int, float, float, float, float]))
+
+
+def readTrainingLog(filename):
+    """ Read the test rows of the output of topaz train. Returns an array
+    with the columns epoch and auprc, one row per evaluated epoch. """
+    rows = []
+    if os.path.exists(filename):
+        with open(filename) as f:
+            for line in f:
+                values = line.split()
+                if len(values) > 2 and values[2] == 'test':
+                    rows.append((int(values[0]), float(values[-1])))
+    return np.array(rows, dtype=[('epoch', int), ('auprc', float)])
@@ -0,0 +1,135 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+
+"""
+Estimation of the memory available to denoise micrographs and of the
+largest denoising patch size that fits in it.
+"""
+
+import os
+import shlex
+import subprocess
+
+import mrcfile
+
+
+# Approximate peak memory (bytes per pixel of the denoised patch) of each
+# denoising model: the activations of its full-resolution layers in float32
+# (e.g. ~225 channels alive at the top of the U-nets) plus some margin
+DENOISE_BYTES_PER_PIXEL = {
+    'unet': 1024,
+    'unet-small': 1024,
+    'fcnn': 768,
+    'affineresnet8': 64
+}
+# Padding added by topaz denoise on each side of the patches by default
+DEFAULT_PADDING = 500
+MIN_PATCH_SIZE = 128
+PATCH_STEP = 128
+# Fraction of the free memory that can be used by a denoising job
+MEMORY_FRACTION = 0.8
+# Messages of the errors of a job that ran out of (GPU or host) memory
+OUT_OF_MEMORY_MESSAGES = ['out of memory', 'MemoryError',
+                          'CUBLAS_STATUS_ALLOC_FAILED',
+                          'Cannot allocate memory']
+
+
+def isOutOfMemoryError(output):
+    """ Whether the output of a failed job shows it ran out of memory. """
+    return any(message in output for message in OUT_OF_MEMORY_MESSAGES)
+
+
+def getHostFreeMemory():
+    """ Bytes of memory available in the host. """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def getGpuFreeMemory(gpus):
+    """ Bytes of free memory of the GPU with the least of it among the
+    given ones, None if it can not be queried. """
+    try:
+        output = subprocess.check_output(
+            ['nvidia-smi', '--query-gpu=memory.free', '--format=csv,noheader,nounits',
+             '-i', ','.join(str(gpu) for gpu in gpus)],
+            stderr=subprocess.DEVNULL, universal_newlines=True)
+        return min(int(line) for line in output.split()) * 1024 ** 2
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return None
+
+
+def getMaxMicrographShape(micFns):
+    """ Largest (rows, columns) among the mrc micrographs, read from
+    their headers. """
+    rows, cols = 0, 0
+    for fn in micFns:
+        with mrcfile.open(fn, header_only=True, permissive=True) as mrc:
+            rows = max(rows, int(mrc.header.ny))
+            cols = max(cols, int(mrc.header.nx))
+    return rows, cols
+
+
+def getPatchPadding(denoiseOptions):
+    """ Padding of the patches given in the topaz denoise options. """
+    argv = shlex.split(denoiseOptions)
+    for i, arg in enumerate(argv[:-1]):
+        if arg in ['-p', '--patch-padding']:
+            return int(argv[i + 1])
+    return DEFAULT_PADDING
+
+
+def getPatchMemory(shape, patchSize, padding, bytesPerPixel):
+    """ Bytes needed to denoise a micrograph of the given shape in patches
+    of patchSize (the whole micrograph if < 1). """
+    if patchSize < 1:
+        pixels = shape[0] * shape[1]
+    else:
+        tile = patchSize + 2 * padding
+        pixels = min(tile, shape[0]) * min(tile, shape[1])
+    return pixels * bytesPerPixel
+
+
+def getDenoisePatchSize(shape, freeBytes, bytesPerPixel,
+                        padding=DEFAULT_PADDING, maxPatchSize=None):
+    """ Largest patch size (a multiple of PATCH_STEP, or -1 for the whole
+    micrograph) whose denoising needs less than the given memory. It is
+    never smaller than MIN_PATCH_SIZE. With maxPatchSize, only smaller
+    patches are considered (e.g. after running out of memory). """
+    if maxPatchSize is None:
+        if getPatchMemory(shape, -1, padding, bytesPerPixel) <= freeBytes:
+            return -1
+        maxPatchSize = max(shape)
+    patchSize = maxPatchSize - maxPatchSize % PATCH_STEP
+    while patchSize > MIN_PATCH_SIZE:
+        if getPatchMemory(shape, patchSize, padding, bytesPerPixel) <= freeBytes:
+            break
+        patchSize -= PATCH_STEP
+    return max(patchSize, MIN_PATCH_SIZE)
@@ -33,6 +33,9 @@ class TopazModel(EMObject):
     def __init__(self, path=None, **kwargs):
         EMObject.__init__(self, **kwargs)
         self._path = pwobj.String(path)
+        # Recommended picking parameters, estimated on the test micrographs
+        self._threshold = pwobj.Float()
+        self._radius = pwobj.Integer()
 
     def getPath(self):
         return self._path.get()
@@ -40,5 +43,24 @@ class TopazModel(EMObject):
     def setPath(self, path):
         self._path.set(path)
 
+    def hasThreshold(self):
+        return self._threshold.hasValue()
+
+    def getThreshold(self):
+        return self._threshold.get()
+
+    def setThreshold(self, threshold):
+        self._threshold.set(threshold)
+
+    def getRadius(self):
+        return self._radius.get()
+
+    def setRadius(self, radius):
+        self._radius.set(radius)
+
     def __str__(self):
-        return "TopazModel(path=%s)" % self.getPath()
+        s = "TopazModel(path=%s)" % self.getPath()
+        if self.hasThreshold():
+            s += " threshold=%0.2f radius=%d" % (self.getThreshold(),
+                                                 self.getRadius())
+        return s
@@ -0,0 +1,223 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+
+"""
+In-process equivalent of "topaz preprocess": Fourier-crop downsampling
+and normalization of the micrographs with the scaled two-component
+Gaussian mixture model (or the affine one) used by Topaz.
+
+Micrographs are read through memory-mapped MRC access and downsampled in
+vectorized batches of micrographs of the same shape, so no process is
+launched and each micrograph is read and written only once.
+"""
+
+import argparse
+import os
+import shlex
+
+import numpy as np
+import mrcfile
+from scipy.stats import beta as betaDist
+
+
+# Micrographs downsampled together in a single FFT call
+BATCH_SIZE = 8
+# Initial proportions of the mixture tried by Topaz
+GMM_INITIAL_PIS = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.98, 1]
+
+
+def getOptionsParser():
+    """ Parser of the "topaz preprocess" options that are supported. The
+    ones only related to how topaz runs (device, workers...) are ignored. """
+    parser = argparse.ArgumentParser(prog='preprocess', add_help=False)
+    parser.add_argument('--affine', action='store_true')
+    parser.add_argument('--sample', type=int, default=10)
+    parser.add_argument('--niters', type=int, default=100)
+    parser.add_argument('-a', '--alpha', type=float, default=900)
+    parser.add_argument('-b', '--beta', type=float, default=1)
+    for option in [('-d', '--device'), ('-t', '--num-workers'),
+                   ('-j', '--num-threads')]:
+        parser.add_argument(*option, type=int)
+    parser.add_argument('-v', '--verbose', action='store_true')
+    return parser
+
+
+def parseOptions(extra):
+    """ Return the normalization options given as "topaz preprocess"
+    command line options. """
+    args, unknown = getOptionsParser().parse_known_args(shlex.split(extra or ''))
+    if unknown:
+        raise Exception("Options not supported by the native preprocessing: "
+                        "%s" % ' '.join(unknown))
+    return {'affine': args.affine, 'sample': args.sample,
+            'numIters': args.niters, 'alpha': args.alpha, 'beta': args.beta}
+
+
+def downsample(x, factor):
+    """ Downsample the last two dimensions of x (one image or a stack)
+    by cropping its Fourier transform, as topaz does. """
+    m, n = int(x.shape[-2] / factor), int(x.shape[-1] / factor)
+    F = np.fft.rfft2(x)
+    F = np.concatenate([F[..., 0:m // 2, 0:n // 2 + 1],
+                        F[..., -m // 2:, 0:n // 2 + 1]], axis=-2)
+    # Scale the signal from downsampling
+    F *= (m * n) / (x.shape[-2] * x.shape[-1])
+    return np.fft.irfft2(F, s=(m, n)).astype(x.dtype)
+
+
+def _logMixture(x, mu0, mu1, var, pi):
+    logP0 = -(x - mu0) ** 2 / 2 / var - 0.5 * np.log(2 * np.pi * var) + np.log1p(-pi)
+    logP1 = -(x - mu1) ** 2 / 2 / var - 0.5 * np.log(2 * np.pi * var) + np.log(pi)
+    return logP0, logP1, np.logaddexp(logP0, logP1)
+
+
+def fitGmm(x, pi, split, alpha, beta, scale=1, tol=1e-3, numIters=100):
+    """ Fit a two-component Gaussian mixture with shared variance and a beta
+    prior on the proportion pi of the second component, by EM starting
+    from the pixels above split. Returns (logp, mu1, var, pi). """
+    mu = x.mean()
+    p1 = (x > split).astype(np.float64)
+    p0 = 1 - p1
+
+    def update(p0, p1):
+        s0, s1 = p0.sum(), p1.sum()
+        mu0 = (x * p0).sum() / s0 if s0 > 0 else mu
+        mu1 = (x * p1).sum() / s1 if s1 > 0 else mu
+        var = np.mean(p0 * (x - mu0) ** 2 + p1 * (x - mu1) ** 2)
+        return mu0, mu1, var
+
+    mu0, mu1, var = update(p0, p1)
+    logP0, logP1, Z = _logMixture(x, mu0, mu1, var, pi)
+    logp = scale * Z.sum() + betaDist.logpdf(pi, alpha, beta)
+
+    for _ in range(numIters):
+        p0, p1 = np.exp(logP0 - Z), np.exp(logP1 - Z)
+        s = p1.sum()
+        a, b = alpha + s, beta + p1.size - s
+        pi = (a - 1) / (a + b - 2)  # MAP estimate of pi
+
+        mu0, mu1, var = update(p0, p1)
+        logP0, logP1, Z = _logMixture(x, mu0, mu1, var, pi)
+        logpPrev = logp
+        logp = scale * Z.sum() + betaDist.logpdf(pi, alpha, beta)
+        if logp - logpPrev <= tol:
+            break
+
+    return logp, mu1, var, pi
+
+
+def fitNormalization(x, alpha=900, beta=1, numIters=100, sample=1):
+    """ Return the mean and the standard deviation used to normalize the
+    image x: those of the main component of the best mixture among the
+    ones fitted from each initial proportion of Topaz. With sample > 1,
+    the mixture is fitted on a random subset of the pixels. """
+    scale = 1
+    x = x.ravel()
+    if sample > 1:
+        n = int(np.round(x.size / sample))
+        scale = x.size / n
+        x = np.random.choice(x, size=n, replace=False)
+    x = x.astype(np.float64)
+
+    pis = np.array(GMM_INITIAL_PIS)
+    splits = np.quantile(x, 1 - pis)
+    best = None
+    for pi, split in zip(pis, splits):
+        if pi == 1:  # single component model
+            # As topaz.stats.norm_fit: the unbiased variance (torch default)
+            # and the prior density, not its log, so the same mixture wins
+            mu, var = x.mean(), x.var(ddof=1)
+            logp = (scale * np.sum(-(x - mu) ** 2 / 2 / var -
+                                   0.5 * np.log(2 * np.pi * var)) +
+                    betaDist.pdf(1, alpha, beta))
+        else:
+            logp, mu, var, _ = fitGmm(x, pi, split, alpha, beta, scale=scale,
+                                      numIters=numIters)
+        if best is None or logp > best[0]:
+            best = (logp, mu, var)
+
+    return best[1], np.sqrt(best[2])
+
+
+def normalize(x, affine=False, alpha=900, beta=1, numIters=100, sample=1):
+    """ Normalize the image x as topaz preprocess does. """
+    if affine:
+        mu, std = x.mean(), x.std()
+    else:
+        mu, std = fitNormalization(x, alpha=alpha, beta=beta,
+                                   numIters=numIters, sample=sample)
+    return ((x - mu) / std).astype(np.float32)
+
+
+def readMicrographs(micFns):
+    """ Return a float32 stack with the 2D data of the mrc micrographs, read
+    through memory mapping, and the voxel size of each one. """
+    stack, voxelSizes = [], []
+    for fn in micFns:
+        with mrcfile.mmap(fn, mode='r', permissive=True) as mrc:
+            stack.append(mrc.data.reshape(mrc.data.shape[-2:]))
+            voxelSize = mrc.voxel_size
+            voxelSizes.append((float(voxelSize.x), float(voxelSize.y),
+                               float(voxelSize.z)))
+            # Copy the data while the file is still mapped
+            stack[-1] = stack[-1].astype(np.float32)
+    return np.stack(stack), voxelSizes
+
+
+def getMicrographShape(fn):
+    with mrcfile.mmap(fn, mode='r', permissive=True) as mrc:
+        return mrc.data.shape[-2:]
+
+
+def writeMicrograph(fn, data, voxelSize):
+    """ Write the micrograph to a temporary file renamed once complete, so
+    an interrupted job never leaves a partial output. """
+    tmpFn = fn + '.tmp'
+    with mrcfile.new(tmpFn, overwrite=True) as mrc:
+        mrc.set_data(data)
+        mrc.voxel_size = voxelSize
+    os.replace(tmpFn, fn)
+
+
+def preprocessMicrographs(micFns, outputDir, scale, batchSize=BATCH_SIZE,
+                          **options):
+    """ Downsample and normalize the mrc micrographs, writing them into
+    outputDir with the same names. The options are those returned by
+    parseOptions. """
+    # Micrographs of the same shape are downsampled together
+    byShape = {}
+    for fn in micFns:
+        byShape.setdefault(getMicrographShape(fn), []).append(fn)
+
+    for fns in byShape.values():
+        for start in range(0, len(fns), batchSize):
+            batchFns = fns[start:start + batchSize]
+            stack, voxelSizes = readMicrographs(batchFns)
+            if scale > 1:
+                stack = downsample(stack, scale)
+            for fn, x, voxelSize in zip(batchFns, stack, voxelSizes):
+                writeMicrograph(os.path.join(outputDir, os.path.basename(fn)),
+                                normalize(x, **options),
+                                tuple(v * scale for v in voxelSize))
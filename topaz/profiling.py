@@ -0,0 +1,170 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+
+
+import json
+import os
+import resource
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import timedelta
+
+import pyworkflow.utils as pwutils
+
+
+STAGES_LOG = 'topaz_stages.jsonl'
+# Order in which the stages are reported in the summary
+STAGES = ['convert', 'denoise', 'preprocess', 'pick', 'extract', 'train',
+          'coordinates']
+
+# Per thread usage of the process where available (Linux), so parallel
+# steps do not count each other's in-process work
+_RUSAGE_SELF = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+_BLOCK_SIZE = 512
+_logLock = threading.Lock()
+
+
+def getUsage():
+    """ Snapshot of the resources used by the current thread (or process)
+    and its finished child processes. """
+    own = resource.getrusage(_RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'wall': time.time(),
+        'cpu': (own.ru_utime + own.ru_stime +
+                children.ru_utime + children.ru_stime),
+        'read': (own.ru_inblock + children.ru_inblock) * _BLOCK_SIZE,
+        'written': (own.ru_oublock + children.ru_oublock) * _BLOCK_SIZE,
+        # High-water mark of the whole process (and of its largest finished
+        # child) since it started, not of any single stage. ru_maxrss is in
+        # kilobytes on Linux
+        'processPeakRss': max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                       children.ru_maxrss) * 1024
+    }
+
+
+def getStagesLog(protocol):
+    return protocol._getExtraPath(STAGES_LOG)
+
+
+@contextmanager
+def stage(protocol, name, **info):
+    """ Measure a stage of a protocol (wall and CPU time and bytes read
+    and written from disk, with the process peak RSS so far) and append it as a JSON line to
+    the protocol stages log, with any extra info given (e.g. mics, the
+    number of micrographs, or batch).
+    The usage of child processes is only accounted once they finish, so
+    jobs sent to a persistent worker only report their wall time, and
+    stages running at the same time in parallel steps share the usage of
+    the child processes that finished while they were running.
+    """
+    start = getUsage()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        end = getUsage()
+        record = OrderedDict([('stage', name),
+                              ('start', time.strftime('%Y-%m-%d %H:%M:%S',
+                                                      time.localtime(start['wall'])))])
+        record.update(info)
+        for key in ['wall', 'cpu', 'read', 'written']:
+            record[key] = end[key] - start[key]
+        record['wall'] = round(record['wall'], 3)
+        record['cpu'] = round(record['cpu'], 3)
+        record['processPeakRss'] = end['processPeakRss']
+        if failed:
+            record['failed'] = True
+        writeStage(getStagesLog(protocol), record)
+
+
+def writeStage(logFn, record):
+    with _logLock:
+        pwutils.makeFilePath(logFn)
+        with open(logFn, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def readStages(logFn):
+    """ Return the list of records in a stages log. """
+    if not os.path.exists(logFn):
+        return []
+    with open(logFn) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarizeStages(records):
+    """ Aggregate the records by stage: count, mics, wall, cpu, read,
+    written and (maximum) processPeakRss, that older logs call peakRss. """
+    summary = OrderedDict()
+    order = {name: i for i, name in enumerate(STAGES)}
+    for record in sorted(records, key=lambda r: order.get(r['stage'],
+                                                         len(STAGES))):
+        total = summary.setdefault(record['stage'], OrderedDict(
+            [('count', 0), ('mics', 0), ('wall', 0.0), ('cpu', 0.0),
+             ('read', 0), ('written', 0), ('processPeakRss', 0)]))
+        total['count'] += 1
+        for key in ['mics', 'wall', 'cpu', 'read', 'written']:
+            total[key] += record.get(key, 0)
+        total['processPeakRss'] = max(
+            total['processPeakRss'],
+            record.get('processPeakRss', record.get('peakRss', 0)))
+    return summary
+
+
+def formatStagesSummary(logFn):
+    """ Lines describing where the time of the run went, for the summary
+    of the protocols. """
+    summary = summarizeStages(readStages(logFn))
+    if not summary:
+        return []
+    totalWall = sum(s['wall'] for s in summary.values()) or 1
+    lines = ['Time per stage (%s):' % os.path.basename(logFn)]
+    for name, s in summary.items():
+        line = ('  %s: %0.1f s wall (%d%%), %0.1f s CPU, %d runs'
+                % (name, s['wall'], 100 * s['wall'] / totalWall, s['cpu'],
+                   s['count']))
+        if s['mics']:
+            line += ', %0.2f s/mic' % (s['wall'] / s['mics'])
+        line += ', %s read, %s written, process peak RSS so far %s' % (
+            pwutils.prettySize(s['read']), pwutils.prettySize(s['written']),
+            pwutils.prettySize(s['processPeakRss']))
+        lines.append(line)
+    return lines
+
+
+def formatStagesMethods(logFn):
+    """ Sentence with the total processing time for the methods. """
+    summary = summarizeStages(readStages(logFn))
+    if not summary:
+        return []
+    totalWall = sum(s['wall'] for s in summary.values())
+    slowest = max(summary, key=lambda name: summary[name]['wall'])
+    return ['Topaz processing took %s (wall time), %d%% of it spent in %s.'
+            % (pwutils.prettyDelta(timedelta(seconds=totalWall)), 100 * summary[slowest]['wall']
+               / (totalWall or 1), slowest)]
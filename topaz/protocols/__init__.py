@@ -27,6 +27,8 @@
 # **************************************************************************
 
 from .protocol_topaz_training import TopazProtTraining
+from .protocol_topaz_training_sweep import TopazProtTrainingSweep
 from .protocol_topaz_picking import TopazProtPicking
 from .protocol_topaz_import import TopazProtImport
+from .protocol_topaz_rethreshold import TopazProtRethreshold
 
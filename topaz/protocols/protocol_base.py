@@ -27,15 +27,49 @@
 # **************************************************************************
 
 import os
+import re
+from glob import glob
+
+import pyworkflow.utils as pwutils
 from pwem.protocols import EMProtocol
 import pyworkflow.protocol.params as params
 import pyworkflow.protocol.constants as cons
 
+from topaz import Plugin
+from topaz.cache import PreprocessCache
+from topaz.convert import isCompleteMrc
+from topaz.memory import (DENOISE_BYTES_PER_PIXEL, MEMORY_FRACTION,
+                          MIN_PATCH_SIZE, isOutOfMemoryError,
+                          getHostFreeMemory, getGpuFreeMemory,
+                          getMaxMicrographShape, getPatchPadding,
+                          getDenoisePatchSize)
+from topaz.preprocessing import parseOptions, preprocessMicrographs
+from topaz.profiling import (stage, getStagesLog, formatStagesSummary,
+                             formatStagesMethods)
+from topaz.constants import TOPAZ_ENV_ACTIVATION
+from topaz.worker import stopProtocolWorkers
+
+CACHE_FOLDER = 'topaz_cache'
+
 class ProtTopazBase(EMProtocol):
   '''Base for topaz protocols including preprocessing parameters and methods'''
+  PREPROCESS_ENGINES = ['topaz', 'native']
+  PREPROCESS_TOPAZ = 0
+  PREPROCESS_NATIVE = 1
+
   def __init__(self, **args):
     EMProtocol.__init__(self, **args)
 
+  def _defineWorkerParams(self, form):
+    form.addParam('useWorker', params.BooleanParam, default=False,
+                  expertLevel=cons.LEVEL_ADVANCED,
+                  label='Use a persistent Topaz worker?',
+                  help='If set, denoise, preprocess and extract commands are '
+                       'run by a Topaz process that is kept alive during the '
+                       'whole protocol run (one per GPU), so the environment '
+                       'activation and the loading of the models are done '
+                       'only once instead of for every batch.')
+
   def _definePreprocessParams(self, form):
     form.addSection('Pre-process')
     group = form.addGroup('Denoise')
@@ -46,8 +80,16 @@ class ProtTopazBase(EMProtocol):
                    choices=['unet', 'unet-small', 'fcnn', 'affineresnet8'],
                    label='Model',
                    help='Denoising model to use on micrographs.')
+    group.addParam('autoPatchSize', params.BooleanParam, default=False,
+                   label='Automatic patch size?', condition='doDenoise',
+                   help='If set, the patch size is the largest one that fits '
+                        'in the free memory of the GPU (or of the host when '
+                        'no GPU is used), estimated from the size of the '
+                        'micrographs and the denoising model. If denoising '
+                        'fails anyway, it is retried with smaller patches.')
     group.addParam('patchSize', params.IntParam, default=-1,
-                   label='Patch Size', condition='doDenoise',
+                   label='Patch Size',
+                   condition='doDenoise and not autoPatchSize',
                    help='Process each micrograph in patches of this size.\n'
                         'This is useful when using GPU processing and the micrographs '
                         'are too large to be denoised in one shot on your GPU. '
@@ -67,6 +109,34 @@ class ProtTopazBase(EMProtocol):
                    expertLevel=cons.LEVEL_ADVANCED,
                    label="Advanced options",
                    help="Provide advanced command line options here.")
+    group.addParam('preprocessEngine', params.EnumParam,
+                   choices=self.PREPROCESS_ENGINES,
+                   default=self.PREPROCESS_TOPAZ,
+                   expertLevel=cons.LEVEL_ADVANCED,
+                   label='Preprocessing engine',
+                   help='*topaz*: run topaz preprocess.\n'
+                        '*native*: downsample and normalize the micrographs '
+                        'within the protocol, with the same algorithms as '
+                        'topaz preprocess (on the CPU), saving the launch of '
+                        'topaz and a read and write of each micrograph. Only '
+                        'the normalization options of topaz (--affine, '
+                        '--sample, --niters, --alpha, --beta) are accepted '
+                        'as advanced options. Not used in fused picking mode.')
+    group.addParam('useCache', params.BooleanParam, default=False,
+                   expertLevel=cons.LEVEL_ADVANCED,
+                   label='Use project preprocessing cache?',
+                   help='If set, denoised and preprocessed micrographs are '
+                        'stored in a cache shared by all topaz protocols of '
+                        'the project, and micrographs already processed with '
+                        'the same parameters are taken from there instead of '
+                        'running topaz again. Only used when intermediate '
+                        'micrographs are written to disk (not in fused '
+                        'picking mode).')
+    group.addParam('cacheSize', params.FloatParam, default=50,
+                   expertLevel=cons.LEVEL_ADVANCED, condition='useCache',
+                   label='Cache size (GB)',
+                   help='Maximum size of the cache. When exceeded, the least '
+                        'recently used micrographs are removed.')
 
     form.addHidden(params.GPU_LIST, params.StringParam, default='0',
                    expertLevel=cons.LEVEL_ADVANCED,
@@ -77,11 +147,20 @@ class ProtTopazBase(EMProtocol):
 
 
   #UTILS for preprocess steps
-  def getDenoiseArgs(self, inputDir, outDir):
+  def getDenoiseArgs(self, inputDir, outDir, patchSize=None):
       args = ' %s/*.mrc -o %s/' % (inputDir, outDir)
-      args += ' --model %s' % self.getEnumText('modelDenoise')
       args += ' --device %(GPU)s'  # Add GPU that will be set by the executor
-      if self.patchSize.get() > 0:
+      args += self.getDenoiseOptions(patchSize)
+
+      return args
+
+  def getDenoiseOptions(self, patchSize=None):
+      """ Denoising options, without the input, output and device.
+      patchSize replaces the one of the parameters (-1 for no patches). """
+      args = ' --model %s' % self.getEnumText('modelDenoise')
+      if patchSize is not None:
+        args += ' --patch-size %d' % patchSize
+      elif self.patchSize.get() > 0:
         args += ' --patch-size %s' % self.patchSize.get()
 
       if self.denoiseExtra.hasValue():
@@ -102,16 +181,237 @@ class ProtTopazBase(EMProtocol):
 
     return args
 
+  def getPreprocessParams(self):
+    """ Parameters that determine the content of a preprocessed micrograph. """
+    prepParams = {'scale': self.scale.get(),
+                  'preExtra': self.preExtra.get(),
+                  'topaz': Plugin.getVar(TOPAZ_ENV_ACTIVATION)}
+    if self.preprocessEngine.get() == self.PREPROCESS_NATIVE:
+      prepParams['engine'] = 'native'
+    if self.doDenoise:
+      prepParams.update(modelDenoise=self.getEnumText('modelDenoise'),
+                        patchSize=('auto' if self.autoPatchSize
+                                   else self.patchSize.get()),
+                        denoiseExtra=self.denoiseExtra.get())
+    return prepParams
+
+  def getPreprocessCache(self):
+    """ Return the preprocessing cache of the project. """
+    project = self.getProject()
+    path = (project.getTmpPath(CACHE_FOLDER) if project is not None
+            else os.path.join('Tmp', CACHE_FOLDER))
+    return PreprocessCache(path, int(self.cacheSize.get() * 1024 ** 3))
+
+  def preprocessMicrographs(self, inputDir, denoiseDir, outputDir,
+                            stageInfo=None, sourceFns=None):
+    """ Denoise (if selected) and preprocess the mrc micrographs in inputDir,
+    writing the result into outputDir. If the cache is used, micrographs
+    found in it are not processed again. stageInfo is recorded with the
+    stages in the protocol stages log. sourceFns maps the name of each
+    micrograph in inputDir to its original file, so the cache key does not
+    depend on the copy converted by each run. """
+    pwutils.makePath(outputDir)
+    micFns = sorted(glob(os.path.join(inputDir, '*.mrc')))
+    pending = micFns
+
+    if self.useCache:
+      cache = self.getPreprocessCache()
+      prepParams = self.getPreprocessParams()
+      sourceFns = sourceFns or {}
+      keys = {fn: cache.getKey(sourceFns.get(os.path.basename(fn), fn),
+                               prepParams)
+              for fn in micFns}
+      pending = [fn for fn in micFns
+                 if not cache.fetch(keys[fn], os.path.join(outputDir,
+                                                           os.path.basename(fn)))]
+      self.info("Preprocessing cache: %d of %d micrographs found."
+                % (len(micFns) - len(pending), len(micFns)))
+      if not pending:
+        return
+
+      if len(pending) < len(micFns):
+        # Only process the micrographs that were not found
+        inputDir = self.linkPendingMicrographs(inputDir, pending)
+
+    stageInfo = dict(stageInfo or {}, mics=len(pending))
+    if self.doDenoise:
+      pwutils.makePath(denoiseDir)
+      self.runDenoise(inputDir, denoiseDir, stageInfo)
+      inputDir = denoiseDir
+
+    self.runPreprocess(inputDir, outputDir, stageInfo)
+
+    if self.useCache:
+      for fn in pending:
+        cache.store(keys[fn], os.path.join(outputDir, os.path.basename(fn)))
+      cache.evict()
+
+  def getDenoiseFreeMemory(self):
+    """ Bytes of memory that a denoising job can use: those of the GPUs
+    of the protocol, shared by the jobs running on each of them, or those
+    of the host without GPUs. None if unknown. """
+    gpus = self.getGpuList()
+    if not gpus:
+      return getHostFreeMemory() * MEMORY_FRACTION
+    free = getGpuFreeMemory(gpus)
+    if free is None:
+      return None
+    return free * MEMORY_FRACTION / max(1, self.getAttributeValue('jobsPerGpu', 0))
+
+  def getAutoPatchSize(self, micFns, maxPatchSize=None):
+    """ Largest denoising patch size for the micrographs that fits in the
+    free memory (-1 for whole micrographs), None if the memory is unknown. """
+    free = self.getDenoiseFreeMemory()
+    if free is None or not micFns:
+      return None
+    return getDenoisePatchSize(
+      getMaxMicrographShape(micFns), free,
+      DENOISE_BYTES_PER_PIXEL[self.getEnumText('modelDenoise')],
+      padding=getPatchPadding(self.denoiseExtra.get()),
+      maxPatchSize=maxPatchSize)
+
+  def runDenoise(self, inputDir, outputDir, stageInfo=None):
+    """ Denoise the mrc micrographs in inputDir into outputDir. With the
+    automatic patch size, a run that fails out of memory is retried with
+    smaller patches for the micrographs not denoised yet, down to the
+    minimum size. """
+    if not self.autoPatchSize:
+      args = self.getDenoiseArgs(inputDir, outputDir)
+      Plugin.runTopaz(self, 'topaz denoise', args, stageInfo=stageInfo)
+      return
+
+    micFns = sorted(glob(os.path.join(inputDir, '*.mrc')))
+    patchSize = self.getAutoPatchSize(micFns)
+    if patchSize is None:
+      self.info("Free memory unknown, using the default patch size.")
+    while True:
+      self.info("Denoising patch size: %s" % patchSize)
+      args = self.getDenoiseArgs(inputDir, outputDir, patchSize)
+      logSizes = self._getLogSizes()
+      try:
+        Plugin.runTopaz(self, 'topaz denoise', args,
+                        stageInfo=dict(stageInfo or {}, patchSize=patchSize))
+        return
+      except Exception as e:
+        if patchSize is None or 0 < patchSize <= MIN_PATCH_SIZE:
+          raise
+        # Other errors (e.g. a wrong path or model) would fail again
+        if not isOutOfMemoryError(str(e) + self._readLogsSince(logSizes)):
+          raise
+        # Out of memory, retry the rest with smaller patches
+        shape = getMaxMicrographShape(micFns)
+        patchSize = self.getAutoPatchSize(
+          micFns, maxPatchSize=(patchSize if patchSize > 0 else max(shape)) // 2)
+        if patchSize is None:
+          # No size known to fit, do not hide the error with another run
+          self.warning("Denoising failed and the free memory is now "
+                       "unknown, not retrying.")
+          raise
+        self.warning("Denoising failed (%s), retrying with patches of %d px."
+                     % (e, patchSize))
+        inputDir = self.getPendingInput(inputDir, outputDir)
+        if inputDir is None:
+          return
+
+  def _getLogSizes(self):
+    """ Current size of the stdout and stderr logs of the run. """
+    return [os.path.getsize(fn) if os.path.exists(fn) else 0
+            for fn in self.getLogPaths()[:2]]
+
+  def _readLogsSince(self, logSizes):
+    """ Output written to the logs of the run after they had the given
+    sizes, e.g. that of a job that failed. """
+    output = ''
+    for fn, size in zip(self.getLogPaths()[:2], logSizes):
+      if os.path.exists(fn):
+        with open(fn, errors='replace') as f:
+          f.seek(size)
+          output += f.read()
+    return output
+
+  def runPreprocess(self, inputDir, outputDir, stageInfo=None):
+    """ Downsample and normalize the mrc micrographs in inputDir with the
+    selected engine, writing them into outputDir. """
+    if self.preprocessEngine.get() == self.PREPROCESS_NATIVE:
+      micFns = sorted(glob(os.path.join(inputDir, '*.mrc')))
+      with stage(self, 'preprocess', engine='native', **(stageInfo or {})):
+        preprocessMicrographs(micFns, outputDir, self.scale.get(),
+                              **parseOptions(self.preExtra.get()))
+    else:
+      args = self.getPreprocessArgs(inputDir, outputDir)
+      Plugin.runTopaz(self, 'topaz preprocess', args, stageInfo=stageInfo)
+
+  def validatePreprocess(self):
+    """ Errors in the preprocessing parameters. """
+    errors = []
+    if self.preprocessEngine.get() == self.PREPROCESS_NATIVE:
+      try:
+        parseOptions(self.preExtra.get())
+      except Exception as e:
+        errors.append(str(e))
+    return errors
+
+  def linkPendingMicrographs(self, inputDir, pending):
+    """ Link the given micrographs of inputDir into a new 'pending'
+    subfolder, returned to be used as input instead of inputDir. """
+    pendingDir = os.path.join(inputDir, 'pending')
+    pwutils.cleanPath(pendingDir)
+    pwutils.makePath(pendingDir)
+    for fn in pending:
+      pwutils.createAbsLink(os.path.abspath(fn),
+                            os.path.join(pendingDir, os.path.basename(fn)))
+    return pendingDir
+
+  def getPendingInput(self, inputDir, outputDir):
+    """ Return the folder with the mrc micrographs of inputDir that do not
+    have a complete output in outputDir yet (e.g. after an interrupted
+    job): inputDir itself, a folder with links to the pending ones or
+    None if all of them are done. """
+    micFns = sorted(glob(os.path.join(inputDir, '*.mrc')))
+    pending = [fn for fn in micFns if not isCompleteMrc(
+      os.path.join(outputDir, os.path.basename(fn)))]
+    if len(pending) < len(micFns):
+      self.info("%d of %d micrographs already processed in %s."
+                % (len(micFns) - len(pending), len(micFns), outputDir))
+    if not pending:
+      return None
+    if len(pending) == len(micFns):
+      return inputDir
+    return self.linkPendingMicrographs(inputDir, pending)
+
+  def getStagesSummary(self):
+    """ Summary of the time and resources used by each stage, from the
+    stages log of the run. """
+    return formatStagesSummary(getStagesLog(self))
+
+  def getStagesMethods(self):
+    return formatStagesMethods(getStagesLog(self))
+
+  def stopTopazWorkers(self):
+    """ Stop the persistent topaz workers started by this protocol, if any. """
+    stopProtocolWorkers(self)
+
   def getOutputModelPath(self):
     return self.MODEL
 
-  def getLastEpochModel(self, modelsDir, ext='.sav'):
-    '''Return the last trained model, in alphabetic order (last trained epoch) in modelsDir'''
-    modelFn = 'model.sav'
+  def getEpochModels(self, modelsDir, ext='.sav', prefix='model'):
+    '''Return a dict epoch -> model file with the models saved by topaz train
+    (<prefix>_epoch<N>.sav, N not always zero padded) in modelsDir'''
+    models = {}
+    pattern = re.compile(r'^%s_epoch(\d+)%s$' % (re.escape(prefix),
+                                                 re.escape(ext)))
     for file in os.listdir(modelsDir):
-      if ext in file:
-        modelFn = file
-    return os.path.join(modelsDir, modelFn)
+      match = pattern.search(file)
+      if match:
+        models[int(match.group(1))] = os.path.join(modelsDir, file)
+    return models
+
+  def getLastEpochModel(self, modelsDir, ext='.sav'):
+    '''Return the model of the last trained epoch in modelsDir'''
+    models = self.getEpochModels(modelsDir, ext)
+    if not models:
+      return os.path.join(modelsDir, 'model.sav')
+    return models[max(models)]
 
 
 
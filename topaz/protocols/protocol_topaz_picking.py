@@ -25,21 +25,34 @@
 # **************************************************************************
 
 import os
+import shlex
 import time
 
+import numpy as np
+
 import pyworkflow.utils as pwutils
 import pyworkflow.protocol.params as params
 import pyworkflow.protocol.constants as cons
 from pwem.protocols import ProtParticlePickingAuto
 
-from topaz import convert, Plugin
+from topaz import convert, constants, Plugin
 from topaz.protocols.protocol_base import ProtTopazBase
-from topaz.convert import (readSetOfCoordinates)
+from topaz.convert import (readSetOfCoordinates, CsvMicrographList,
+                           MicrographIndex, getScoredPicksFile,
+                           COORDINATE_STORE_EXT)
+from topaz.worker import PICK_PROGRAM
+from topaz.batching import BatchSizeController
+from topaz.profiling import stage
+from topaz.scratch import ScratchSpace, KEEP_ALL, KEEP_LAST
 
 TOPAZ_COORDINATES_FILE = 'topaz_coordinates_file'
+MODEL_COORDINATES_FILE = 'model_coordinates_file'
 PICKING_DENOISE_FOLDER = 'picking_denoise_folder'
 PICKING_PRE_FOLDER = 'picking_pre_folder'
 PICKING_FOLDER = 'picking_folder'
+PICKING_IMAGE_LIST = 'picking_image_list'
+PICKING_MIC_COORDS_FOLDER = 'picking_mic_coords_folder'
+SCORED_PICKS_FILE = 'scored_picks_file'
 MODEL_FOLDER = 'model_folder'
 
 
@@ -57,6 +70,10 @@ class TopazProtPicking(ProtParticlePickingAuto, ProtTopazBase):
   MODEL_RESNET8_U64 = 2
   MODEL_RESNET8_U32 = 3
 
+  PICKING_MODES = ['staged', 'fused']
+  PICKING_STAGED = 0
+  PICKING_FUSED = 1
+
   def __init__(self, **args):
     ProtParticlePickingAuto.__init__(self, **args)
     self.stepsExecutionMode = cons.STEPS_PARALLEL
@@ -78,12 +95,41 @@ class TopazProtPicking(ProtParticlePickingAuto, ProtTopazBase):
                   condition='modelInitialization== %s' % self.ADD_MODEL_PRETRAINED, allowsNull=True,
                   label='Select topaz model',
                   help='Select a topaz model to continue from.')
+    form.addParam('useModelThreshold', params.BooleanParam, default=True,
+                  condition='modelInitialization== %s' % self.ADD_MODEL_PRETRAINED,
+                  label='Use threshold estimated in training?',
+                  help='If the model comes with a threshold and extraction '
+                       'radius estimated on the test micrographs during '
+                       'training, use them instead of the extraction '
+                       'threshold and radius given in the Picking section.')
     form.addParam('generalModel', params.EnumParam,
                   choices=self.GENERAL_MODELS, default=self.MODEL_RESNET16_U64,
                   condition='modelInitialization== %s' % self.ADD_MODEL_GENERAL,
                   label='Topaz general model',
                   help='A topaz NN model pretrained and provided in topaz sofware.'
                        '\nMight not be optimized for specific particles')
+    form.addParam('otherModels', params.MultiPointerParam,
+                  pointerClass='TopazModel', allowsNull=True,
+                  label='Other topaz models to compare',
+                  help='Each micrograph is preprocessed once and picked with '
+                       'the model above and with each of these models, '
+                       'producing one set of coordinates per model '
+                       '(outputCoordinates1, outputCoordinates2...).')
+    form.addParam('otherGeneralModels', params.StringParam, default='',
+                  label='Other general models to compare',
+                  help='Names of topaz general models (%s), separated by '
+                       'spaces, also picked from the same preprocessed '
+                       'micrographs after the topaz models above.'
+                       % ', '.join(self.GENERAL_MODELS))
+    form.addParam('otherThresholds', params.NumericListParam, default='',
+                  label='Thresholds of the other models',
+                  help='Extraction threshold of each of the other models, in '
+                       'the same order. If empty, the threshold (and radius) '
+                       'estimated in training is used for the topaz models '
+                       'that have it, and the extraction threshold of the '
+                       'Picking section otherwise. Re-thresholding and '
+                       'publishing picks per micrograph only apply to the '
+                       'main model.')
 
     form.addSection('Picking')
     form.addParam('radius', params.IntParam, default=8,
@@ -97,11 +143,120 @@ class TopazProtPicking(ProtParticlePickingAuto, ProtTopazBase):
                   help='log-likelihood score threshold at which to terminate region extraction. '
                        '\nValue -6 is p>=0.0025 (default: -6)'
                        '\nHigher values will mean a more restrictive picking')
+    form.addParam('storePicks', params.BooleanParam, default=False,
+                  label='Store picks for re-thresholding?',
+                  help='If *Yes*, particles are extracted down to the '
+                       'threshold below and all the scored picks are kept in '
+                       'a compact file, while the output only contains those '
+                       'above the extraction threshold. Use the protocol '
+                       '*re-threshold picks* to get coordinates at another '
+                       'threshold without picking again.')
+    form.addParam('storeThreshold', params.FloatParam, default=-10.0,
+                  condition='storePicks',
+                  label='Store picks above',
+                  help='Lowest threshold that can be used later when '
+                       're-thresholding.')
+    form.addParam('minDistance', params.FloatParam, default=0,
+                  expertLevel=cons.LEVEL_ADVANCED,
+                  label='Minimum distance between picks (px)',
+                  help='Picks closer than this distance (in the same pixels '
+                       'as the particle radius) to a pick with a higher '
+                       'score are removed, e.g. duplicates coming from '
+                       'overlapping patches. Use 0 to keep all of them.')
+    form.addParam('maxPicksPerMic', params.IntParam, default=0,
+                  expertLevel=cons.LEVEL_ADVANCED,
+                  label='Maximum picks per micrograph',
+                  help='Keep only this number of picks, the ones with the '
+                       'highest scores, in each micrograph. Use 0 to keep '
+                       'all of them.')
+    form.addParam('pickingMode', params.EnumParam,
+                  choices=self.PICKING_MODES, default=self.PICKING_STAGED,
+                  expertLevel=cons.LEVEL_ADVANCED,
+                  label='Picking mode',
+                  help='*staged*: run topaz denoise, preprocess and extract '
+                       'one after the other, writing the intermediate '
+                       'micrographs to disk (useful for debugging).\n'
+                       '*fused*: each micrograph is denoised, preprocessed and '
+                       'picked in memory and only the coordinates are written.')
+    form.addParam('streamPicks', params.BooleanParam, default=False,
+                  condition='pickingMode==%d' % self.PICKING_FUSED,
+                  expertLevel=cons.LEVEL_ADVANCED,
+                  label='Publish picks per micrograph',
+                  help='If *Yes*, the coordinates of each micrograph are '
+                       'added to the output as soon as it is picked, '
+                       'instead of waiting for the whole batch. This reduces '
+                       'the time until the first particles are available '
+                       'for the next protocols in streaming.')
+    form.addParam('binaryCoordinates', params.BooleanParam, default=False,
+                  condition='pickingMode==%d' % self.PICKING_FUSED,
+                  expertLevel=cons.LEVEL_ADVANCED,
+                  label='Binary coordinates?',
+                  help='If *Yes*, the coordinates of each batch are passed '
+                       'from topaz as binary columns instead of a text '
+                       'file, avoiding formatting and parsing them. They '
+                       'are not published per micrograph in this case.')
 
     form.addParallelSection(threads=1, mpi=1)
+    self._defineWorkerParams(form)
+    form.addParam('jobsPerGpu', params.IntParam, default=0,
+                  expertLevel=cons.LEVEL_ADVANCED,
+                  label='Topaz jobs per GPU',
+                  help='Maximum number of topaz jobs (denoise, preprocess, '
+                       'extract) running at the same time on each GPU. Each '
+                       'job is sent to the least loaded of the selected GPUs '
+                       'and waits if all of them are full. With 0, the GPU '
+                       'assigned by Scipion to each step is used.')
     self._definePreprocessParams(form)
     self._defineStreamingParams(form)
     form.getParam('streamingBatchSize').setDefault(32)
+    form.addParam('adaptiveBatch', params.BooleanParam, default=False,
+                  label='Adapt batch size?',
+                  help='If *Yes*, the batch size above is only the initial '
+                       'one. The time spent in each batch is measured to '
+                       'estimate the overhead per batch and the cost per '
+                       'micrograph, and the size of the next batches is '
+                       'changed within the limits below.')
+    line = form.addLine('Batch size limits', condition='adaptiveBatch',
+                        help='Minimum and maximum number of micrographs '
+                             'per batch.')
+    line.addParam('minBatchSize', params.IntParam, default=4, label='Min')
+    line.addParam('maxBatchSize', params.IntParam, default=256, label='Max')
+    form.addParam('targetLatency', params.FloatParam, default=0,
+                  condition='adaptiveBatch',
+                  label='Target latency (s)',
+                  help='Time from the arrival of a micrograph until its '
+                       'coordinates are ready. Batches are made as large as '
+                       'possible while keeping this latency, taking into '
+                       'account the arrival rate of the micrographs. '
+                       'With 0, batches are made large enough for the '
+                       'overhead to be below 10% of the batch time, '
+                       'maximizing the throughput.')
+
+    form.addParam('scratchRetention', params.EnumParam, default=KEEP_ALL,
+                  choices=['all', 'coordinates', 'last batches'],
+                  expertLevel=cons.LEVEL_ADVANCED,
+                  label='Keep intermediate files',
+                  help='Files kept in the tmp folder of the run for each '
+                       'picked batch (micrograph links or conversions, '
+                       'denoised and preprocessed micrographs):\n'
+                       '*all*: nothing is removed.\n'
+                       '*coordinates*: only the coordinates file of each '
+                       'batch is kept.\n'
+                       '*last batches*: only the last batches are kept '
+                       'complete, the older ones keep only the coordinates.')
+    form.addParam('keepBatches', params.IntParam, default=2,
+                  condition='scratchRetention==%d' % KEEP_LAST,
+                  expertLevel=cons.LEVEL_ADVANCED,
+                  label='Batches to keep',
+                  help='Number of finished batches whose intermediate files '
+                       'are kept.')
+    form.addParam('scratchQuota', params.FloatParam, default=0,
+                  condition='scratchRetention!=%d' % KEEP_ALL,
+                  expertLevel=cons.LEVEL_ADVANCED,
+                  label='Scratch quota (GB)',
+                  help='If the batch folders use more than this, new batches '
+                       'wait until the running ones finish and their files '
+                       'are removed. With 0, there is no limit.')
 
   # -------------------------- INSERT steps functions -----------------------
   def _insertInitialSteps(self):
@@ -118,8 +273,14 @@ class TopazProtPicking(ProtParticlePickingAuto, ProtTopazBase):
       PICKING_FOLDER: pickingFolder,
       PICKING_DENOISE_FOLDER: pickingDenoiseFolder,
       PICKING_PRE_FOLDER: pickingPreFolder,
+      PICKING_IMAGE_LIST: os.path.join(pickingFolder, "image_list.txt"),
+      PICKING_MIC_COORDS_FOLDER: self._getTmpPath("coordinates"),
+      SCORED_PICKS_FILE: getScoredPicksFile(self._getExtraPath(),
+                                            "%(min)s-%(max)s"),
       TOPAZ_COORDINATES_FILE: os.path.join(pickingPreFolder,
-                                           "topaz_coordinates%(min)s-%(max)s.txt")
+                                           "topaz_coordinates%(min)s-%(max)s.txt"),
+      MODEL_COORDINATES_FILE: os.path.join(
+        pickingPreFolder, "topaz_coordinates%(min)s-%(max)s_model%(model)d.txt")
     }
 
     self._updateFilenamesDict(myDict)
@@ -130,72 +291,381 @@ class TopazProtPicking(ProtParticlePickingAuto, ProtTopazBase):
     self._pickMicrographList([micrograph], *args)
 
   def _pickMicrographList(self, micList, *args):
+    scratch = self._getScratchSpace()
+    workingDir = self.getPickingFileName(micList, PICKING_FOLDER)
+    scratch.startBatch(workingDir, log=self.info)
+
+    t0 = time.time()
+    failed = True
+    try:
+      if self.pickingMode.get() == self.PICKING_FUSED:
+        self._pickMicrographListFused(micList)
+      else:
+        self._pickMicrographListStaged(micList)
+      failed = False
+    finally:
+      # Only the coordinates are needed once the batch is picked
+      scratch.finishBatch(workingDir, failed=failed, keepFiles=[
+        self.getCoordinatesFn(micList, model)
+        for model in range(len(self.getPickingModels()))])
+
+    if self.adaptiveBatch:
+      self._getBatchController().addBatch(len(micList), time.time() - t0)
+
+  def _pickMicrographListStaged(self, micList):
     # Link or convert the whole set of micrographs to "batch" folders
     workingDir = self.getPickingFileName(micList, PICKING_FOLDER)
     pwutils.makePath(workingDir)
 
-    convert.convertMicrographs(micList, workingDir)
+    stageInfo = self._getStageInfo(micList)
+    with stage(self, 'convert', **stageInfo):
+      convert.convertMicrographs(micList, workingDir,
+                                 self.numberOfThreads.get())
 
-    if self.doDenoise:
-      denoisedDir = self.getPickingFileName(micList, PICKING_DENOISE_FOLDER)
-      pwutils.makePath(denoisedDir)
-      # denoise the micrographs in the batch folder, output in denoisedDir
-      args = self.getDenoiseArgs(workingDir, denoisedDir)
-      Plugin.runTopaz(self, 'topaz denoise', args)
-      workingDir = denoisedDir
-
-    # create preprocessed folder under the workingDir.
-    # Now in the extra folder should be replaced in tmp folder
+    # denoise (if selected) and preprocess the micrographs in the batch
+    # folder, output in preprocessedDir
+    denoisedDir = self.getPickingFileName(micList, PICKING_DENOISE_FOLDER)
     preprocessedDir = self.getPickingFileName(micList, PICKING_PRE_FOLDER)
-    pwutils.makePath(preprocessedDir)
-
-    # preprocess the micrographs in the batch folder, output in preprocessedDir
-    args = self.getPreprocessArgs(workingDir, preprocessedDir)
-    Plugin.runTopaz(self, 'topaz preprocess', args)
-
-    # perform prediction on the preprocessed micrographs
-    if self.modelInitialization.get() == self.ADD_MODEL_PRETRAINED:
-      modelFn = self.prevTopazModel.get().getPath()
-    elif self.modelInitialization.get() == self.ADD_MODEL_GENERAL:
-      modelFn = self.getEnumText('generalModel')
-
-    # Launch process called extract which is rather a prediction
-    args = ' -t {}'.format(self.threshold.get())
-    args += ' -r %d' % self.radius.get()
-    args += ' -m %s' % modelFn
-    args += ' -o %s' % self.getPickingFileName(micList,
-                                               TOPAZ_COORDINATES_FILE)
-    args += ' --num-workers %d' % self.numberOfThreads
+    sourceFns = {convert.getMicIdName(mic, '.mrc'): mic.getFileName()
+                 for mic in micList}
+    self.preprocessMicrographs(workingDir, denoisedDir, preprocessedDir,
+                               stageInfo, sourceFns=sourceFns)
+
+    # Launch process called extract which is rather a prediction, once per
+    # model from the same preprocessed micrographs
+    for model, (modelFn, radius, threshold) in enumerate(self.getPickingModels()):
+      args = ' -t {}'.format(threshold)
+      args += ' -r %d' % radius
+      args += ' -m %s' % modelFn
+      args += ' -o %s' % self.getCoordinatesFn(micList, model)
+      args += ' --num-workers %d' % self.numberOfThreads
+      args += ' --device %(GPU)s'  # Add GPU that will be set by the executor
+      args += ' %s/*.mrc' % preprocessedDir
+
+      Plugin.runTopaz(self, 'topaz extract', args,
+                      stageInfo=dict(stageInfo, model=model))
+
+  def _pickMicrographListFused(self, micList):
+    """ Denoise, preprocess and extract in a single pass, keeping the
+    micrographs in memory. Only micrographs in formats not supported by
+    topaz are converted into the batch folder. """
+    workingDir = self.getPickingFileName(micList, PICKING_FOLDER)
+    pwutils.makePath(workingDir)
+    coordsFn = self.getCoordinatesFn(micList)
+    pwutils.makeFilePath(coordsFn)
+
+    stageInfo = self._getStageInfo(micList)
+    ext = pwutils.getExt(micList[0].getFileName())
+    if ext not in constants.TOPAZ_SUPPORTED_FORMATS:
+      with stage(self, 'convert', **stageInfo):
+        convert.convertMicrographs(micList, workingDir,
+                                   self.numberOfThreads.get())
+
+    imageListFn = self.getPickingFileName(micList, PICKING_IMAGE_LIST)
+    csvMics = CsvMicrographList(imageListFn, 'w')
+    micFns = []
+    for mic in micList:
+      if ext in constants.TOPAZ_SUPPORTED_FORMATS:
+        micFn = os.path.abspath(mic.getFileName())
+      else:
+        micFn = os.path.join(workingDir, convert.getMicIdName(mic, '.mrc'))
+      csvMics.addMic(mic.getObjId(), micFn)
+      micFns.append(micFn)
+    csvMics.close()
+
+    patchSize = None
+    if self.doDenoise and self.autoPatchSize and pwutils.getExt(micFns[0]) == '.mrc':
+      # No retry here, the whole batch is picked by a single process
+      patchSize = self.getAutoPatchSize(micFns)
+
+    args = ' --images %s' % imageListFn
+    args += ' -o %s' % coordsFn
+    args += ' -m %s' % self.getModelFn()
+    args += ' -r %d' % self.getExtractionRadius()
+    args += ' -t {}'.format(self.getExtractionThreshold())
+    args += ' --scale %d' % self.scale.get()
     args += ' --device %(GPU)s'  # Add GPU that will be set by the executor
-    args += ' %s/*.mrc' % preprocessedDir
-
-    Plugin.runTopaz(self, 'topaz extract', args)
-
-  def readCoordsFromMics(self, outputDir, micDoneList, outputCoords):
+    if self.doDenoise:
+      args += ' --denoise --denoise-args %s' % shlex.quote(
+        self.getDenoiseOptions(patchSize))
+    if self.preExtra.hasValue():
+      args += ' --preprocess-args %s' % shlex.quote(' ' + self.preExtra.get())
+    if self._streamPicks():
+      args += ' --per-micrograph %s' % self._getFileName(PICKING_MIC_COORDS_FOLDER)
+    if self._binaryCoordinates():
+      args += ' --columns'
+    # The other models score the same preprocessed micrographs
+    for model, (modelFn, radius, threshold) in enumerate(self.getPickingModels()):
+      if model > 0:
+        args += ' --extra-model %s %s %d %s' % (
+          modelFn, self.getCoordinatesFn(micList, model), radius, threshold)
+
+    Plugin.runTopaz(self, PICK_PROGRAM, args, stageInfo=stageInfo)
+
+  def readCoordsFromMics(self, outputDir, micDoneList, outputCoords, model=0):
     """ Read the coordinates from a given list of micrographs """
+    stageInfo = self._getStageInfo(micDoneList)
+    if model:
+      stageInfo['model'] = model
+    with stage(self, 'coordinates', **stageInfo):
+      self._readCoordsFromMics(micDoneList, outputCoords, model)
 
-    outputParticlesFn = self.getPickingFileName(micDoneList,
-                                                TOPAZ_COORDINATES_FILE)
-
+  def _readCoordsFromMics(self, micDoneList, outputCoords, model=0):
     scale = self.scale.get()
-    readSetOfCoordinates(outputParticlesFn, outputCoords.getMicrographs(),
-                         outputCoords, scale)
+    micIndex = self._getMicrographIndex(outputCoords.getMicrographs())
+    # Picks are stored for re-thresholding only for the main model
+    storePicks = self.storePicks and model == 0
+
+    if self._streamPicks():
+      # Each micrograph has its own file, written once it was picked
+      coordsFiles = [self._getMicCoordsFn(mic) for mic in micDoneList]
+    else:
+      coordsFiles = [self.getCoordinatesFn(micDoneList, model)]
+
+    if storePicks or self._filterPicks():
+      picks = [np.concatenate(c) for c in
+               zip(*[convert.readCoordinates(fn, scale) for fn in coordsFiles])]
+      if storePicks:
+        # Keep every pick and add to the output those above the threshold
+        picksFn = self.getPickingFileName(micDoneList, SCORED_PICKS_FILE)
+        pwutils.makeFilePath(picksFn)
+        convert.writeScoredPicks(picksFn, *picks)
+        # The filter below is applied again when re-thresholding
+        convert.writeScoredPicksFilter(self._getExtraPath(),
+                                       self.minDistance.get() * scale,
+                                       self.maxPicksPerMic.get())
+        mask = picks[3] >= self.getThreshold()
+        picks = [c[mask] for c in picks]
+      picks = convert.filterPicks(*picks,
+                                  minDistance=self.minDistance.get() * scale,
+                                  maxPerMic=self.maxPicksPerMic.get())
+      convert.appendCoordinates(outputCoords, micIndex, *picks)
+    else:
+      for coordsFn in coordsFiles:
+        readSetOfCoordinates(coordsFn, micIndex, outputCoords, scale)
 
     if self.boxSize.get() == -1:
-      boxSize = self.radius.get() * 2 * scale
+      boxSize = self.getPickingModels()[model][1] * 2 * scale
     else:
       boxSize = self.boxSize.get()
     outputCoords.setBoxSize(boxSize)
 
+  def createOutputStep(self):
+    # No more batches to pick, the persistent workers are not needed
+    self.stopTopazWorkers()
+    ProtParticlePickingAuto.createOutputStep(self)
+
+  def _updateOutputCoordSet(self, micList, streamMode):
+    micDoneList = ProtParticlePickingAuto._updateOutputCoordSet(self, micList,
+                                                                streamMode)
+    for model in range(1, len(self.getPickingModels())):
+      self._updateModelCoordSet(model, micDoneList, streamMode)
+    return micDoneList
+
+  def _updateStreamState(self, streamMode):
+    ProtParticlePickingAuto._updateStreamState(self, streamMode)
+    for model in range(1, len(self.getPickingModels())):
+      self._updateModelCoordSet(model, [], streamMode)
+
+  def _updateModelCoordSet(self, model, micDoneList, streamMode):
+    """ Add the coordinates of the micrographs picked by one of the other
+    models to its own output, as done for outputCoordinates. """
+    outputName = 'outputCoordinates%d' % model
+    outputCoords = getattr(self, outputName, None)
+    firstTime = outputCoords is None
+
+    if firstTime:
+      outputCoords = self._createSetOfCoordinates(
+        self.getInputMicrographsPointer(), suffix=str(model))
+    else:
+      outputCoords.enableAppend()
+
+    if micDoneList:
+      self.readCoordsFromMics(self.getCoordsDir(), micDoneList, outputCoords,
+                              model)
+    outputCoords.setObjComment(self.getSummary(outputCoords))
+    self._updateOutputSet(outputName, outputCoords, streamMode)
+
+    if firstTime:
+      self._defineSourceRelation(self.getInputMicrographsPointer(),
+                                 outputCoords)
+
+  def _insertNewMicsSteps(self, inputMics):
+    if self.adaptiveBatch:
+      self._getBatchController().addArrivals(mic.getObjId()
+                                             for mic in inputMics)
+    return ProtParticlePickingAuto._insertNewMicsSteps(self, inputMics)
+
   # --------------------------- UTILS functions --------------------------
+  def _getBatchController(self):
+    if getattr(self, '_batchController', None) is None:
+      self._batchController = BatchSizeController(
+        self.minBatchSize.get(), self.maxBatchSize.get(),
+        initialSize=self.streamingBatchSize.get(),
+        targetLatency=self.targetLatency.get())
+    return self._batchController
+
+  def _getScratchSpace(self):
+    if getattr(self, '_scratchSpace', None) is None:
+      retention = self.scratchRetention.get()
+      # Nothing would be freed while waiting if all the files are kept
+      quota = 0 if retention == KEEP_ALL else self.scratchQuota.get()
+      self._scratchSpace = ScratchSpace(retention, self.keepBatches.get(),
+                                        int(quota * 1024 ** 3))
+    return self._scratchSpace
+
+  def _getStreamingBatchSize(self):
+    if not self.adaptiveBatch:
+      return ProtParticlePickingAuto._getStreamingBatchSize(self)
+
+    controller = self._getBatchController()
+    lastSize = getattr(self, '_lastBatchSize', None)
+    size = controller.getBatchSize()
+    if size != lastSize:
+      self.info("Batch size: %s -> %d (%s)" % (lastSize, size,
+                                               controller.reason))
+      self._lastBatchSize = size
+    return size
+
   def getPickingFileName(self, micList, key):
     return self._getFileName(key, **{"min": micList[0].strId(),
                                      'max': micList[-1].strId()})
 
+  def getCoordinatesFn(self, micList, model=0):
+    """ Coordinates extracted by the given model (0 for the main one,
+    then the other models in order) from a batch of micrographs. """
+    if model == 0:
+      coordsFn = self.getPickingFileName(micList, TOPAZ_COORDINATES_FILE)
+    else:
+      coordsFn = self._getFileName(MODEL_COORDINATES_FILE, model=model,
+                                   **{"min": micList[0].strId(),
+                                      'max': micList[-1].strId()})
+    if self._binaryCoordinates():
+      # A coordinate store (folder) instead of the text file
+      coordsFn = pwutils.replaceExt(coordsFn, COORDINATE_STORE_EXT[1:])
+    return coordsFn
+
+  def _getStageInfo(self, micList):
+    """ Fields recorded in the stages log for a batch of micrographs. """
+    return {'mics': len(micList),
+            'batch': '%s-%s' % (micList[0].strId(), micList[-1].strId())}
+
+  def _streamPicks(self):
+    # The coordinates of the other models are only written per batch
+    return (self.pickingMode.get() == self.PICKING_FUSED and
+            self.streamPicks.get() and not self.binaryCoordinates and
+            len(self.getPickingModels()) == 1)
+
+  def _binaryCoordinates(self):
+    return (self.pickingMode.get() == self.PICKING_FUSED and
+            self.binaryCoordinates.get())
+
+  def _filterPicks(self):
+    return self.minDistance.get() > 0 or self.maxPicksPerMic.get() > 0
+
+  def _getMicCoordsFn(self, mic):
+    return os.path.join(self._getFileName(PICKING_MIC_COORDS_FOLDER),
+                        convert.getMicCoordinatesName(mic.getObjId()))
+
+  def _isMicDone(self, mic):
+    """ When publishing picks per micrograph, a micrograph is done as soon
+    as its coordinates file is written, even if the rest of the batch is
+    still being picked. """
+    return (ProtParticlePickingAuto._isMicDone(self, mic) or
+            (self._streamPicks() and os.path.exists(self._getMicCoordsFn(mic))))
+
+  def _getMicrographIndex(self, micSet):
+    """ Return the micrograph index kept during the whole run, so only the
+    micrographs of each new batch are read from the (refreshed) set. """
+    if getattr(self, '_micIndex', None) is None:
+      self._micIndex = MicrographIndex()
+    self._micIndex.setMicrographs(micSet)
+    return self._micIndex
+
+  def _getTrainedOperatingPoint(self):
+    """ The model from training if it has an estimated threshold
+    to be used, otherwise None. """
+    if (self.modelInitialization.get() == self.ADD_MODEL_PRETRAINED and
+        self.useModelThreshold):
+      model = self.prevTopazModel.get()
+      if model is not None and model.hasThreshold():
+        return model
+    return None
+
+  def getThreshold(self):
+    """ Threshold of the output coordinates. """
+    model = self._getTrainedOperatingPoint()
+    return model.getThreshold() if model else self.threshold.get()
+
+  def getExtractionRadius(self):
+    model = self._getTrainedOperatingPoint()
+    return model.getRadius() if model else self.radius.get()
+
+  def getExtractionThreshold(self):
+    """ Threshold used by topaz, lower than the one of the output if
+    the picks are stored for re-thresholding. """
+    if self.storePicks:
+      return min(self.getThreshold(), self.storeThreshold.get())
+    return self.getThreshold()
+
+  def getModelFn(self):
+    """ Return the model path (or general model name) used for extraction. """
+    if self.modelInitialization.get() == self.ADD_MODEL_PRETRAINED:
+      return self.prevTopazModel.get().getPath()
+    else:
+      return self.getEnumText('generalModel')
+
+  def getPickingModels(self):
+    """ Return a (model, radius, threshold) tuple for each model used
+    in extraction: the main one followed by the other models. """
+    models = [(self.getModelFn(), self.getExtractionRadius(),
+               self.getExtractionThreshold())]
+    others = [(p.get().getPath(), p.get()) for p in self.otherModels
+              if p.get() is not None]
+    others += [(name, None) for name in self.otherGeneralModels.get('').split()]
+    thresholds = pwutils.getFloatListFromValues(self.otherThresholds.get(''))
+
+    for i, (modelFn, model) in enumerate(others):
+      radius, threshold = self.radius.get(), self.threshold.get()
+      if self.useModelThreshold and model is not None and model.hasThreshold():
+        radius, threshold = model.getRadius(), model.getThreshold()
+      if thresholds:
+        threshold = thresholds[i]
+      models.append((modelFn, radius, threshold))
+    return models
+
+
+  def _summary(self):
+    summary = ProtParticlePickingAuto._summary(self)
+    # The model paths can not be resolved without the input model
+    if (self.modelInitialization.get() != self.ADD_MODEL_PRETRAINED or
+        self.prevTopazModel.get() is not None):
+      for model, (modelFn, _, threshold) in enumerate(self.getPickingModels()):
+        outputName = 'outputCoordinates%d' % model
+        if model and self.hasAttribute(outputName):
+          summary.append('%s: %d particles picked with %s (threshold %s)'
+                         % (outputName, getattr(self, outputName).getSize(),
+                            os.path.basename(modelFn), threshold))
+    return summary + self.getStagesSummary()
+
+  def _methods(self):
+    methods = ProtParticlePickingAuto._methods(self)
+    return methods + self.getStagesMethods()
 
   def _validate(self):
     validateMsgs = []
     if self.modelInitialization.get() == self.ADD_MODEL_PRETRAINED:
       if self.prevTopazModel.get() is None:
         validateMsgs.append('Model not ready')
-    return validateMsgs
\ No newline at end of file
+    names = self.otherGeneralModels.get('').split()
+    if any(name not in self.GENERAL_MODELS for name in names):
+      validateMsgs.append('The other general models should be among: %s'
+                          % ', '.join(self.GENERAL_MODELS))
+    thresholds = pwutils.getFloatListFromValues(self.otherThresholds.get(''))
+    numOthers = len(self.otherModels) + len(names)
+    if thresholds and len(thresholds) != numOthers:
+      validateMsgs.append('Give one threshold per other model (%d).'
+                          % numOthers)
+    if self.scratchRetention.get() == KEEP_LAST and self.keepBatches.get() < 0:
+      validateMsgs.append('The number of batches to keep can not be negative.')
+    return validateMsgs + self.validatePreprocess()
\ No newline at end of file
@@ -0,0 +1,130 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+
+import pyworkflow.protocol.params as params
+from pwem.protocols import EMProtocol
+
+from topaz.convert import (MicrographIndex, getScoredPicksFiles,
+                           readScoredPicks, readScoredPicksFilter,
+                           filterPicks, appendCoordinates)
+
+
+class TopazProtRethreshold(EMProtocol):
+    """ Derive a new set of coordinates at another threshold from the picks
+    stored by a topaz picking run (with *Store picks for re-thresholding*),
+    without picking the micrographs again. The minimum distance and maximum
+    picks per micrograph of the picking run are applied as well.
+    """
+    _label = 're-threshold picks'
+
+    # -------------------------- DEFINE param functions -----------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputCoordinates', params.PointerParam,
+                      pointerClass='SetOfCoordinates',
+                      label='Topaz coordinates',
+                      help='Output of a topaz picking run that stored its '
+                           'picks for re-thresholding. Picks are only stored '
+                           'for the main model (outputCoordinates).')
+        form.addParam('threshold', params.FloatParam, default=-3.0,
+                      label='Threshold',
+                      help='Keep the picks with a score (log-likelihood) '
+                           'equal or higher than this value. It can not be '
+                           'lower than the one used to store the picks.')
+
+    # --------------------------- INSERT steps functions ----------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep('createOutputStep')
+
+    # --------------------------- STEPS functions -----------------------------
+    def createOutputStep(self):
+        inputCoords = self.inputCoordinates.get()
+        picksFns = self.getScoredPicksFiles()
+        micIds, xs, ys, scores = readScoredPicks(picksFns,
+                                                 self.threshold.get())
+        self.info("%d picks with score >= %s in %d files"
+                  % (len(scores), self.threshold.get(), len(picksFns)))
+        settings = self.getFilterSettings()
+        if settings['minDistance'] > 0 or settings['maxPerMic'] > 0:
+            micIds, xs, ys, scores = filterPicks(micIds, xs, ys, scores,
+                                                 **settings)
+            self.info("%d picks after filtering them as in picking (minimum "
+                      "distance %s px, maximum %d per micrograph)"
+                      % (len(scores), settings['minDistance'],
+                         settings['maxPerMic']))
+
+        micSet = inputCoords.getMicrographs()
+        outputCoords = self._createSetOfCoordinates(micSet)
+        outputCoords.setBoxSize(inputCoords.getBoxSize())
+        appendCoordinates(outputCoords, MicrographIndex(micSet),
+                          micIds, xs, ys, scores)
+
+        self._defineOutputs(outputCoordinates=outputCoords)
+        self._defineSourceRelation(self.inputCoordinates, outputCoords)
+
+    # --------------------------- UTILS functions -----------------------------
+    def getScoredPicksFiles(self):
+        """ Files stored by the picking run that produced the input. """
+        return getScoredPicksFiles(self._getPickingExtraDir())
+
+    def getFilterSettings(self):
+        """ Filter applied by the picking run to its output. """
+        return readScoredPicksFilter(self._getPickingExtraDir())
+
+    def _getPickingExtraDir(self):
+        runDir = os.path.dirname(self.inputCoordinates.get().getFileName())
+        return os.path.join(runDir, 'extra')
+
+    def _isMainModelOutput(self):
+        """ Whether the input is the output of the main model of the
+        picking run, the only one with stored picks. """
+        extended = self.inputCoordinates.getExtended()
+        return not extended or extended == 'outputCoordinates'
+
+    # --------------------------- INFO functions ------------------------------
+    def _validate(self):
+        errors = []
+        if self.inputCoordinates.get() is None:
+            errors.append('Missing input coordinates.')
+        elif not self._isMainModelOutput():
+            errors.append('Picks are only stored for the main model of the '
+                          'picking run, select its outputCoordinates instead '
+                          'of %s.' % self.inputCoordinates.getExtended())
+        elif not self.getScoredPicksFiles():
+            errors.append('The input coordinates do not have stored picks. '
+                          'Run topaz picking with *Store picks for '
+                          're-thresholding* set to Yes.')
+        return errors
+
+    def _summary(self):
+        summary = []
+        if self.hasAttribute('outputCoordinates'):
+            summary.append('%d coordinates with score >= %s'
+                           % (self.outputCoordinates.getSize(),
+                              self.threshold.get()))
+        return summary
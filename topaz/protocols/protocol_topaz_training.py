@@ -25,7 +25,9 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
+import itertools
 import os
+import time
 import numpy as np
 
 import pyworkflow as pw
@@ -34,12 +36,16 @@ import pyworkflow.protocol.params as params
 import pyworkflow.protocol.constants as cons
 from pwem.protocols import ProtParticlePicking
 from pwem.objects import SetOfMicrographs, SetOfCoordinates
-from pwem.emlib.image import ImageHandler
 
 from topaz.protocols.protocol_base import ProtTopazBase
 from topaz import convert, Plugin
 from topaz.convert import (CsvMicrographList, CsvCoordinateList, micId2MicName)
 from topaz.objects import TopazModel
+from topaz.profiling import stage
+from topaz.worker import TRAIN_PROGRAM
+from topaz.evaluation import (sweepThresholds, getBestOperatingPoint,
+                              writeSweep, readSweep, readTargets,
+                              readTrainingLog)
 
 
 MODEL_FOLDER = 'model_folder'
@@ -52,6 +58,21 @@ TRAININGLIST = 'traininglist'
 TRAININGTEST = 'trainingtest'
 PARTICLES_TEST_TXT = 'particles_test.txt'
 PARTICLES_TRAIN_TXT = 'particles_train.txt'
+SWEEP_PICKS = 'sweep_picks'
+SWEEP_FILE = 'sweep_file'
+TRAINING_INPUT_DONE = 'training_input_done'
+
+# Output and models of topaz train, and of a training resumed after an epoch
+TRAINING_OUTPUT = 'model_training.txt'
+RESUMED_OUTPUT = 'model_training_resume%d.txt'
+RESUMED_PREFIX = 'model_resume%d'
+
+# Thresholds evaluated by the threshold sweep
+SWEEP_THRESHOLDS = np.arange(-8, 4.01, 0.25)
+
+# Seconds between checks while waiting for input coordinates
+WAIT_MIN = 1
+WAIT_MAX = 60
 
 
 class TopazProtTraining(ProtParticlePicking, ProtTopazBase):
@@ -119,6 +140,19 @@ class TopazProtTraining(ProtParticlePicking, ProtTopazBase):
     form.addParam('numEpochs', params.IntParam, default=10,
                   label='Number of epochs',
                   help='Number of training epochs.')
+    form.addParam('earlyStopping', params.BooleanParam, default=True,
+                  label='Stop early?',
+                  help='If *Yes*, the training is stopped once the '
+                       'precision-recall (AUPRC) on the test dataset has '
+                       'not improved for the given number of epochs. In any '
+                       'case, the output model is the epoch with the best '
+                       'AUPRC on the test dataset.')
+    form.addParam('patience', params.IntParam, default=3,
+                  condition='earlyStopping',
+                  expertLevel=cons.LEVEL_ADVANCED,
+                  label='Patience (epochs)',
+                  help='Epochs without improvement of the test AUPRC '
+                       'before stopping the training.')
     form.addParam('method', params.EnumParam, default=2,
                   expertLevel=cons.LEVEL_ADVANCED,
                   choices=['PN', 'GE-KL', 'GE-binomial', 'PU'],
@@ -139,12 +173,37 @@ class TopazProtTraining(ProtParticlePicking, ProtTopazBase):
                        'picks into five micrograph subsets where one '
                        'will be used as the test dataset; '
                        '20% will be held-out for validation')
+    form.addParam('foldsToTrain', params.IntParam, default=1,
+                  expertLevel=cons.LEVEL_ADVANCED,
+                  label='Folds to train',
+                  help='Number of models trained, each one using a different '
+                       'subset as test dataset (up to K for a full K-fold '
+                       'cross-validation). The trainings share the '
+                       'preprocessed micrographs and run in parallel, as '
+                       'many at a time as threads, on the selected GPUs. '
+                       'The model with the best precision-recall (AUPRC) '
+                       'on its test dataset is the output.')
     form.addParam('trainExtra', params.StringParam, default='',
                   expertLevel=cons.LEVEL_ADVANCED,
                   label="Advanced options",
                   help="Provide advanced command line options here.")
 
+    form.addParam('doSweep', params.BooleanParam, default=True,
+                  label='Estimate picking threshold?',
+                  help='If *Yes*, after training the model picks the test '
+                       'micrographs once and the precision, recall and F1 '
+                       'against their coordinates are computed for a grid '
+                       'of thresholds and extraction radii. The best '
+                       'operating point (F1) is stored with the model and '
+                       'can be used directly by the picking protocol.')
+    form.addParam('sweepRadii', params.NumericListParam, default='4 6 8 10 12 16',
+                  condition='doSweep', expertLevel=cons.LEVEL_ADVANCED,
+                  label='Extraction radii (px)',
+                  help='Extraction radii to evaluate, in pixels of the '
+                       'downsampled micrographs (as the picking radius).')
+
     form.addParallelSection(threads=1, mpi=1)
+    self._defineWorkerParams(form)
     self._definePreprocessParams(form)
     self._defineStreamingParams(form)
 
@@ -153,26 +212,42 @@ class TopazProtTraining(ProtParticlePicking, ProtTopazBase):
   # -------------------------- INSERT steps functions -----------------------
   def _insertAllSteps(self):
     self._defineFileDict()
-    ids = [self._insertFunctionStep('convertInputStep',
-                                    self.inputCoordinates.getObjId(),
-                                    self.scale.get(),
-                                    self.kfold.get())]
-    if self.doDenoise:
-      ids += [self._insertFunctionStep('denoiseStep')]
-
-    ids += [self._insertFunctionStep('preprocessStep')]
-
-    # Training selected
-    ids += [self._insertFunctionStep('trainingStep',
-                                     self.radius.get(),
-                                     self.autoenc.get(),
-                                     self.numEpochs.get(),
-                                     self.getNNModelFn(),
-                                     self.getEnumText('method'),
-                                     self.numPartPerImg.get(),
-                                     self.trainExtra.get())]
-
-    ids += [self._insertFunctionStep("createOutputStep")]
+    prepId = self._insertInputSteps()
+    ids = self._insertTrainingSteps(prepId)
+    self._insertFunctionStep("createOutputStep", prerequisites=ids)
+
+  def _insertInputSteps(self):
+    """ Insert the steps preparing the training data, returning the id
+    of the last one. """
+    self._insertFunctionStep('convertInputStep',
+                             self.inputCoordinates.getObjId(),
+                             self.scale.get(),
+                             self.kfold.get())
+    # When using the cache, denoising is done together with the preprocessing
+    if self.doDenoise and not self.useCache:
+      self._insertFunctionStep('denoiseStep')
+
+    return self._insertFunctionStep('preprocessStep')
+
+  def _insertTrainingSteps(self, prepId):
+    """ Insert the training steps after prepId, returning the ids of the
+    steps the output depends on. """
+    # Train the folds in parallel, all of them from the same preprocessing
+    ids = [self._insertFunctionStep('trainingStep',
+                                    self.radius.get(),
+                                    self.autoenc.get(),
+                                    self.numEpochs.get(),
+                                    self.getNNModelFn(),
+                                    self.getEnumText('method'),
+                                    self.numPartPerImg.get(),
+                                    self.trainExtra.get(),
+                                    fold, prerequisites=[prepId])
+           for fold in range(self.foldsToTrain.get())]
+
+    if self.doSweep:
+      ids = [self._insertFunctionStep('thresholdSweepStep',
+                                      prerequisites=ids)]
+    return ids
 
   def _defineFileDict(self):
     """ Centralize how files are called for iterations and references. """
@@ -186,11 +261,14 @@ class TopazProtTraining(ProtParticlePicking, ProtTopazBase):
       TRAININGDENOISE: traindenoiseFolder,
       TRAININGPREPROCESS: trainpreFolder,
       TRAININGPRE_MIC: os.path.join(trainpreFolder, '%(mic)s.mrc'),
-      TRAININGLIST: os.path.join(trainpreFolder, 'image_list_train.txt'),
-      TRAININGTEST: os.path.join(trainpreFolder, 'image_list_test.txt'),
-      PARTICLES_TRAIN_TXT: os.path.join(trainpreFolder, 'particles_train_test.txt'),
-      PARTICLES_TEST_TXT: os.path.join(trainpreFolder, 'particles_test_test.txt'),
-      MODEL_FOLDER: self._getExtraPath("model")
+      TRAININGLIST: os.path.join(trainpreFolder, 'image_list_train_fold%(fold)d.txt'),
+      TRAININGTEST: os.path.join(trainpreFolder, 'image_list_test_fold%(fold)d.txt'),
+      PARTICLES_TRAIN_TXT: os.path.join(trainpreFolder, 'particles_train_fold%(fold)d.txt'),
+      PARTICLES_TEST_TXT: os.path.join(trainpreFolder, 'particles_test_fold%(fold)d.txt'),
+      MODEL_FOLDER: self._getExtraPath("model", "fold%(fold)d"),
+      SWEEP_PICKS: os.path.join(trainpreFolder, 'sweep_picks.txt'),
+      SWEEP_FILE: self._getExtraPath('threshold_sweep.txt'),
+      TRAINING_INPUT_DONE: os.path.join(trainingFolder, 'input_done.txt')
     }
 
     self._updateFilenamesDict(myDict)
@@ -203,31 +281,19 @@ class TopazProtTraining(ProtParticlePicking, ProtTopazBase):
     the mrc files.
     """
 
-    micIds = []
-    coordSet = self.inputCoordinates.get()
-    setFn = coordSet.getFileName()
+    doneFn = self._getFileName(TRAINING_INPUT_DONE)
+    if os.path.exists(doneFn):
+      # Keep the input (and folds) of the previous run, the trained
+      # epochs depend on them
+      self.info("Training input already prepared (%s)." % doneFn)
+      return
+
+    setFn = self.inputCoordinates.get().getFileName()
     self.debug("Loading input db: %s" % setFn)
 
-    # Load set of coordinates with a user determined number of coordinates for the training step
-    enoughMicrographs = False
-    while True:
-      coordSet = SetOfCoordinates(filename=setFn)
-      coordSet._xmippMd = params.String()
-      coordSet.loadAllProperties()
-
-      for micAgg in coordSet.aggregate(["MAX"], "_micId", ["_micId"]):
-        micIds.append(micAgg["_micId"])
-        if len(micIds) == self.micsForTraining.get():
-          enoughMicrographs = True
-          break
-      if enoughMicrographs:
-        break
-      else:
-        if coordSet.isStreamClosed():
-          raise Exception("Input coordinates set is closed and there is not enough data to do the training!!.")
-        self.info("Not yet there: %s" % len(micIds))
-        import time
-        time.sleep(10)
+    # Wait for a user determined number of micrographs for the training step
+    coordSet, micIds = self._waitForMicrographs(setFn,
+                                                self.micsForTraining.get())
 
     # Create input folder and pre-processed micrographs folder
     micDir = self._getFileName(TRAINING)
@@ -235,38 +301,28 @@ class TopazProtTraining(ProtParticlePicking, ProtTopazBase):
     prepDir = self._getFileName(TRAININGPREPROCESS)
     pw.utils.makePath(prepDir)
 
-    ih = ImageHandler()
-
     # Get a refreshed set of micrographs
     micsFn = self.inputCoordinates.get().getMicrographs().getFileName()
     # not updating, refresh problem
     coordMics = SetOfMicrographs(filename=micsFn)
     coordMics.loadAllProperties()
 
-    # Create a 0/1 list to mark micrographs for training/testing
-    n = len(micIds)
-    indexes = np.zeros(n, dtype='int8')
-    testSetImages = int((kfold / float(100)) * n)
-
-    # Both the training and the test data set should contain at least one micrograph
-    if testSetImages < 1:
-      requiredMinimumPercentage = (1 * 100 / n) + 1
-      testSetImages = int((requiredMinimumPercentage / float(100)) * n)
-    elif testSetImages == n:
-      testSetImages = int(0.99 * n)
-    indexes[:testSetImages] = 1
-    np.random.shuffle(indexes)
-    self.info('indexes: %s' % indexes)
-
-    # Write micrographs files
-    csvMics = [
-      CsvMicrographList(self._getFileName(TRAININGLIST), 'w'),
-      CsvMicrographList(self._getFileName(TRAININGTEST), 'w')
-    ]
-
-    # Store the micId and indexes in micDict
+    # Assign the micrographs to kfold subsets of (almost) the same size,
+    # each trained fold uses one of them for testing and the rest for training
+    folds = np.arange(len(micIds)) % kfold
+    np.random.shuffle(folds)
+    self.info('folds: %s' % folds)
+    trainedFolds = range(self.foldsToTrain.get())
+
+    # Write micrographs files, (train, test) for each trained fold
+    csvMics = [(CsvMicrographList(self._getFileName(TRAININGLIST, fold=f), 'w'),
+                CsvMicrographList(self._getFileName(TRAININGTEST, fold=f), 'w'))
+               for f in trainedFolds]
+
+    # Store the micId and subset in micDict
     micDict = {}
-    for i, micId in zip(indexes, micIds):
+    convertList = []
+    for subset, micId in zip(folds.tolist(), micIds):
       mic = coordMics[micId]
       micFn = mic.getFileName()
       baseFn = micId2MicName(micId)
@@ -274,44 +330,120 @@ class TopazProtTraining(ProtParticlePicking, ProtTopazBase):
       if micFn.endswith('.mrc'):
         pwutils.createAbsLink(os.path.abspath(micFn), inputFn)
       else:
-        ih.convert(micFn, inputFn)
+        convertList.append((micFn, inputFn))
 
       prepMicFn = self._getFileName(TRAININGPRE_MIC, **{"mic": baseFn})
 
-      csvMics[i].addMic(micId, prepMicFn)
-      micDict[micId] = i  # store if train or test
+      for f, (csvTrain, csvTest) in zip(trainedFolds, csvMics):
+        (csvTest if subset == f else csvTrain).addMic(micId, prepMicFn)
+      micDict[micId] = subset
 
-    for csv in csvMics:
-      csv.close()
+    for csvTrain, csvTest in csvMics:
+      csvTrain.close()
+      csvTest.close()
 
-    # Write particles files
-    csvParts = [
-      CsvCoordinateList(self._getFileName(PARTICLES_TRAIN_TXT), 'w'),
-      CsvCoordinateList(self._getFileName(PARTICLES_TEST_TXT), 'w')
-    ]
+    with stage(self, 'convert', mics=len(micIds)):
+      convert.convertImages(convertList, self.numberOfThreads.get())
 
-    for coord in coordSet.iterItems(orderBy='_micId'):
+    # Only read the coordinates of the selected micrographs (the mapper
+    # does not translate attribute names inside IN clauses)
+    coords = [[] for _ in range(kfold)]
+    where = ' OR '.join('_micId=%d' % micId for micId in micDict)
+    for coord in coordSet.iterItems(orderBy='_micId', where=where):
       micId = coord.getMicId()
-      if micId in micDict:
-        x = int(round(float(coord.getX()) / scale))
-        y = int(round(float(coord.getY()) / scale))
-        csvParts[micDict[micId]].addCoord(micId, x, y)
+      coords[micDict[micId]].append((micId, coord.getX(), coord.getY()))
 
-    for csv in csvParts:
-      csv.close()
+    # Write particles files
+    for f in trainedFolds:
+      csvTrain = CsvCoordinateList(self._getFileName(PARTICLES_TRAIN_TXT, fold=f), 'w')
+      csvTrain.addCoords(itertools.chain.from_iterable(
+        subsetCoords for subset, subsetCoords in enumerate(coords)
+        if subset != f), scale)
+      csvTrain.close()
+      csvTest = CsvCoordinateList(self._getFileName(PARTICLES_TEST_TXT, fold=f), 'w')
+      csvTest.addCoords(coords[f], scale)
+      csvTest.close()
+
+    with open(doneFn, 'w') as f:
+      f.write('%d micrographs\n' % len(micIds))
+
+  def _waitForMicrographs(self, setFn, nMics):
+    """ Wait until the coordinates set has coordinates in nMics distinct
+    micrographs, returning the set and the micrograph ids. Only the rows
+    added since the last query are checked, the database is queried only
+    when its files change and the wait between checks grows while nothing
+    new arrives.
+    """
+    micIds = []
+    seen = set()
+    lastId = 0
+    lastStat = None
+    wait = WAIT_MIN
+
+    while True:
+      stat = self._getSetStat(setFn)
+      if stat != lastStat:
+        lastStat = stat
+        coordSet = SetOfCoordinates(filename=setFn)
+        coordSet._xmippMd = params.String()
+        coordSet.loadAllProperties()
+
+        # Coordinates are appended, so new rows have higher ids
+        maxId = lastId
+        for coord in coordSet.iterItems(orderBy='id', direction='DESC',
+                                        limit=1):
+          maxId = coord.getObjId()
+
+        if maxId > lastId:
+          where = 'id > %d AND id <= %d' % (lastId, maxId)
+          newIds = sorted(set(coordSet.getUniqueValues('_micId', where=where))
+                          - seen)
+          seen.update(newIds)
+          micIds.extend(newIds)
+          lastId = maxId
+          if newIds:
+            wait = WAIT_MIN
+
+        if len(micIds) >= nMics:
+          return coordSet, micIds[:nMics]
+
+        if coordSet.isStreamClosed():
+          raise Exception("Input coordinates set is closed and there is not enough data to do the training!!.")
+        coordSet.close()
+        self.info("Not yet there: %d micrographs of %d" % (len(micIds), nMics))
+
+      time.sleep(wait)
+      wait = min(wait * 2, WAIT_MAX)
+
+  def _getSetStat(self, setFn):
+    """ Modification time and size of the sqlite files of a set. """
+    stat = []
+    for fn in [setFn, setFn + '-wal']:
+      if os.path.exists(fn):
+        st = os.stat(fn)
+        stat.append((st.st_mtime_ns, st.st_size))
+    return stat
 
   def denoiseStep(self):
-    inputDir = self._getFileName(TRAINING)
     outputDir = self._getFileName(TRAININGDENOISE)
     pwutils.makePath(outputDir)
+    # Skip the micrographs denoised by a previous (interrupted) run
+    inputDir = self.getPendingInput(self._getFileName(TRAINING), outputDir)
+    if inputDir is None:
+      return
 
-    args = self.getDenoiseArgs(inputDir, outputDir)
-    Plugin.runTopaz(self, 'topaz denoise', args)
+    self.runDenoise(inputDir, outputDir)
 
   def preprocessStep(self):
     """ Downsamples the micrographs with a factor determined
     by the scale parameter and normalize them with the per-micrograph
     scaled Gaussian mixture model"""
+    if self.useCache:
+      self.preprocessMicrographs(self._getFileName(TRAINING),
+                                 self._getFileName(TRAININGDENOISE),
+                                 self._getFileName(TRAININGPREPROCESS),
+                                 sourceFns=self.getSourceMicrographFiles())
+      return
 
     if self.doDenoise:
       inputDir = self._getFileName(TRAININGDENOISE)
@@ -320,49 +452,268 @@ class TopazProtTraining(ProtParticlePicking, ProtTopazBase):
     pwutils.makePath(inputDir)
     outputDir = self._getFileName(TRAININGPREPROCESS)
     pwutils.makePath(outputDir)
+    inputDir = self.getPendingInput(inputDir, outputDir)
+    if inputDir is None:
+      return
 
-    args = self.getPreprocessArgs(inputDir, outputDir)
-    Plugin.runTopaz(self, 'topaz preprocess', args)
+    self.runPreprocess(inputDir, outputDir)
 
   def trainingStep(self, radius, enc, numEpochs, modelFit,
-                   method, numParts, extra):
+                   method, numParts, extra, fold=0, outputDir=None):
     """ Train the model with the provided parameters and the previously
-    preprocessed micrograph images and the provided input coordinates.
+    preprocessed micrograph images and the provided input coordinates,
+    testing on the given fold. If some epochs were saved by a previous
+    (interrupted) run, the training is resumed from the last of them.
+    The models are saved into outputDir (the folder of the fold by default).
     """
-    outputDir = self._getFileName(MODEL_FOLDER)
+    outputDir = outputDir or self.getModelsDir(fold)
     pw.utils.makePath(outputDir)
 
+    lastEpoch = self._collectCheckpoints(outputDir)
+    if lastEpoch >= numEpochs or self._isStoppedEarly(outputDir):
+      self.info("Training of fold %d already done (%d epochs)."
+                % (fold, lastEpoch))
+      return
+
+    prefix, outputFn = 'model', TRAINING_OUTPUT
+    if lastEpoch:
+      self.info("Resuming training of fold %d from epoch %d."
+                % (fold, lastEpoch))
+      modelFit = self.getEpochModels(outputDir)[lastEpoch]
+      numEpochs -= lastEpoch
+      prefix, outputFn = RESUMED_PREFIX % lastEpoch, RESUMED_OUTPUT % lastEpoch
+
     args = ' --radius %d' % radius
     args += ' --autoencoder %f' % enc
     args += ' --num-epochs %d' % numEpochs
     args += ' --model %s' % modelFit
     args += ' --method %s' % method
     args += ' --num-particles %d' % numParts
-    args += ' --train-images %s' % self._getFileName(TRAININGLIST)
-    args += ' --train-targets %s' % self._getFileName(PARTICLES_TRAIN_TXT)
-    args += ' --test-images %s' % self._getFileName(TRAININGTEST)
-    args += ' --test-targets %s' % self._getFileName(PARTICLES_TEST_TXT)
+    args += ' --train-images %s' % self._getFileName(TRAININGLIST, fold=fold)
+    args += ' --train-targets %s' % self._getFileName(PARTICLES_TRAIN_TXT, fold=fold)
+    args += ' --test-images %s' % self._getFileName(TRAININGTEST, fold=fold)
+    args += ' --test-targets %s' % self._getFileName(PARTICLES_TEST_TXT, fold=fold)
     args += ' --num-workers %d' % self.numberOfThreads
-    args += ' --device %s' % self.gpuList
-    args += ' --save-prefix %s/model' % outputDir
-    args += ' -o %s/model_training.txt' % outputDir
+    args += ' --device %(GPU)s'  # Add GPU that will be set by the executor
+    args += ' --save-prefix %s/%s' % (outputDir, prefix)
+    args += ' -o %s/%s' % (outputDir, outputFn)
 
     if extra != '':
       args += ' ' + extra
 
-    Plugin.runTopaz(self, 'topaz train', args)
+    if self.earlyStopping:
+      # Run by the worker script, following the test scores
+      trainArgs = ' --patience %d' % self.patience.get()
+      if lastEpoch:
+        trainArgs += ' --previous %s' % self.getTrainingLogFn(outputDir)
+      Plugin.runTopaz(self, TRAIN_PROGRAM, trainArgs + args,
+                      stageInfo={'fold': fold})
+    else:
+      Plugin.runTopaz(self, 'topaz train', args, stageInfo={'fold': fold})
+
+    self._collectCheckpoints(outputDir)
+
+  def thresholdSweepStep(self):
+    """ Evaluate the output model for a grid of thresholds and radii. """
+    fold, _ = self.getBestModel()
+    best = self.evaluateModel(self.getOutputModelPath(), fold,
+                              self._getFileName(SWEEP_PICKS),
+                              self._getFileName(SWEEP_FILE),
+                              self.radius.get())
+    self.info("Best operating point: radius %d, threshold %0.2f "
+              "(precision %0.3f, recall %0.3f, F1 %0.3f)" % tuple(best))
+
+  def evaluateModel(self, modelFn, fold, picksFn, sweepFn, matchRadius):
+    """ Pick the test micrographs of the fold once, with the smallest radius
+    and the lowest threshold, and evaluate the picks against the test
+    coordinates for the whole grid of thresholds and radii. The table is
+    written to sweepFn and its best operating point (F1) is returned. """
+    radii = sorted(self.getSweepRadii())
+    testList = CsvMicrographList(self._getFileName(TRAININGTEST, fold=fold))
+    testImages = [row[1] for row in testList]
+    testList.close()
+
+    args = ' -r %d' % radii[0]
+    args += ' -t %f' % SWEEP_THRESHOLDS[0]
+    args += ' -m %s' % modelFn
+    args += ' -o %s' % picksFn
+    args += ' --num-workers %d' % self.numberOfThreads
+    args += ' --device %(GPU)s'  # Add GPU that will be set by the executor
+    args += ' ' + ' '.join(testImages)
+    Plugin.runTopaz(self, 'topaz extract', args)
+
+    micIds, xs, ys, scores = convert.readCoordinates(picksFn, 1)
+    picks = {micId: (np.column_stack((xs[start:end], ys[start:end])),
+                     scores[start:end])
+             for micId, start, end in convert.iterMicrographRuns(micIds)}
+    targets = readTargets(self._getFileName(PARTICLES_TEST_TXT, fold=fold))
 
-    self.MODEL = self.getLastEpochModel(outputDir)
+    sweep = sweepThresholds(picks, targets, radii, SWEEP_THRESHOLDS,
+                            matchRadius=matchRadius)
+    writeSweep(sweepFn, sweep)
+    return getBestOperatingPoint(sweep)
 
   def createOutputStep(self):
     """ Register the output model. """
-    self._defineOutputs(outputModel=TopazModel(self.getOutputModelPath()))
+    self.stopTopazWorkers()
+    scores = self.getFoldScores()
+    if len(scores) > 1:
+      self.info("Test AUPRC of the folds: %s (mean %0.3f, std %0.3f), "
+                "using fold %d" % (', '.join('%0.3f' % s for s in scores),
+                                   np.mean(scores), np.std(scores),
+                                   self.getBestModel()[0]))
+    model = TopazModel(self.getOutputModelPath())
+    self.info("Output model: %s" % model.getPath())
+
+    sweepFn = self._getFileName(SWEEP_FILE)
+    if self.doSweep and os.path.exists(sweepFn):
+      best = getBestOperatingPoint(readSweep(sweepFn))
+      model.setThreshold(float(best['threshold']))
+      model.setRadius(int(best['radius']))
+
+    self._defineOutputs(outputModel=model)
+
+  # --------------------------- INFO functions -----------------------------
+  def _summary(self):
+    summary = []
+    if self.hasAttribute('outputModel'):
+      summary.append('Output model: %s' % self.outputModel)
+    else:
+      summary.append('Output model not ready yet.')
+    return summary + self.getStagesSummary()
+
+  def _methods(self):
+    return self.getStagesMethods()
+
+  def _validate(self):
+    errors = []
+    kfold = self.kfold.get()
+    if kfold < 2:
+      errors.append('K-fold should be at least 2.')
+    elif self.micsForTraining.get() < kfold:
+      errors.append('At least %d micrographs (K-fold) are needed for '
+                    'training.' % kfold)
+    if not 1 <= self.foldsToTrain.get() <= kfold:
+      errors.append('Folds to train should be between 1 and K-fold.')
+    return errors + self.validatePreprocess()
 
   # --------------------------- UTILS functions --------------------------
   def getPickingFileName(self, micList, key):
     return self._getFileName(key, **{"min": micList[0].strId(),
                                      'max': micList[-1].strId()})
 
+  def getSourceMicrographFiles(self):
+    """ Original file of each micrograph of the training folder, by the
+    name of its (linked or converted) copy. """
+    micDir = self._getFileName(TRAINING)
+    micIds = [int(os.path.splitext(fn)[0]) for fn in os.listdir(micDir)
+              if fn.endswith('.mrc')]
+    micsFn = self.inputCoordinates.get().getMicrographs().getFileName()
+    micIndex = convert.MicrographIndex(SetOfMicrographs(filename=micsFn),
+                                       maxSize=max(len(micIds), 1))
+    micIndex.load(micIds)
+    return {micId2MicName(micId) + '.mrc': micIndex.get(micId).getFileName()
+            for micId in micIds if micIndex.get(micId) is not None}
+
+  def getModelsDir(self, fold):
+    return self._getFileName(MODEL_FOLDER, fold=fold)
+
+  def getTrainingLogFn(self, modelsDir):
+    return os.path.join(modelsDir, TRAINING_OUTPUT)
+
+  def _collectCheckpoints(self, modelsDir):
+    """ Move the models and output of resumed trainings into those of the
+    first one, numbering their epochs after the epoch they resumed from,
+    and drop from the output the epochs whose model was not saved.
+    Returns the last saved epoch (0 if none). """
+    outputFn = os.path.join(modelsDir, TRAINING_OUTPUT)
+    lines = []
+    if os.path.exists(outputFn):
+      with open(outputFn) as f:
+        lines = f.readlines()
+    lastEpoch = max(self.getEpochModels(modelsDir), default=0)
+
+    resumedFn = os.path.join(modelsDir, RESUMED_OUTPUT % lastEpoch)
+    while lastEpoch and os.path.exists(resumedFn):
+      offset = lastEpoch
+      models = self.getEpochModels(modelsDir, prefix=RESUMED_PREFIX % offset)
+      for epoch, modelFn in models.items():
+        os.replace(modelFn, os.path.join(modelsDir, 'model_epoch%d.sav'
+                                         % (offset + epoch)))
+      lines = [line for line in lines if self._getLineEpoch(line) <= offset]
+      with open(resumedFn) as f:
+        for line in f:
+          epoch = self._getLineEpoch(line)
+          if epoch:
+            lines.append('\t'.join([str(offset + epoch)] +
+                                   line.split('\t')[1:]))
+      lastEpoch = offset + max(models, default=0)
+      self._writeLines(outputFn, lines, lastEpoch)
+      os.remove(resumedFn)
+      resumedFn = os.path.join(modelsDir, RESUMED_OUTPUT % lastEpoch)
+
+    self._writeLines(outputFn, lines, lastEpoch)
+    return lastEpoch
+
+  def _getLineEpoch(self, line):
+    """ Epoch of a row of the training output, 0 for the header. """
+    value = line.split('\t', 1)[0]
+    return int(value) if value.isdigit() else 0
+
+  def _writeLines(self, outputFn, lines, lastEpoch):
+    """ Write the training output up to the given epoch. """
+    if lines:
+      with open(outputFn, 'w') as f:
+        f.writelines(line for line in lines
+                     if self._getLineEpoch(line) <= lastEpoch)
+
+  def _isStoppedEarly(self, modelsDir):
+    """ Whether the test AUPRC had not improved for the patience epochs
+    at the end of the training output in modelsDir. """
+    log = readTrainingLog(self.getTrainingLogFn(modelsDir))
+    if not self.earlyStopping or not len(log):
+      return False
+    bestEpoch = log['epoch'][np.argmax(log['auprc'])]
+    return log['epoch'][-1] - bestEpoch >= self.patience.get()
+
+  def getBestEpoch(self, modelsDir):
+    """ Return (epoch, auprc) of the epoch of the training in modelsDir
+    with the best AUPRC on its test micrographs among the saved ones,
+    (None, nan) if unknown. """
+    log = readTrainingLog(self.getTrainingLogFn(modelsDir))
+    saved = self.getEpochModels(modelsDir) if os.path.exists(modelsDir) else {}
+    log = log[np.isin(log['epoch'], list(saved))]
+    if not len(log):
+      return None, np.nan
+    best = log[np.argmax(log['auprc'])]
+    return int(best['epoch']), float(best['auprc'])
+
+  def getFoldScores(self):
+    """ Best AUPRC on its test micrographs of each fold. """
+    return [self.getBestEpoch(self.getModelsDir(fold))[1]
+            for fold in range(self.foldsToTrain.get())]
+
+  def getBestModel(self):
+    """ Return (fold, modelsDir) of the best trained model. """
+    scores = self.getFoldScores()
+    fold = 0 if np.all(np.isnan(scores)) else int(np.nanargmax(scores))
+    return fold, self.getModelsDir(fold)
+
+  def getBestEpochModel(self, modelsDir):
+    """ Model of the best epoch of the training in modelsDir (the last
+    epoch if the test scores are not available). """
+    epoch, _ = self.getBestEpoch(modelsDir)
+    if epoch is None:
+      return self.getLastEpochModel(modelsDir)
+    return self.getEpochModels(modelsDir)[epoch]
+
+  def getOutputModelPath(self):
+    """ Model of the best epoch of the best training. """
+    return self.getBestEpochModel(self.getBestModel()[1])
+
+  def getSweepRadii(self):
+    return [int(r) for r in pwutils.getListFromRangeString(self.sweepRadii.get())]
+
   def getNNModelFn(self):
     '''Returns the model fn (or type) as expected from topaz software'''
     if self.modelInitialization.get() == self.ADD_MODEL_TRAIN_MODEL and self.prevTopazModel.get() != None:
@@ -0,0 +1,219 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se) [1]
+# *              Peter Horvath (phorvath@cnb.csic.es) [2]
+# *
+# * [1] SciLifeLab, Stockholm University
+# * [2] I2PC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import itertools
+import os
+import shutil
+
+import pyworkflow.utils as pwutils
+import pyworkflow.protocol.params as params
+
+from topaz.protocols.protocol_topaz_training import (TopazProtTraining,
+                                                     SWEEP_FILE)
+from topaz.evaluation import readSweep, getBestOperatingPoint
+
+
+SWEEP_MODELS_FILE = 'sweep_models_file'
+
+# Columns of the table with the results of every trained model
+SWEEP_MODELS_COLUMNS = ['combination', 'fold', 'radius', 'numParts',
+                        'modelFit', 'method', 'autoenc', 'epoch', 'auprc',
+                        'f1', 'precision', 'recall', 'threshold',
+                        'extractRadius']
+
+
+class TopazProtTrainingSweep(TopazProtTraining):
+  """ Train Topaz models for a grid of training parameters, preprocessing
+  the micrographs only once, and keep the best one on the test data """
+  _label = 'training sweep'
+
+  # Training parameters replaced by the lists of values of the sweep
+  SWEPT_PARAMS = ['radius', 'numPartPerImg', 'modelFit', 'method', 'autoenc',
+                  'doSweep']
+
+  # -------------------------- DEFINE param functions -----------------------
+  def _defineParams(self, form):
+    TopazProtTraining._defineParams(self, form)
+    for name in self.SWEPT_PARAMS:
+      form.getParam(name).condition.set('False')
+
+    form.addSection('Sweep')
+    form.addParam('radiusList', params.NumericListParam, default='3',
+                  label='Particle radius (px)',
+                  help='Values of the particle radius to train with.')
+    form.addParam('numPartsList', params.NumericListParam, default='300',
+                  label='Number of particles per image',
+                  help='Values of the expected number of particles per '
+                       'micrograph to train with.')
+    form.addParam('modelFitList', params.StringParam, default='resnet8',
+                  condition='modelInitialization==%d' % self.ADD_MODEL_TRAIN_NEW,
+                  label='CNN models',
+                  help='Model types to fit, separated by spaces (resnet8, '
+                       'resnet16, conv31, conv63, conv127).')
+    form.addParam('methodList', params.StringParam, default='GE-binomial',
+                  label='Methods',
+                  help='Objective functions to train with, separated by '
+                       'spaces (PN, GE-KL, GE-binomial, PU).')
+    form.addParam('autoencList', params.StringParam, default='0',
+                  label='Autoencoder weights',
+                  help='Values of the autoencoder weight, separated by spaces.')
+    form.addParam('evalRadius', params.IntParam, default=3,
+                  label='Matching radius (px)',
+                  help='Picks of the trained models closer than this to a '
+                       'test coordinate (in pixels of the downsampled '
+                       'micrographs) are counted as true positives. The '
+                       'models are ranked by the best F1 of their picks on '
+                       'the test micrographs, over the thresholds and the '
+                       'extraction radii given in the training section.')
+
+  # -------------------------- INSERT steps functions -----------------------
+  def _defineFileDict(self):
+    TopazProtTraining._defineFileDict(self)
+    self._updateFilenamesDict({
+      SWEEP_MODELS_FILE: self._getExtraPath('sweep_models.txt')
+    })
+
+  def _insertTrainingSteps(self, prepId):
+    """ Train and evaluate each combination of parameters (and fold) in
+    parallel, then rank all the models. """
+    ids = []
+    for i, combination in enumerate(self.getCombinations()):
+      radius, numParts, modelFit, method, enc = combination
+      for fold in range(self.foldsToTrain.get()):
+        trainId = self._insertFunctionStep('trainingStep', radius, enc,
+                                           self.numEpochs.get(), modelFit,
+                                           method, numParts,
+                                           self.trainExtra.get(), fold,
+                                           self.getSweepModelsDir(i, fold),
+                                           prerequisites=[prepId])
+        ids.append(self._insertFunctionStep('evaluateStep', i, fold,
+                                            prerequisites=[trainId]))
+
+    return [self._insertFunctionStep('rankModelsStep', prerequisites=ids)]
+
+  # --------------------------- STEPS functions ------------------------------
+  def evaluateStep(self, combination, fold):
+    """ Evaluate the best epoch of a trained model on its test data. """
+    modelsDir = self.getSweepModelsDir(combination, fold)
+    best = self.evaluateModel(self.getBestEpochModel(modelsDir), fold,
+                              os.path.join(modelsDir, 'test_picks.txt'),
+                              os.path.join(modelsDir, 'threshold_sweep.txt'),
+                              self.evalRadius.get())
+    self.info("Combination %d, fold %d: F1 %0.3f" % (combination, fold,
+                                                     best['f1']))
+
+  def rankModelsStep(self):
+    """ Write the table of all the trained models, sorted from the best to
+    the worst, and keep the threshold sweep of the best one. """
+    rows = []
+    for i, combination in enumerate(self.getCombinations()):
+      for fold in range(self.foldsToTrain.get()):
+        modelsDir = self.getSweepModelsDir(i, fold)
+        epoch, auprc = self.getBestEpoch(modelsDir)
+        best = getBestOperatingPoint(
+          readSweep(os.path.join(modelsDir, 'threshold_sweep.txt')))
+        rows.append([i, fold] + list(combination) +
+                    [epoch, auprc, best['f1'], best['precision'],
+                     best['recall'], best['threshold'], best['radius']])
+    rows.sort(key=lambda row: -row[SWEEP_MODELS_COLUMNS.index('f1')])
+
+    with open(self._getFileName(SWEEP_MODELS_FILE), 'w') as f:
+      f.write('\t'.join(SWEEP_MODELS_COLUMNS) + '\n')
+      for row in rows:
+        f.write('\t'.join(str(v) for v in row) + '\n')
+
+    combination, fold = rows[0][:2]
+    self.info("Best model: combination %d, fold %d (%s)"
+              % (combination, fold, self._formatRow(rows[0])))
+    shutil.copy(os.path.join(self.getSweepModelsDir(combination, fold),
+                             'threshold_sweep.txt'),
+                self._getFileName(SWEEP_FILE))
+
+  # --------------------------- INFO functions -----------------------------
+  def _summary(self):
+    summary = TopazProtTraining._summary(self)
+    rows = self.readSweepModels()
+    if rows:
+      summary.append('Best of %d trained models (%s):'
+                     % (len(rows), os.path.basename(
+                       self._getFileName(SWEEP_MODELS_FILE))))
+      summary.extend('  %s' % self._formatRow(row) for row in rows[:5])
+    return summary
+
+  def _validate(self):
+    errors = TopazProtTraining._validate(self)
+    methods = self.getParam('method').choices
+    if not all(m in methods for m in self.methodList.get().split()):
+      errors.append('Methods should be among: %s' % ', '.join(methods))
+    if self.modelInitialization.get() == self.ADD_MODEL_TRAIN_NEW:
+      models = self.getParam('modelFit').choices
+      if not all(m in models for m in self.modelFitList.get().split()):
+        errors.append('CNN models should be among: %s' % ', '.join(models))
+    if not self.getCombinations():
+      errors.append('At least one value is needed for each swept parameter.')
+    return errors
+
+  # --------------------------- UTILS functions --------------------------
+  def getCombinations(self):
+    """ List of (radius, numParts, modelFit, method, autoenc) to train. """
+    if self.modelInitialization.get() == self.ADD_MODEL_TRAIN_NEW:
+      models = self.modelFitList.get().split()
+    else:
+      models = [self.getNNModelFn()]
+    return list(itertools.product(
+      [int(v) for v in pwutils.getListFromRangeString(self.radiusList.get())],
+      [int(v) for v in pwutils.getListFromRangeString(self.numPartsList.get())],
+      models, self.methodList.get().split(),
+      [float(v) for v in self.autoencList.get().split()]))
+
+  def getSweepModelsDir(self, combination, fold):
+    return self._getExtraPath('model', 'combination%03d' % combination,
+                              'fold%d' % fold)
+
+  def readSweepModels(self):
+    """ Rows of the table of trained models, best first. """
+    fn = self._getFileName(SWEEP_MODELS_FILE)
+    if not os.path.exists(fn):
+      return []
+    with open(fn) as f:
+      return [line.rstrip('\n').split('\t') for line in f][1:]
+
+  def _formatRow(self, row):
+    return ', '.join('%s=%s' % (name, value) for name, value
+                     in zip(SWEEP_MODELS_COLUMNS[2:], row[2:]))
+
+  def getBestModel(self):
+    rows = self.readSweepModels()
+    combination, fold = (int(rows[0][0]), int(rows[0][1])) if rows else (0, 0)
+    return fold, self.getSweepModelsDir(combination, fold)
+
+  def getFoldScores(self):
+    """ Best AUPRC on its test micrographs of each fold of the best
+    combination. """
+    bestDir = os.path.dirname(self.getBestModel()[1])
+    return [self.getBestEpoch(os.path.join(bestDir, 'fold%d' % fold))[1]
+            for fold in range(self.foldsToTrain.get())]
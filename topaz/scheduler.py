@@ -0,0 +1,99 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+
+import threading
+from contextlib import contextmanager
+
+
+_schedulersLock = threading.Lock()
+
+
+class DeviceScheduler:
+    """ Assign jobs to devices (GPU ids) by their current load, running at
+    most maxJobs jobs at the same time on each device. Threads asking for
+    a device when all of them are full wait until one is released.
+    """
+    def __init__(self, devices, maxJobs=1):
+        if not devices:
+            raise Exception("DeviceScheduler needs at least one device")
+        # The same id may be repeated in the GPU list, keep the first one
+        self._devices = list(dict.fromkeys(str(d) for d in devices))
+        self._maxJobs = max(1, maxJobs)
+        self._running = {d: 0 for d in self._devices}
+        self._total = {d: 0 for d in self._devices}
+        self._condition = threading.Condition()
+
+    def _getFreeDevice(self):
+        """ Least loaded device with a free slot (ties are broken by the
+        number of jobs already run on each device) or None. """
+        free = [d for d in self._devices if self._running[d] < self._maxJobs]
+        if not free:
+            return None
+        return min(free, key=lambda d: (self._running[d], self._total[d]))
+
+    def acquire(self, timeout=None):
+        """ Reserve a slot in a device, waiting for one if needed.
+        Returns the device id (string). """
+        with self._condition:
+            if not self._condition.wait_for(
+                    lambda: self._getFreeDevice() is not None, timeout):
+                raise Exception("No device available after %s seconds"
+                                % timeout)
+            device = self._getFreeDevice()
+            self._running[device] += 1
+            self._total[device] += 1
+            return device
+
+    def release(self, device):
+        """ Free the slot reserved by acquire. """
+        with self._condition:
+            self._running[device] -= 1
+            self._condition.notify()
+
+    @contextmanager
+    def device(self):
+        """ Context manager reserving a device while the block runs. """
+        device = self.acquire()
+        try:
+            yield device
+        finally:
+            self.release(device)
+
+    def getLoad(self):
+        """ Return a dict with the number of running jobs per device. """
+        with self._condition:
+            return dict(self._running)
+
+
+def getProtocolScheduler(protocol, maxJobs):
+    """ Return the scheduler shared by all the steps of the protocol,
+    balancing the jobs among the GPUs selected for it.
+    """
+    with _schedulersLock:
+        scheduler = getattr(protocol, '_topazScheduler', None)
+        if scheduler is None:
+            scheduler = DeviceScheduler(protocol.getGpuList(), maxJobs)
+            protocol._topazScheduler = scheduler
+        return scheduler
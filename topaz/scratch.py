@@ -0,0 +1,139 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import threading
+import time
+from collections import deque
+
+import pyworkflow.utils as pwutils
+
+
+# Retention policies of the batch folders
+KEEP_ALL = 0
+KEEP_COORDINATES = 1
+KEEP_LAST = 2
+
+# Seconds between checks of the scratch usage while throttling
+THROTTLE_CHECK = 10
+
+
+def getFolderSize(path):
+    """ Bytes used by the files in a folder (links are not followed). """
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for fn in files:
+            try:
+                size += os.lstat(os.path.join(root, fn)).st_size
+            except OSError:  # removed while walking
+                pass
+    return size
+
+
+def cleanFolder(path, keepFiles=()):
+    """ Remove everything in a folder but the files in keepFiles (and the
+    folders containing them). Folders in keepFiles are kept with all
+    their content. """
+    keepFiles = {os.path.abspath(fn) for fn in keepFiles}
+    keepDirs = tuple(fn + os.sep for fn in keepFiles if os.path.isdir(fn))
+    for root, dirs, files in os.walk(path, topdown=False):
+        for fn in files:
+            fullFn = os.path.abspath(os.path.join(root, fn))
+            if fullFn not in keepFiles and not fullFn.startswith(keepDirs):
+                os.remove(fullFn)
+        for d in dirs:
+            fullDir = os.path.join(root, d)
+            if os.path.islink(fullDir):
+                os.remove(fullDir)
+            elif not os.listdir(fullDir):
+                os.rmdir(fullDir)
+
+
+class ScratchSpace:
+    """ Keep track of the batch folders of a picking run, to remove the
+    intermediate files of the finished batches according to a retention
+    policy and to delay new batches while the folders use more than a
+    quota of disk space.
+    Params:
+        retention: KEEP_ALL, KEEP_COORDINATES (only the files given when
+            finishing each batch are kept) or KEEP_LAST (the keepLast last
+            finished batches are kept complete).
+        quota: maximum bytes used by the batch folders (0 for no limit).
+    """
+    def __init__(self, retention=KEEP_ALL, keepLast=0, quota=0):
+        self.retention = retention
+        self.keepLast = keepLast
+        self.quota = quota
+        self._folders = set()  # Folders of the running batches
+        self._sizes = {}  # Bytes used by the folders of finished batches
+        self._finished = deque()
+        self._running = 0
+        self._condition = threading.Condition()
+
+    def getUsage(self):
+        """ Bytes used by the folders of the batches of this run. Only
+        those of the running batches are walked, the size of a finished one
+        is measured once when it finishes and again if it is cleaned. """
+        return (sum(getFolderSize(folder) for folder in list(self._folders)) +
+                sum(self._sizes.values()))
+
+    def startBatch(self, folder, log=None):
+        """ Register the folder of a new batch. If the quota is exceeded,
+        wait until the running batches free some space (there is nothing
+        to wait for if none is running). Returns the seconds waited. """
+        t0 = time.time()
+        with self._condition:
+            while self.quota and self._running:
+                usage = self.getUsage()
+                if usage <= self.quota:
+                    break
+                if log is not None:
+                    log("Scratch usage %s over the quota (%s), waiting for "
+                        "%d running batches." % (pwutils.prettySize(usage),
+                                                 pwutils.prettySize(self.quota),
+                                                 self._running))
+                self._condition.wait(THROTTLE_CHECK)
+            self._running += 1
+            self._folders.add(folder)
+            self._sizes.pop(folder, None)
+        return time.time() - t0
+
+    def finishBatch(self, folder, keepFiles=(), failed=False):
+        """ Clean the batch folder following the retention policy, keeping
+        the given files (e.g. the coordinates that are still to be read).
+        The files of failed batches are kept for debugging. """
+        with self._condition:
+            self._running -= 1
+            self._folders.discard(folder)
+            self._sizes[folder] = getFolderSize(folder)
+            if not failed and self.retention != KEEP_ALL:
+                self._finished.append((folder, keepFiles))
+                keepLast = self.keepLast if self.retention == KEEP_LAST else 0
+                while len(self._finished) > keepLast:
+                    oldFolder, oldKeepFiles = self._finished.popleft()
+                    cleanFolder(oldFolder, oldKeepFiles)
+                    self._sizes[oldFolder] = getFolderSize(oldFolder)
+            self._condition.notify_all()
@@ -0,0 +1,565 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Helper script executed inside the Topaz conda environment.
+
+When launched with the *serve* command it becomes a persistent worker:
+it reads one JSON job per line from stdin, runs the requested Topaz
+command in-process and answers with one JSON line on stdout. In this way
+the environment activation, the torch import and the loaded models are
+paid only once per protocol run instead of once per command.
+
+The *pick* command (also available as a worker job) runs denoise,
+preprocess and extract on each micrograph keeping it in memory, so only
+the coordinates file is written to disk. Several models can score the
+same preprocessed micrographs, each one writing its own coordinates file.
+
+The *train* command runs topaz train, stopping it once the precision-recall
+on the test images does not improve for a number of epochs.
+
+NOTE: This file should not import anything from Scipion or the plugin,
+since only the Topaz environment is available when it is executed.
+"""
+
+import argparse
+import glob
+import json
+import os
+import random
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+import traceback
+
+
+COMMANDS = ['denoise', 'preprocess', 'extract', 'pick']
+# Commands that the stub runner can also run
+STUB_COMMANDS = COMMANDS + ['train']
+
+
+def splitArgs(args):
+    """ Split a command line string as the shell would do, expanding
+    the wildcards used to pass the micrographs of a folder. """
+    argv = []
+    for arg in shlex.split(args):
+        matches = sorted(glob.glob(arg)) if glob.has_magic(arg) else []
+        argv.extend(matches or [arg])
+    return argv
+
+
+def addPickArguments(parser):
+    parser.add_argument('--images', required=True,
+                        help='tab separated file with image_name and path '
+                             'of the micrographs to pick')
+    parser.add_argument('-o', '--output', required=True,
+                        help='output coordinates file')
+    parser.add_argument('-m', '--model', required=True,
+                        help='picking model, path or pretrained name')
+    parser.add_argument('-r', '--radius', type=int, required=True)
+    parser.add_argument('-t', '--threshold', type=float, default=-6)
+    parser.add_argument('-s', '--scale', type=int, default=1,
+                        help='downsampling factor')
+    parser.add_argument('-d', '--device', type=int, default=0)
+    parser.add_argument('--denoise', action='store_true',
+                        help='denoise micrographs before preprocessing')
+    parser.add_argument('--denoise-args', default='',
+                        help='extra options as for "topaz denoise"')
+    parser.add_argument('--preprocess-args', default='',
+                        help='extra options as for "topaz preprocess"')
+    parser.add_argument('--per-micrograph', metavar='DIR',
+                        help='also write the coordinates of each micrograph '
+                             'to DIR/<image_name>.txt as soon as it is '
+                             'picked')
+    parser.add_argument('--columns', action='store_true',
+                        help='write each output as a coordinate store (a '
+                             'folder with binary columns) instead of a text '
+                             'file, image names must be micrograph ids')
+    parser.add_argument('--extra-model', nargs=4, action='append', default=[],
+                        metavar=('MODEL', 'OUTPUT', 'RADIUS', 'THRESHOLD'),
+                        help='also extract with this model from the same '
+                             'preprocessed micrographs, writing its '
+                             'coordinates to OUTPUT (can be repeated)')
+    return parser
+
+
+def readImageList(filename):
+    """ Read a topaz image list, returning (image_name, path) tuples. """
+    with open(filename) as f:
+        rows = [line.rstrip('\n').split('\t') for line in f]
+    return [tuple(row[:2]) for row in rows[1:] if row and row[0]]
+
+
+def writeMicrographCoordinates(outputDir, name, lines):
+    """ Write the coordinates of a single micrograph. The file is renamed
+    into place once complete, so readers never see a partial file. """
+    fn = os.path.join(outputDir, '%s.txt' % name)
+    tmpFn = fn + '.tmp'
+    with open(tmpFn, 'w') as f:
+        f.write('image_name\tx_coord\ty_coord\tscore\n')
+        f.writelines(lines)
+    os.replace(tmpFn, fn)
+
+
+def writeCoordinateColumns(outputDir, micIds, xs, ys, scores):
+    """ Write picks in the coordinate store format of the plugin (see
+    topaz.convert.writeCoordinateStore): one .npy file per column, sorted
+    by micrograph, and the (micId, start, end) index of the micrographs. """
+    import numpy as np
+
+    micIds = np.asarray(micIds, dtype=np.int32)
+    order = np.argsort(micIds, kind='stable')
+    columns = {'micId': micIds[order],
+               'x': np.asarray(xs, dtype=np.int32)[order],
+               'y': np.asarray(ys, dtype=np.int32)[order],
+               'score': np.asarray(scores, dtype=np.float32)[order]}
+    ids, starts = np.unique(columns['micId'], return_index=True)
+    ends = np.append(starts[1:], len(order)) if len(order) else starts
+    index = np.column_stack((ids, starts, ends)).astype(np.int64)
+
+    tmpDir = outputDir + '.tmp'
+    shutil.rmtree(tmpDir, ignore_errors=True)
+    os.makedirs(tmpDir)
+    for name, values in columns.items():
+        np.save(os.path.join(tmpDir, name + '.npy'), values)
+    np.save(os.path.join(tmpDir, 'index.npy'), index.reshape(-1, 3))
+    shutil.rmtree(outputDir, ignore_errors=True)
+    os.rename(tmpDir, outputDir)
+
+
+def pickMicrographs(args):
+    """ Denoise (optional), downsample, normalize and extract particles
+    from each micrograph in memory, writing only the coordinates. """
+    import numpy as np
+    import torch
+    import topaz.denoise
+    import topaz.extract
+    import topaz.commands.denoise
+    import topaz.commands.preprocess
+    from topaz.algorithms import non_maximum_suppression
+    from topaz.cuda import set_device
+    from topaz.stats import normalize
+    from topaz.utils.data.loader import load_image
+    from topaz.utils.image import downsample
+
+    use_cuda = set_device(args.device)
+
+    # Parse the extra options with the parsers of the staged commands,
+    # so both modes accept the same advanced options
+    prepParser = argparse.ArgumentParser()
+    topaz.commands.preprocess.add_arguments(prepParser)
+    prep = prepParser.parse_args(['image'] + splitArgs(args.preprocess_args))
+    method = 'affine' if prep.affine else 'gmm'
+
+    if args.denoise:
+        dnParser = argparse.ArgumentParser()
+        topaz.commands.denoise.add_arguments(dnParser)
+        dnArgs = dnParser.parse_args(splitArgs(args.denoise_args))
+        denoisers = [topaz.denoise.Denoise(m, use_cuda) for m in dnArgs.model]
+        gaus = (topaz.denoise.GaussianDenoise(dnArgs.gaussian, use_cuda=use_cuda)
+                if dnArgs.gaussian > 0 else None)
+        invGaus = (topaz.denoise.InvGaussianFilter(dnArgs.inv_gaussian,
+                                                   use_cuda=use_cuda)
+                   if dnArgs.inv_gaussian > 0 else None)
+
+    # (model, output, radius, threshold) of the main and the extra models
+    pickers = [(args.model, args.output, args.radius, args.threshold)]
+    pickers += [(m, o, int(r), float(t)) for m, o, r, t in args.extra_model]
+    models, outputs = [], []
+    for modelName, output, _, _ in pickers:
+        model = topaz.extract.load_model(modelName)
+        model.eval()
+        model.fill()
+        if use_cuda:
+            model.cuda()
+        models.append(model)
+        if args.columns:
+            # Picks of each micrograph: (micIds, coords, scores)
+            outputs.append([])
+        else:
+            outputs.append(open(output, 'w'))
+            outputs[-1].write('image_name\tx_coord\ty_coord\tscore\n')
+
+    if args.per_micrograph:
+        os.makedirs(args.per_micrograph, exist_ok=True)
+
+    try:
+        for name, path in readImageList(args.images):
+            image = load_image(path, make_image=False, return_header=False)
+            x = image.astype(np.float32)
+
+            if args.denoise:
+                x = topaz.denoise.denoise_image(
+                    x, denoisers, lowpass=dnArgs.lowpass,
+                    cutoff=dnArgs.pixel_cutoff, gaus=gaus, inv_gaus=invGaus,
+                    deconvolve=dnArgs.deconvolve,
+                    deconv_patch=dnArgs.deconv_patch,
+                    patch_size=dnArgs.patch_size,
+                    padding=dnArgs.patch_padding,
+                    normalize=dnArgs.normalize,
+                    use_cuda=use_cuda).astype(np.float32)
+
+            if args.scale > 1:
+                x = downsample(x, args.scale)
+            x, _ = normalize(x, alpha=prep.alpha, beta=prep.beta,
+                             num_iters=prep.niters, method=method,
+                             sample=prep.sample, use_cuda=use_cuda)
+
+            x = torch.from_numpy(x.copy()).float().unsqueeze(0).unsqueeze(0)
+            if use_cuda:
+                x = x.cuda()
+
+            for model, f, (_, _, radius, threshold) in zip(models, outputs,
+                                                           pickers):
+                with torch.no_grad():
+                    scores = model(x).data[0, 0].cpu().numpy()
+
+                score, coords = non_maximum_suppression(scores, radius,
+                                                        threshold=threshold)
+                if args.columns:
+                    f.append((np.full(len(score), int(name)), coords, score))
+                    continue
+                lines = ['%s\t%d\t%d\t%s\n' % (name, coords[i, 0],
+                                                coords[i, 1], score[i])
+                         for i in range(len(score))]
+                f.writelines(lines)
+                f.flush()
+                if args.per_micrograph and f is outputs[0]:
+                    writeMicrographCoordinates(args.per_micrograph, name, lines)
+
+        if args.columns:
+            for picks, (_, output, _, _) in zip(outputs, pickers):
+                micIds, coords, scores = [np.concatenate(c) for c in
+                                          zip(*picks)] if picks else [[]] * 3
+                coords = np.asarray(coords).reshape(-1, 2)
+                writeCoordinateColumns(output, micIds, coords[:, 0],
+                                       coords[:, 1], scores)
+    finally:
+        for f in outputs:
+            if not args.columns:
+                f.close()
+
+
+def getOption(argv, options, default=None):
+    """ Value of the first of the given options found in argv. """
+    for option in options:
+        if option in argv:
+            return argv[argv.index(option) + 1]
+    return default
+
+
+def readTestScores(filename):
+    """ Read the (epoch, auprc) of the test rows written by topaz train. """
+    scores = []
+    if os.path.exists(filename):
+        with open(filename) as f:
+            for line in f:
+                values = line.split()
+                if len(values) > 2 and values[2] == 'test':
+                    scores.append((int(values[0]), float(values[-1])))
+    return scores
+
+
+def trainEarlyStopping(args, trainArgs):
+    """ Run topaz train in a child process, reading the test scores from
+    its output file while it runs, and stop it once the best test AUPRC
+    is patience epochs old. The models of the epochs up to the last one
+    evaluated are already saved when it is stopped. """
+    outputFn = getOption(trainArgs, ['-o', '--output'])
+    if outputFn is None:
+        raise Exception("An output file (-o) is needed to follow the training")
+
+    # Scores of the epochs trained before resuming, the epochs of this
+    # run are numbered after them
+    previous = readTestScores(args.previous) if args.previous else []
+    offset = previous[-1][0] if previous else 0
+
+    process = subprocess.Popen(shlex.split(args.topaz) + ['train'] + trainArgs)
+    stopped = False
+    while process.poll() is None:
+        time.sleep(args.poll)
+        scores = previous + [(offset + epoch, score)
+                             for epoch, score in readTestScores(outputFn)]
+        if len(scores) == len(previous):
+            continue
+        bestEpoch, bestScore = max(scores, key=lambda s: s[1])
+        lastEpoch = scores[-1][0]
+        if lastEpoch - bestEpoch >= args.patience:
+            print("Test AUPRC has not improved for %d epochs, stopping "
+                  "training at epoch %d (best %f at epoch %d)"
+                  % (args.patience, lastEpoch, bestScore, bestEpoch))
+            sys.stdout.flush()
+            process.terminate()
+            process.wait()
+            stopped = True
+
+    if not stopped and process.returncode:
+        sys.exit(process.returncode)
+
+
+class TopazRunner:
+    """ Run Topaz commands in the current process, keeping the models
+    loaded in memory between jobs. """
+    def __init__(self):
+        import topaz.commands.denoise
+        import topaz.commands.preprocess
+        import topaz.commands.extract
+
+        self._modules = {
+            'denoise': topaz.commands.denoise,
+            'preprocess': topaz.commands.preprocess,
+            'extract': topaz.commands.extract
+        }
+        self._models = {}
+        self._cacheModels()
+
+    def _cacheModels(self):
+        """ Replace the model loading functions used by Topaz commands
+        by a cached version of them. The commands may have imported them
+        by name, so every module of topaz holding one of them is patched,
+        not only the modules defining them. """
+        import topaz.extract
+        import topaz.denoise
+
+        cached = {}
+        for module in [topaz.extract, topaz.denoise]:
+            loadFunc = module.load_model
+            cached[loadFunc] = self._cachedLoader(loadFunc)
+
+        for name, module in list(sys.modules.items()):
+            if name != 'topaz' and not name.startswith('topaz.'):
+                continue
+            loadFunc = getattr(module, 'load_model', None)
+            if loadFunc in cached:
+                module.load_model = cached[loadFunc]
+
+    def _cachedLoader(self, loadFunc):
+        def _load(path, *args, **kwargs):
+            key = (loadFunc.__module__, str(path), args,
+                   tuple(sorted(kwargs.items())))
+            model = self._models.get(key)
+            if model is None:
+                model = self._models[key] = loadFunc(path, *args, **kwargs)
+            elif hasattr(model, 'unfill'):
+                # Extraction fills the classifier before scoring,
+                # restore it as it was freshly loaded
+                model.unfill()
+            return model
+        return _load
+
+    def run(self, command, argv):
+        if command == 'pick':
+            parser = addPickArguments(argparse.ArgumentParser(prog='pick'))
+            pickMicrographs(parser.parse_args(argv))
+            return
+
+        module = self._modules[command]
+        parser = argparse.ArgumentParser(prog='topaz %s' % command)
+        module.add_arguments(parser)
+        module.main(parser.parse_args(argv))
+
+
+class StubRunner:
+    """ Runner that does not require Topaz, used for testing.
+    Denoise and preprocess just copy the input micrographs to the output
+    folder and extract writes random picks for each input micrograph. """
+    def __init__(self, picksPerImage=0):
+        self.jobs = []
+        self.picksPerImage = picksPerImage
+
+    def _randomPicks(self, name, seed=''):
+        rng = random.Random(name + seed)
+        return ['%s\t%d\t%d\t%0.3f\n' % (name, rng.randint(0, 1024),
+                                         rng.randint(0, 1024),
+                                         rng.gauss(-3, 2))
+                for _ in range(self.picksPerImage)]
+
+    def _train(self, argv):
+        """ Write a training output whose test AUPRC stops improving
+        after the third epoch and save a (fake) model per epoch. """
+        numEpochs = int(getOption(argv, ['--num-epochs'], 10))
+        prefix = getOption(argv, ['--save-prefix'])
+        with open(getOption(argv, ['-o', '--output']), 'w') as f:
+            f.write('epoch\titer\tsplit\tloss\tprecision\ttpr\tfpr\tauprc\n')
+            for epoch in range(1, numEpochs + 1):
+                time.sleep(0.1)
+                auprc = 0.2 * min(epoch, 3) - 0.01 * max(epoch - 3, 0)
+                f.write('%d\t%d\ttest\t0.5\t0.5\t0.5\t0.1\t%f\n'
+                        % (epoch, epoch * 10, auprc))
+                f.flush()
+                if prefix:
+                    with open('%s_epoch%d.sav' % (prefix, epoch), 'w') as m:
+                        m.write('model')
+
+    def _writePicks(self, output, picks, columns=False):
+        """ Write the lists of pick lines as a coordinates file, or as a
+        coordinate store if columns is set. """
+        lines = [line for micPicks in picks for line in micPicks]
+        if columns:
+            rows = [line.split('\t') for line in lines]
+            writeCoordinateColumns(output, *[[float(row[i]) for row in rows]
+                                             for i in range(4)])
+            return
+        with open(output, 'w') as f:
+            f.write('image_name\tx_coord\ty_coord\tscore\n')
+            f.writelines(lines)
+
+    def run(self, command, argv):
+        if command not in STUB_COMMANDS:
+            raise Exception("Unknown command: %s" % command)
+        self.jobs.append((command, argv))
+        output = getOption(argv, ['-o', '--output', '--destdir'])
+
+        if command == 'train':
+            self._train(argv)
+
+        elif command in ['extract', 'pick']:
+            if command == 'pick':
+                names = [name for name, _ in
+                         readImageList(argv[argv.index('--images') + 1])]
+            else:
+                values = {argv[i + 1] for i, a in enumerate(argv[:-1])
+                          if a.startswith('-')}
+                names = [os.path.splitext(os.path.basename(fn))[0]
+                         for fn in argv
+                         if fn not in values and os.path.isfile(fn)]
+            picks = {name: self._randomPicks(name) for name in names}
+            self._writePicks(output, [picks[name] for name in names],
+                             '--columns' in argv)
+            if '--per-micrograph' in argv:
+                outputDir = argv[argv.index('--per-micrograph') + 1]
+                os.makedirs(outputDir, exist_ok=True)
+                for name in names:
+                    writeMicrographCoordinates(outputDir, name, picks[name])
+            # Other picks for each extra model of the pick command
+            for i, arg in enumerate(argv):
+                if arg == '--extra-model':
+                    model, extraOutput = argv[i + 1:i + 3]
+                    self._writePicks(extraOutput,
+                                     [self._randomPicks(name, model)
+                                      for name in names], '--columns' in argv)
+        else:
+            os.makedirs(output, exist_ok=True)
+            for fn in argv:
+                if os.path.isfile(fn):
+                    shutil.copy(fn, os.path.join(output, os.path.basename(fn)))
+
+
+def serve(runner, inStream, outStream):
+    """ Read jobs from inStream until a 'stop' job or the end of the
+    input, writing the result of each one to outStream. """
+    for line in inStream:
+        line = line.strip()
+        if not line:
+            continue
+
+        job = json.loads(line)
+        response = {'id': job.get('id'), 'status': 'ok'}
+
+        if job['command'] == 'stop':
+            outStream.write(json.dumps(response) + '\n')
+            outStream.flush()
+            break
+
+        cwd = os.getcwd()
+        try:
+            if job.get('cwd'):
+                os.chdir(job['cwd'])
+            runner.run(job['command'], splitArgs(job.get('args', '')))
+        except BaseException:
+            response['status'] = 'error'
+            response['error'] = traceback.format_exc()
+        finally:
+            os.chdir(cwd)
+
+        outStream.write(json.dumps(response) + '\n')
+        outStream.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run Topaz jobs for the Scipion plugin.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    serveParser = subparsers.add_parser(
+        'serve', help='read jobs from stdin and run them until stopped')
+    serveParser.add_argument('--stub', action='store_true',
+                             help='do not use Topaz, only for testing')
+    serveParser.add_argument('--stub-picks', type=int, default=0,
+                             help='random picks written per micrograph by '
+                                  'the stub extract')
+
+    stubParser = subparsers.add_parser(
+        'stub', help='run a single job without Topaz, standing for the '
+                     'topaz executable in tests and benchmarks')
+    stubParser.add_argument('--picks', type=int, default=0,
+                            help='random picks written per micrograph')
+    stubParser.add_argument('job', choices=STUB_COMMANDS)
+    stubParser.add_argument('args', nargs=argparse.REMAINDER)
+
+    addPickArguments(subparsers.add_parser(
+        'pick', help='denoise, preprocess and extract in a single pass'))
+
+    trainParser = subparsers.add_parser(
+        'train', help='run topaz train with early stopping, any other '
+                      'option is passed to topaz train')
+    trainParser.add_argument('--patience', type=int, default=3,
+                             help='epochs without improvement of the test '
+                                  'AUPRC before stopping')
+    trainParser.add_argument('--poll', type=float, default=5,
+                             help='seconds between reads of the output')
+    trainParser.add_argument('--topaz', default='topaz',
+                             help='topaz executable')
+    trainParser.add_argument('--previous', metavar='FILE',
+                             help='output of the training that is resumed, '
+                                  'its test scores are also taken into account')
+
+    args, extraArgs = parser.parse_known_args()
+    if extraArgs and args.command != 'train':
+        parser.error('unrecognized arguments: %s' % ' '.join(extraArgs))
+
+    if args.command == 'pick':
+        pickMicrographs(args)
+
+    elif args.command == 'train':
+        trainEarlyStopping(args, extraArgs)
+
+    elif args.command == 'stub':
+        StubRunner(args.picks).run(args.job, splitArgs(' '.join(args.args)))
+
+    elif args.command == 'serve':
+        # Keep stdout only for the responses, anything else printed
+        # by Topaz (or its C libraries) goes to stderr
+        outStream = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+        runner = StubRunner(args.stub_picks) if args.stub else TopazRunner()
+        serve(runner, sys.stdin, outStream)
+
+
+if __name__ == '__main__':
+    main()
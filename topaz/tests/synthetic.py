@@ -0,0 +1,87 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Synthetic micrographs and coordinates used by the tests and benchmarks.
+"""
+
+import os
+
+import numpy as np
+import mrcfile
+
+from pwem.objects import (SetOfMicrographs, SetOfCoordinates, Micrograph,
+                          Coordinate)
+
+
+def createMicrographs(filename, n, micDir=None, size=0):
+    """ Create a set with n micrographs. If micDir is given, write them
+    as MRC files of size x size with random values. """
+    micSet = SetOfMicrographs(filename=filename)
+    micSet.setSamplingRate(1.0)
+    mic = Micrograph()
+    rng = np.random.default_rng(0)
+    for micId in range(1, n + 1):
+        micFn = 'mic%06d.mrc' % micId
+        if micDir is not None:
+            micFn = os.path.join(micDir, micFn)
+            with mrcfile.new(micFn, overwrite=True) as mrc:
+                mrc.set_data(rng.normal(size=(size, size)).astype(np.float32))
+        mic.setObjId(micId)
+        mic.setFileName(micFn)
+        micSet.append(mic)
+    micSet.write()
+    return micSet
+
+
+def createCoordinates(filename, micSet, coordsPerMic):
+    """ Create a set with coordsPerMic random coordinates per micrograph. """
+    coordSet = SetOfCoordinates(filename=filename)
+    coordSet.setMicrographs(micSet)
+    coordSet.setBoxSize(64)
+    rng = np.random.default_rng(0)
+    coord = Coordinate()
+    for mic in micSet:
+        coord.setMicrograph(mic)
+        for x, y in rng.integers(0, 4096, (coordsPerMic, 2)).tolist():
+            coord.setObjId(None)
+            coord.setPosition(x, y)
+            coordSet.append(coord)
+    coordSet.setStreamState(coordSet.STREAM_CLOSED)
+    coordSet.write()
+    return coordSet
+
+
+def writeCoordinates(filename, micIds, coordsPerMic, seed=0):
+    """ Write a coordinates file as produced by topaz extract. """
+    rng = np.random.default_rng(seed)
+    n = len(micIds) * coordsPerMic
+    names = np.repeat(micIds, coordsPerMic)
+    xy = rng.integers(0, 1024, size=(n, 2))
+    scores = rng.normal(-3, 2, size=n)
+    with open(filename, 'w') as f:
+        f.write('image_name\tx_coord\ty_coord\tscore\n')
+        for micId, (x, y), score in zip(names, xy, scores):
+            f.write('%06d\t%d\t%d\t%f\n' % (micId, x, y, score))
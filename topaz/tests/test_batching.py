@@ -0,0 +1,69 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+from pyworkflow.tests import BaseTest
+
+from topaz.batching import BatchSizeController
+
+
+def cost(n, overhead=20., perMic=0.5):
+    return overhead + n * perMic
+
+
+class TestBatchSizeController(BaseTest):
+    """ Check the batch sizes chosen for a simulated picking cost. """
+    def _run(self, controller, batches=10):
+        for _ in range(batches):
+            n = controller.getBatchSize()
+            controller.addBatch(n, cost(n))
+        return controller.getBatchSize()
+
+    def testThroughput(self):
+        controller = BatchSizeController(4, 1000, initialSize=32)
+        # overhead below 10%: 20 * 0.9 / (0.1 * 0.5) = 360
+        self.assertEqual(self._run(controller), 360)
+
+        controller = BatchSizeController(4, 100, initialSize=32)
+        self.assertEqual(self._run(controller), 100)
+
+    def testLatency(self):
+        controller = BatchSizeController(1, 1000, initialSize=8,
+                                         targetLatency=60)
+        # One micrograph every 2 seconds
+        for i in range(10):
+            controller.addArrivals([i], when=2 * i)
+        # (n - 1) * 2 + 20 + 0.5 * n <= 60 -> n <= 16.8
+        self.assertEqual(self._run(controller), 16)
+
+        # Already seen micrographs are not counted again
+        controller.addArrivals(range(10), when=100)
+        self.assertAlmostEqual(controller.getArrivalRate(), 0.5)
+
+    def testBounds(self):
+        controller = BatchSizeController(8, 16, initialSize=64,
+                                         targetLatency=1)
+        self.assertEqual(controller.getBatchSize(), 16)
+        self.assertEqual(self._run(controller), 8)
@@ -0,0 +1,311 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Benchmarks of the plugin Python code on synthetic data, not requiring
+Topaz (a stub stands for the topaz executable) nor any dataset.
+
+The scale of the data is selected with TOPAZ_BENCHMARK_SCALE (small, by
+default, or large) and the timings are appended as JSON lines to the file
+given by TOPAZ_BENCHMARK_RESULTS (by default topaz_benchmark.jsonl in the
+tests output folder), so they can be compared between revisions.
+"""
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import pyworkflow as pw
+from pyworkflow.tests import BaseTest, setupTestOutput
+from pwem.objects import SetOfCoordinates
+
+from topaz.convert import (readSetOfCoordinates, MicrographIndex,
+                           convertImages, convertMicrographs, filterPicks,
+                           CsvMicrographList, CsvCoordinateList)
+from topaz.protocols import TopazProtTraining
+from topaz.tests.synthetic import (createMicrographs, createCoordinates,
+                                   writeCoordinates)
+from topaz.worker import TopazWorker, WORKER_SCRIPT
+
+
+SCALES = {
+    'small': {'mics': 200, 'session': 5000, 'coordsPerMic': 100,
+              'micSize': 512, 'batches': 5},
+    'large': {'mics': 2000, 'session': 50000, 'coordsPerMic': 500,
+              'micSize': 4096, 'batches': 20}
+}
+SCALE = os.environ.get('TOPAZ_BENCHMARK_SCALE', 'small')
+
+# Command standing for the topaz executable
+STUB_TOPAZ = [sys.executable, WORKER_SCRIPT, 'stub']
+
+
+def getResultsFile():
+    return os.environ.get('TOPAZ_BENCHMARK_RESULTS',
+                          os.path.join(pw.Config.SCIPION_TESTS_OUTPUT,
+                                       'topaz_benchmark.jsonl'))
+
+
+class BenchmarkTest(BaseTest):
+    """ Base class of the benchmarks, recording the timings. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.scale = SCALES[SCALE]
+
+    def record(self, name, seconds, **info):
+        """ Append the timing of a benchmark to the results file. """
+        result = {'benchmark': '%s.%s' % (self.__class__.__name__, name),
+                  'scale': SCALE,
+                  'seconds': round(seconds, 4),
+                  'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                  'python': platform.python_version(),
+                  'host': platform.node()}
+        result.update(info)
+        resultsFn = getResultsFile()
+        os.makedirs(os.path.dirname(os.path.abspath(resultsFn)), exist_ok=True)
+        with open(resultsFn, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+        print("%s: %0.3fs %s" % (result['benchmark'], seconds, info))
+
+    def timeit(self, func, *args, **kwargs):
+        t0 = time.time()
+        func(*args, **kwargs)
+        return time.time() - t0
+
+
+class TestCsvBenchmark(BenchmarkTest):
+    """ Write the image and coordinate lists read by topaz. """
+    def testWriteLists(self):
+        nMics = self.scale['mics']
+        nCoords = nMics * self.scale['coordsPerMic']
+        rng = np.random.default_rng(0)
+        micIds = np.repeat(np.arange(1, nMics + 1), self.scale['coordsPerMic'])
+        coords = list(zip(micIds.tolist(),
+                          *rng.integers(0, 4096, (2, nCoords)).tolist()))
+
+        def _writeMics():
+            csvMics = CsvMicrographList(self.getOutputPath('mics.txt'), 'w')
+            for micId in range(1, nMics + 1):
+                csvMics.addMic(micId, '/data/mic%06d.mrc' % micId)
+            csvMics.close()
+
+        def _writeCoords():
+            csvCoords = CsvCoordinateList(self.getOutputPath('coords.txt'), 'w')
+            csvCoords.addCoords(coords, scale=4)
+            csvCoords.close()
+
+        self.record('micrographs', self.timeit(_writeMics), items=nMics)
+        self.record('coordinates', self.timeit(_writeCoords), items=nCoords)
+        with open(self.getOutputPath('coords.txt')) as f:
+            self.assertEqual(sum(1 for _ in f), nCoords + 1)
+
+
+class TestReadCoordinatesBenchmark(BenchmarkTest):
+    """ Reading the coordinates of a streaming batch should cost the same
+    at the beginning and at the end of a long session. """
+    BATCH = 32
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.session = cls.scale['session']
+        cls.micSet = createMicrographs(cls.getOutputPath('mics.sqlite'),
+                                       cls.session)
+
+    def _readBatch(self, micIndex, firstId, name):
+        coordsFn = self.getOutputPath('%s.txt' % name)
+        micIds = list(range(firstId, firstId + self.BATCH))
+        writeCoordinates(coordsFn, micIds, self.scale['coordsPerMic'])
+        coordSet = SetOfCoordinates(
+            filename=self.getOutputPath('%s.sqlite' % name))
+        coordSet.setMicrographs(self.micSet)
+
+        loaded = micIndex.loaded
+        elapsed = self.timeit(readSetOfCoordinates, coordsFn, micIndex,
+                              coordSet, scale=4)
+        self.assertEqual(coordSet.getSize(),
+                         self.BATCH * self.scale['coordsPerMic'])
+        coordSet.close()
+        return micIndex.loaded - loaded, elapsed
+
+    def testBatchCostIsFlat(self):
+        micIndex = MicrographIndex(self.micSet)
+        results = []
+        for firstId in [1, self.session // 2, self.session - self.BATCH]:
+            loaded, elapsed = self._readBatch(micIndex, firstId,
+                                              'batch%d' % firstId)
+            results.append(elapsed)
+            # Only the micrographs of the batch are read from the set
+            self.assertEqual(loaded, self.BATCH)
+            self.record('batch', elapsed, firstMic=firstId,
+                        session=self.session,
+                        coords=self.BATCH * self.scale['coordsPerMic'])
+
+        self.assertLess(results[-1], 5 * results[0] + 0.5)
+
+
+def convertSynthetic(inputFn, outputFn):
+    """ Stand-in for a format conversion: read, filter and write back. """
+    image = np.load(inputFn)
+    image = np.fft.irfft2(np.fft.rfft2(image)).astype(np.float32)
+    with open(outputFn, 'wb') as f:
+        f.write(image.tobytes())
+
+
+class TestConvertImagesBenchmark(BenchmarkTest):
+    """ Convert synthetic micrographs serially and with a pool. """
+    N = 16
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        size = cls.scale['micSize']
+        rng = np.random.default_rng(0)
+        cls.inputs = []
+        for i in range(cls.N):
+            fn = cls.getOutputPath('mic%02d.npy' % i)
+            np.save(fn, rng.normal(size=(size, size)).astype(np.float32))
+            cls.inputs.append(fn)
+
+    def _convert(self, numberOfThreads):
+        outDir = self.getOutputPath('threads%d' % numberOfThreads)
+        os.makedirs(outDir)
+        fileList = [(fn, os.path.join(outDir, '%d.mrc' % i))
+                    for i, fn in enumerate(self.inputs)]
+        elapsed = self.timeit(convertImages, fileList, numberOfThreads,
+                              convertSynthetic)
+        self.assertEqual(len(os.listdir(outDir)), self.N)
+        return elapsed
+
+    def testPool(self):
+        for n in [1, 4]:
+            self.record('pool', self._convert(n), threads=n, images=self.N,
+                        size=self.scale['micSize'])
+
+    def testLinkMicrographs(self):
+        micDir = self.getOutputPath('mrc')
+        os.makedirs(micDir)
+        micSet = createMicrographs(self.getOutputPath('mics.sqlite'),
+                                   self.N, micDir, self.scale['micSize'])
+        outDir = self.getOutputPath('links')
+        os.makedirs(outDir)
+        elapsed = self.timeit(convertMicrographs,
+                             [mic.clone() for mic in micSet], outDir)
+        self.assertEqual(len(os.listdir(outDir)), self.N)
+        self.record('link', elapsed, images=self.N)
+
+    def testErrors(self):
+        fileList = [(fn, self.getOutputPath('%d.mrc' % i))
+                    for i, fn in enumerate(self.inputs[:3])]
+        fileList.append(('missing.npy', self.getOutputPath('missing.mrc')))
+        with self.assertRaises(Exception) as cm:
+            convertImages(fileList, 2, convertSynthetic)
+        self.assertIn('missing.npy', str(cm.exception))
+        # The valid files are converted anyway
+        self.assertTrue(os.path.exists(self.getOutputPath('2.mrc')))
+
+
+class TestTrainingInputBenchmark(BenchmarkTest):
+    """ Prepare the training input from a large set of coordinates. """
+    def testConvertInputStep(self):
+        nMics = self.scale['mics']
+        micSet = createMicrographs(self.getOutputPath('mics.sqlite'), nMics)
+        coordSet = createCoordinates(self.getOutputPath('coords.sqlite'),
+                                     micSet, self.scale['coordsPerMic'])
+
+        prot = TopazProtTraining()
+        prot.workingDir.set(self.getOutputPath('run'))
+        prot.inputCoordinates.set(coordSet)
+        prot.micsForTraining.set(10)
+        prot._defineFileDict()
+
+        elapsed = self.timeit(prot.convertInputStep, None, 4,
+                              prot.kfold.get())
+        self.record('convertInputStep', elapsed, mics=nMics,
+                    coords=nMics * self.scale['coordsPerMic'])
+
+        nCoords = 0
+        for fn in ['particles_train_fold0.txt', 'particles_test_fold0.txt']:
+            with open(os.path.join(prot._getTmpPath('training', 'preprocess'),
+                                   fn)) as f:
+                nCoords += sum(1 for _ in f) - 1
+        self.assertEqual(nCoords, 10 * self.scale['coordsPerMic'])
+
+
+class TestStubTopazBenchmark(BenchmarkTest):
+    """ Run preprocess and extract for several batches with a new (stub)
+    topaz process per command and with a persistent (stub) worker. """
+    def _batches(self, run):
+        micDir = self.getOutputPath('mics')
+        os.makedirs(micDir, exist_ok=True)
+        for micId in range(1, 33):
+            with open(os.path.join(micDir, '%d.mrc' % micId), 'w') as f:
+                f.write('mic')
+
+        for batch in range(self.scale['batches']):
+            preDir = self.getOutputPath('pre%d' % batch)
+            run('preprocess', '%s/*.mrc -o %s/ --scale 4' % (micDir, preDir))
+            run('extract', '-r 8 -o %s %s/*.mrc'
+                % (self.getOutputPath('coords%d.txt' % batch), preDir))
+
+    def testWorker(self):
+        def _runProcess(job, args):
+            subprocess.check_call(STUB_TOPAZ + ['--picks', '100', job] +
+                                  args.split())
+
+        worker = TopazWorker([sys.executable, WORKER_SCRIPT, 'serve', '--stub',
+                              '--stub-picks', '100'])
+        self.record('process', self.timeit(self._batches, _runProcess),
+                    batches=self.scale['batches'])
+        self.record('worker', self.timeit(self._batches, worker.run),
+                    batches=self.scale['batches'])
+        worker.stop()
+
+        with open(self.getOutputPath('coords0.txt')) as f:
+            self.assertEqual(sum(1 for _ in f), 32 * 100 + 1)
+
+
+class TestFilterPicksBenchmark(BenchmarkTest):
+    """ Duplicate suppression should stay near-linear with the number
+    of picks in a batch. """
+    def _filter(self, n, nMics=200):
+        rng = np.random.default_rng(0)
+        micIds = np.sort(rng.integers(1, nMics + 1, n))
+        xs, ys = rng.integers(0, 4096, (2, n))
+        scores = rng.normal(size=n)
+        elapsed = self.timeit(filterPicks, micIds, xs, ys, scores,
+                              minDistance=20, maxPerMic=500)
+        self.record('filter', elapsed, picks=n)
+        return elapsed
+
+    def testScaling(self):
+        small, large = self._filter(250000), self._filter(1000000)
+        self.assertLess(large, 8 * small + 0.5)
@@ -0,0 +1,74 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from topaz.cache import PreprocessCache
+
+
+class TestPreprocessCache(BaseTest):
+    """ Test the keys and the LRU eviction of the preprocessing cache. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def _writeFile(self, fn, size):
+        with open(fn, 'wb') as f:
+            f.write(b'0' * size)
+        return fn
+
+    def testCache(self):
+        cache = PreprocessCache(self.getOutputPath('cache'), maxSize=250)
+        params = {'scale': 4}
+        mics = [self._writeFile(self.getOutputPath('mic%d.mrc' % i), 100)
+                for i in range(3)]
+        keys = [cache.getKey(fn, params) for fn in mics]
+
+        self.assertNotEqual(keys[0], cache.getKey(mics[0], {'scale': 2}))
+        # Links are resolved to the original micrograph
+        linkFn = self.getOutputPath('link.mrc')
+        os.symlink(mics[0], linkFn)
+        self.assertEqual(keys[0], cache.getKey(linkFn, params))
+
+        outFn = self.getOutputPath('out.mrc')
+        self.assertFalse(cache.fetch(keys[0], outFn))
+
+        for i in range(2):
+            cache.store(keys[i], mics[i])
+            # Make sure the modification times are different
+            os.utime(cache.getFile(keys[i]), (i, i))
+
+        self.assertTrue(cache.fetch(keys[0], outFn))
+        self.assertEqual(os.path.getsize(outFn), 100)
+
+        # mic0 was used last, so mic1 should be evicted
+        cache.store(keys[2], mics[2])
+        cache.evict()
+        self.assertTrue(os.path.exists(cache.getFile(keys[0])))
+        self.assertFalse(os.path.exists(cache.getFile(keys[1])))
+        self.assertTrue(os.path.exists(cache.getFile(keys[2])))
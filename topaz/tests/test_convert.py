@@ -0,0 +1,199 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import numpy as np
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+from pwem.objects import SetOfCoordinates
+
+from topaz.convert import (readCoordinates, writeScoredPicks,
+                           readScoredPicks, appendCoordinates,
+                           writeScoredPicksFilter, readScoredPicksFilter,
+                           MicrographIndex, filterPicks, CoordinateStore,
+                           emptyCoordinates, writeCoordinateStore,
+                           convertCoordinatesToStore,
+                           convertStoreToCoordinates)
+from topaz.tests.synthetic import createMicrographs, writeCoordinates
+
+
+class TestScoredPicks(BaseTest):
+    """ Store the picks of several batches and derive coordinates at
+    other thresholds. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.micSet = createMicrographs(cls.getOutputPath('mics.sqlite'), 10)
+
+    def testRethreshold(self):
+        picksFns = []
+        allScores = []
+        for batch, micIds in enumerate([[1, 2, 3], [4, 5], [6, 7, 8, 9, 10]]):
+            coordsFn = self.getOutputPath('coords%d.txt' % batch)
+            writeCoordinates(coordsFn, micIds, coordsPerMic=40, seed=batch)
+            picks = readCoordinates(coordsFn, scale=4)
+            self.assertEqual(picks[0].dtype, np.int32)
+            self.assertTrue(np.all(picks[1] % 4 == 0))
+            picksFn = self.getOutputPath('picks%d.npz' % batch)
+            writeScoredPicks(picksFn, *picks)
+            picksFns.append(picksFn)
+            allScores.append(picks[3])
+        allScores = np.concatenate(allScores)
+
+        micIds, xs, ys, scores = readScoredPicks(picksFns)
+        self.assertEqual(len(scores), 400)
+        self.assertTrue(np.all(np.diff(micIds) >= 0))
+
+        for threshold in [-6, -3, 0]:
+            micIds, xs, ys, scores = readScoredPicks(picksFns, threshold)
+            self.assertEqual(len(scores), np.sum(allScores >= threshold))
+            self.assertTrue(np.all(scores >= threshold))
+
+        coordSet = SetOfCoordinates(filename=self.getOutputPath('coords.sqlite'))
+        coordSet.setMicrographs(self.micSet)
+        appendCoordinates(coordSet, MicrographIndex(self.micSet),
+                          micIds, xs, ys, scores)
+        self.assertEqual(coordSet.getSize(), len(scores))
+        coord = coordSet.getFirstItem()
+        self.assertGreaterEqual(coord._topazScore.get(), 0)
+
+    def testEmpty(self):
+        micIds, xs, ys, scores = readScoredPicks([])
+        self.assertEqual(len(micIds), 0)
+
+    def testNothingAboveThreshold(self):
+        # A batch without picks and a threshold that keeps none of them
+        picksFns = [self.getOutputPath('empty.npz'),
+                    self.getOutputPath('picks.npz')]
+        writeScoredPicks(picksFns[0], *emptyCoordinates())
+        coordsFn = self.getOutputPath('coords.txt')
+        writeCoordinates(coordsFn, [1, 2], coordsPerMic=10)
+        writeScoredPicks(picksFns[1], *readCoordinates(coordsFn, scale=4))
+
+        for fns in [picksFns[:1], picksFns]:
+            picks = readScoredPicks(fns, minScore=100)
+            self.assertEqual(len(picks[0]), 0)
+            coordSet = SetOfCoordinates(
+                filename=self.getOutputPath('nothing%d.sqlite' % len(fns)))
+            coordSet.setMicrographs(self.micSet)
+            appendCoordinates(coordSet, MicrographIndex(self.micSet), *picks)
+            self.assertEqual(coordSet.getSize(), 0)
+
+    def testFilterSettings(self):
+        extraDir = self.getOutputPath('extra')
+        # Runs that did not store them did not filter their picks
+        self.assertEqual(readScoredPicksFilter(extraDir),
+                         {'minDistance': 0, 'maxPerMic': 0})
+        writeScoredPicksFilter(extraDir, minDistance=20, maxPerMic=100)
+        self.assertEqual(readScoredPicksFilter(extraDir),
+                         {'minDistance': 20, 'maxPerMic': 100})
+
+
+class TestCoordinateStore(BaseTest):
+    """ Binary columns with the coordinates of a batch. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def testConversions(self):
+        coordsFn = self.getOutputPath('coords.txt')
+        writeCoordinates(coordsFn, [3, 1, 2], coordsPerMic=50)
+        storePath = self.getOutputPath('coords.cols')
+        convertCoordinatesToStore(coordsFn, storePath)
+
+        store = CoordinateStore(storePath)
+        self.assertEqual(len(store), 150)
+        self.assertEqual(store.getMicIds().tolist(), [1, 2, 3])
+        picks = readCoordinates(coordsFn, scale=1)
+        xs, ys, scores = store.readMicrograph(2)
+        mask = picks[0] == 2
+        np.testing.assert_array_equal(xs, picks[1][mask])
+        np.testing.assert_allclose(scores, picks[3][mask], rtol=1e-6)
+        self.assertEqual(len(store.readMicrograph(4)[0]), 0)
+
+        # Same picks from the store (sorted by micrograph) or the text file
+        order = np.argsort(picks[0], kind='stable')
+        for values, stored in zip(picks, readCoordinates(storePath, scale=1)):
+            np.testing.assert_allclose(values[order], stored, rtol=1e-6)
+
+        textFn = self.getOutputPath('converted.txt')
+        convertStoreToCoordinates(storePath, textFn)
+        for values, converted in zip(readCoordinates(storePath, 4),
+                                     readCoordinates(textFn, 4)):
+            np.testing.assert_allclose(values, converted, rtol=1e-6)
+
+        # Scored picks are stored in the same format
+        picksPath = self.getOutputPath('picks.cols')
+        writeScoredPicks(picksPath, *picks)
+        micIds, xs, ys, scores = readScoredPicks([picksPath], minScore=-3)
+        self.assertEqual(len(scores), np.sum(picks[3] >= -3))
+
+
+    def testEmptyStore(self):
+        # A batch without picks
+        storePath = self.getOutputPath('empty.cols')
+        writeCoordinateStore(storePath, *emptyCoordinates())
+        store = CoordinateStore(storePath)
+        self.assertEqual(len(store), 0)
+        self.assertEqual(len(store.readMicrograph(1)[0]), 0)
+        self.assertEqual(len(readCoordinates(storePath, scale=4)[0]), 0)
+
+        picks = filterPicks(*readScoredPicks([storePath], minScore=-3),
+                            minDistance=5, maxPerMic=10)
+        micSet = createMicrographs(self.getOutputPath('mics.sqlite'), 2)
+        coordSet = SetOfCoordinates(filename=self.getOutputPath('empty.sqlite'))
+        coordSet.setMicrographs(micSet)
+        appendCoordinates(coordSet, MicrographIndex(micSet), *picks)
+        self.assertEqual(coordSet.getSize(), 0)
+
+
+class TestFilterPicks(BaseTest):
+    """ Suppression of near-duplicates and top-K per micrograph. """
+    def setUp(self):
+        self.micIds = np.array([1, 1, 1, 1, 2, 2, 2])
+        self.xs = np.array([0, 3, 50, 100, 0, 4, 8])
+        self.ys = np.zeros(7, dtype=int)
+        self.scores = np.array([1., 2., 0.5, -1., 0.1, 0.3, 0.2])
+
+    def testMinDistance(self):
+        micIds, xs, _, scores = filterPicks(self.micIds, self.xs, self.ys,
+                                            self.scores, minDistance=5)
+        self.assertEqual(micIds.tolist(), [1, 1, 1, 2])
+        self.assertEqual(xs.tolist(), [3, 50, 100, 4])
+
+    def testMaxPerMic(self):
+        micIds, xs, _, scores = filterPicks(self.micIds, self.xs, self.ys,
+                                            self.scores, maxPerMic=2)
+        self.assertEqual(micIds.tolist(), [1, 1, 2, 2])
+        self.assertEqual(scores.tolist(), [1., 2., 0.3, 0.2])
+
+        # Both filters together, the cap applies after the suppression
+        micIds, xs, _, _ = filterPicks(self.micIds, self.xs, self.ys,
+                                       self.scores, minDistance=5, maxPerMic=1)
+        self.assertEqual(xs.tolist(), [3, 4])
+
+    def testEmpty(self):
+        picks = filterPicks(*emptyCoordinates(), minDistance=5, maxPerMic=1)
+        self.assertEqual([len(values) for values in picks], [0, 0, 0, 0])
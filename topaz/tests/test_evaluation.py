@@ -0,0 +1,111 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import numpy as np
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from topaz.evaluation import (suppressNonMaxima, matchPicks, precisionRecall,
+                              sweepThresholds, getBestOperatingPoint,
+                              readTrainingLog)
+
+
+class TestThresholdSweep(BaseTest):
+    """ Evaluate synthetic picks against known particle positions. """
+    def testSuppressNonMaxima(self):
+        rng = np.random.default_rng(0)
+        xy = rng.uniform(0, 200, (300, 2))
+        scores = rng.normal(size=300)
+        keep = suppressNonMaxima(xy, scores, 10)
+
+        # Same result as the straightforward greedy algorithm
+        kept = []
+        for i in np.argsort(-scores):
+            if all(np.hypot(*(xy[i] - xy[j])) > 10 for j in kept):
+                kept.append(i)
+        self.assertEqual(sorted(kept), np.flatnonzero(keep).tolist())
+
+    def testMatchPicks(self):
+        # Two picks around the first target, the second one is a duplicate
+        picksXy = np.array([[0., 0.], [1., 0.], [10., 10.], [50., 50.]])
+        scores = np.array([1., 2., 0.5, 3.])
+        targetsXy = np.array([[0.5, 0.], [10., 11.], [100., 100.]])
+        matched, targetScores = matchPicks(picksXy, scores, targetsXy, 2)
+        self.assertEqual(matched.tolist(), [False, True, True, False])
+        np.testing.assert_array_equal(targetScores, [2., 0.5, -np.inf])
+
+    def testPrecisionRecall(self):
+        scores = np.array([3., 2., 1., 0.])
+        matched = np.array([True, False, True, False])
+        targetScores = np.array([3., 1., -np.inf])
+        precision, recall, f1 = precisionRecall(scores, matched, targetScores,
+                                                [2.5, 0.5, -1])
+        np.testing.assert_allclose(precision, [1, 2 / 3., 0.5])
+        np.testing.assert_allclose(recall, [1 / 3., 2 / 3., 2 / 3.])
+
+    def testSweep(self):
+        rng = np.random.default_rng(1)
+        picks, targets = {}, {}
+        for micId in range(3):
+            true = rng.uniform(0, 500, (40, 2))
+            targets[micId] = true
+            # Good picks, lower-scored duplicates and false positives
+            xy = np.vstack([true + rng.normal(0, 1, true.shape),
+                            true[:20] + rng.normal(0, 3, (20, 2)),
+                            rng.uniform(0, 500, (60, 2))])
+            scores = np.concatenate([rng.normal(2, 1, 40),
+                                     rng.normal(-1, 1, 20),
+                                     rng.normal(-3, 1.5, 60)])
+            picks[micId] = (xy, scores)
+
+        sweep = sweepThresholds(picks, targets, [2, 10],
+                                np.arange(-6, 4, 0.5), matchRadius=3)
+        self.assertEqual(len(sweep), 40)
+        best = getBestOperatingPoint(sweep)
+        # The duplicates are only removed with the larger radius
+        self.assertEqual(best['radius'], 10)
+        self.assertGreater(best['f1'], 0.9)
+
+
+class TestTrainingLog(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def testReadTrainingLog(self):
+        logFn = self.getOutputPath('model_training.txt')
+        with open(logFn, 'w') as f:
+            f.write('epoch\titer\tsplit\tloss\tge_penalty\tprecision\t'
+                    'adjusted_precision\ttpr\tfpr\tauprc\n')
+            for epoch, auprc in [(1, 0.4), (2, 0.6)]:
+                f.write('%d\t%d\ttrain\t0.3\t0.0\t0.5\t0.6\t0.5\t0.1\t-\n'
+                        % (epoch, epoch * 100))
+                f.write('%d\t%d\ttest\t0.3\t-\t0.5\t0.6\t0.5\t0.1\t%s\n'
+                        % (epoch, epoch * 100, auprc))
+        log = readTrainingLog(logFn)
+        self.assertEqual(log['epoch'].tolist(), [1, 2])
+        self.assertEqual(log['auprc'].tolist(), [0.4, 0.6])
+        self.assertEqual(len(readTrainingLog(self.getOutputPath('none.txt'))), 0)
@@ -0,0 +1,78 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import numpy as np
+import mrcfile
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from topaz.memory import (MIN_PATCH_SIZE, getMaxMicrographShape,
+                          getPatchPadding, getPatchMemory,
+                          getDenoisePatchSize, getHostFreeMemory,
+                          isOutOfMemoryError)
+
+
+class TestDenoisePatchSize(BaseTest):
+    """ Choose the denoising patch size from the available memory. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def testMicrographShape(self):
+        fns = []
+        for i, shape in enumerate([(100, 120), (140, 90)]):
+            fns.append(self.getOutputPath('mic%d.mrc' % i))
+            with mrcfile.new(fns[-1]) as mrc:
+                mrc.set_data(np.zeros(shape, dtype=np.float32))
+        self.assertEqual(getMaxMicrographShape(fns), (140, 120))
+        self.assertGreater(getHostFreeMemory(), 0)
+
+    def testPatchSize(self):
+        shape, bpp = (4096, 4096), 1024
+        self.assertEqual(getPatchPadding('--normalize -p 64'), 64)
+        # The whole micrograph fits
+        self.assertEqual(getDenoisePatchSize(shape, 4096 ** 2 * bpp, bpp), -1)
+
+        free = 8 * 1024 ** 3
+        patchSize = getDenoisePatchSize(shape, free, bpp, padding=500)
+        self.assertEqual(patchSize % 128, 0)
+        self.assertLessEqual(getPatchMemory(shape, patchSize, 500, bpp), free)
+        self.assertGreater(getPatchMemory(shape, patchSize + 128, 500, bpp),
+                           free)
+
+        # Smaller after running out of memory, never below the minimum
+        smaller = getDenoisePatchSize(shape, free, bpp, padding=500,
+                                      maxPatchSize=patchSize // 2)
+        self.assertLessEqual(smaller, patchSize // 2)
+        self.assertEqual(getDenoisePatchSize(shape, 1024, bpp), MIN_PATCH_SIZE)
+
+    def testOutOfMemoryError(self):
+        self.assertTrue(isOutOfMemoryError(
+            'RuntimeError: CUDA out of memory. Tried to allocate 2.00 GiB'))
+        self.assertTrue(isOutOfMemoryError('Traceback...\nMemoryError\n'))
+        self.assertFalse(isOutOfMemoryError(
+            "FileNotFoundError: [Errno 2] No such file or directory: 'x.mrc'"))
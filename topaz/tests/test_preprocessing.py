@@ -0,0 +1,150 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import subprocess
+
+import numpy as np
+import mrcfile
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from topaz import Plugin
+from topaz.constants import TOPAZ_ENV_ACTIVATION
+from topaz.preprocessing import (downsample, normalize, parseOptions,
+                                 preprocessMicrographs)
+
+
+# Output of "topaz preprocess --scale 4 --sample 1 --niters 100" (topaz
+# 0.3.20) for the micrographs of writeMicrographs(micDir, 2, (256, 240))
+TOPAZ_REFERENCE = os.path.join(os.path.dirname(__file__), 'data',
+                               'preprocess_topaz.npz')
+
+
+def writeMicrographs(micDir, n, shape=(512, 480), seed=0):
+    """ Write noisy micrographs with a dark (carbon-like) band and a few
+    bright blobs, returning their filenames. """
+    rng = np.random.default_rng(seed)
+    os.makedirs(micDir)
+    micFns = []
+    for i in range(n):
+        data = rng.normal(0, 1, shape).astype(np.float32)
+        data[:, :shape[1] // 10] -= 6
+        data[100:140, 200:240] += 2
+        micFns.append(os.path.join(micDir, 'mic%d.mrc' % i))
+        with mrcfile.new(micFns[-1]) as mrc:
+            mrc.set_data(data)
+            mrc.voxel_size = 1.5
+    return micFns
+
+
+class TestNativePreprocessing(BaseTest):
+    """ Downsample and normalize micrographs in-process, as topaz
+    preprocess does. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def testDownsample(self):
+        rng = np.random.default_rng(1)
+        stack = rng.normal(size=(3, 96, 80)).astype(np.float32)
+        small = downsample(stack, 4)
+        self.assertEqual(small.shape, (3, 24, 20))
+        self.assertEqual(small.dtype, np.float32)
+        # The batch gives the same result as each micrograph on its own
+        for x, y in zip(stack, small):
+            np.testing.assert_allclose(downsample(x, 4), y, atol=1e-6)
+        # The mean is kept and the low frequencies too
+        yy, xx = np.mgrid[:96, :80]
+        wave = np.cos(2 * np.pi * xx / 40.)
+        np.testing.assert_allclose(downsample(wave + 5, 4),
+                                   wave[::4, ::4] + 5, atol=1e-6)
+
+    def testNormalize(self):
+        micFn = writeMicrographs(self.getOutputPath('normalize'), 1)[0]
+        with mrcfile.open(micFn) as mrc:
+            data = mrc.data.copy()
+        x = normalize(data, sample=1)
+        # The main component (not the dark band) is standardized
+        background = x[:, 60:]
+        self.assertAlmostEqual(float(np.median(background)), 0, delta=0.05)
+        self.assertAlmostEqual(float(background.std()), 1, delta=0.1)
+
+        x = normalize(data, affine=True)
+        self.assertAlmostEqual(float(x.mean()), 0, delta=1e-4)
+
+    def testOptions(self):
+        options = parseOptions(' --sample 1 -a 100 --num-workers 4')
+        self.assertEqual(options['sample'], 1)
+        self.assertEqual(options['alpha'], 100)
+        with self.assertRaises(Exception):
+            parseOptions('--format png')
+
+    def testReference(self):
+        """ Same output as topaz preprocess, stored for small micrographs. """
+        micFns = writeMicrographs(self.getOutputPath('reference'), 2,
+                                  shape=(256, 240))
+        nativeDir = self.getOutputPath('reference_native')
+        os.makedirs(nativeDir)
+        preprocessMicrographs(micFns, nativeDir, 4,
+                              **parseOptions('--sample 1 --niters 100'))
+
+        with np.load(TOPAZ_REFERENCE) as reference:
+            for fn in micFns:
+                name = os.path.splitext(os.path.basename(fn))[0]
+                with mrcfile.open(os.path.join(nativeDir, name + '.mrc')) as mrc:
+                    self.assertEqual(mrc.data.shape, (64, 60))
+                    np.testing.assert_allclose(mrc.data, reference[name],
+                                               atol=1e-3)
+
+    def testParity(self):
+        """ Same output as topaz preprocess, if it is installed, for
+        larger micrographs than the stored reference. """
+        micFns = writeMicrographs(self.getOutputPath('parity'), 3)
+        topazDir = self.getOutputPath('topaz')
+        nativeDir = self.getOutputPath('native')
+        os.makedirs(nativeDir)
+
+        if not Plugin.getVar(TOPAZ_ENV_ACTIVATION):
+            self.skipTest('topaz is not configured')
+        # Fit on all the pixels, since the random samples would differ
+        extra = '--sample 1 --niters 100'
+        cmd = '%s %s && topaz preprocess %s --scale 4 -o %s/ %s' % (
+            Plugin.getCondaActivationCmd(), Plugin.getTopazEnvActivation(),
+            ' '.join(micFns), topazDir, extra)
+        if subprocess.call(cmd, shell=True, env=Plugin.getEnviron()) != 0:
+            self.skipTest('topaz is not available')
+
+        preprocessMicrographs(micFns, nativeDir, 4, **parseOptions(extra))
+        for fn in micFns:
+            name = os.path.basename(fn)
+            with mrcfile.open(os.path.join(topazDir, name)) as ref, \
+                    mrcfile.open(os.path.join(nativeDir, name)) as mrc:
+                self.assertEqual(ref.data.shape, (128, 120))
+                np.testing.assert_allclose(mrc.data.reshape(ref.data.shape),
+                                           ref.data.reshape(ref.data.shape),
+                                           atol=1e-3)
@@ -0,0 +1,65 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import subprocess
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from topaz.protocols import TopazProtTraining
+from topaz.profiling import (stage, getStagesLog, readStages,
+                             summarizeStages, formatStagesSummary)
+
+
+class TestStages(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def testRecordStages(self):
+        prot = TopazProtTraining()
+        prot.workingDir.set(self.getOutputPath('run'))
+
+        with stage(prot, 'preprocess', mics=4, batch='1-4'):
+            subprocess.check_call(['dd', 'if=/dev/zero', 'of=/dev/null',
+                                   'bs=1M', 'count=64'],
+                                  stderr=subprocess.DEVNULL)
+        with self.assertRaises(ZeroDivisionError):
+            with stage(prot, 'extract', mics=4):
+                1 / 0
+
+        records = readStages(getStagesLog(prot))
+        self.assertEqual([r['stage'] for r in records],
+                         ['preprocess', 'extract'])
+        self.assertEqual(records[0]['batch'], '1-4')
+        self.assertGreater(records[0]['cpu'], 0)
+        self.assertGreater(records[0]['processPeakRss'], 0)
+        self.assertTrue(records[1]['failed'])
+
+        summary = summarizeStages(records + records)
+        self.assertEqual(summary['preprocess']['count'], 2)
+        self.assertEqual(summary['preprocess']['mics'], 8)
+        lines = formatStagesSummary(getStagesLog(prot))
+        self.assertEqual(len(lines), 3)
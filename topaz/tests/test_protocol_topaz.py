@@ -123,7 +123,7 @@ class TestTopaz(BaseTest):
         protImport = self.newProtocol(
             protocols.TopazProtImport,
             label='Importing 1',
-            modelPath=prot._getExtraPath('model/model_epoch1.sav'))
+            modelPath=prot.outputModel.getPath())
         self.launchProtocol(protImport)
         return protImport
 
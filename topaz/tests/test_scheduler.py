@@ -0,0 +1,82 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import subprocess
+import sys
+import threading
+from collections import Counter
+
+from pyworkflow.tests import BaseTest
+
+from topaz.scheduler import DeviceScheduler
+
+# Command standing for topaz on CPU-only machines
+STUB_TOPAZ = [sys.executable, '-c', 'import time; time.sleep(0.05)']
+
+
+class TestDeviceScheduler(BaseTest):
+    """ Schedule jobs on fake GPU ids running a stub command. """
+    def testLeastLoaded(self):
+        scheduler = DeviceScheduler(['0', '1', '0'], maxJobs=2)
+        devices = [scheduler.acquire() for _ in range(3)]
+        self.assertEqual(devices, ['0', '1', '0'])
+        self.assertEqual(scheduler.getLoad(), {'0': 2, '1': 1})
+        # Device 0 is full, so the next job goes to 1 and then none is free
+        self.assertEqual(scheduler.acquire(), '1')
+        with self.assertRaises(Exception):
+            scheduler.acquire(timeout=0.1)
+        scheduler.release('0')
+        self.assertEqual(scheduler.acquire(), '0')
+
+    def testConcurrentJobs(self):
+        maxJobs = 2
+        scheduler = DeviceScheduler([0, 1, 2], maxJobs=maxJobs)
+        lock = threading.Lock()
+        running = Counter()
+        maxRunning = Counter()
+        jobs = Counter()
+
+        def _run():
+            with scheduler.device() as device:
+                with lock:
+                    running[device] += 1
+                    jobs[device] += 1
+                    maxRunning[device] = max(maxRunning[device],
+                                             running[device])
+                subprocess.check_call(STUB_TOPAZ + ['--device', device])
+                with lock:
+                    running[device] -= 1
+
+        threads = [threading.Thread(target=_run) for _ in range(18)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(sum(jobs.values()), 18)
+        self.assertEqual(sorted(jobs), ['0', '1', '2'])
+        self.assertTrue(all(n <= maxJobs for n in maxRunning.values()))
+        self.assertEqual(scheduler.getLoad(), {'0': 0, '1': 0, '2': 0})
@@ -0,0 +1,91 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import threading
+import time
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from topaz import scratch
+from topaz.scratch import ScratchSpace, KEEP_COORDINATES, KEEP_LAST
+
+
+class TestScratchSpace(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def _createBatch(self, name, size=1000):
+        """ Batch folder with a link, a micrograph and a coordinates file. """
+        folder = self.getOutputPath(name)
+        os.makedirs(os.path.join(folder, 'preprocess'))
+        with open(os.path.join(folder, 'preprocess', '1.mrc'), 'wb') as f:
+            f.write(b'0' * size)
+        os.symlink('/missing/1.mrc', os.path.join(folder, '1.mrc'))
+        coordsFn = os.path.join(folder, 'preprocess', 'coordinates.txt')
+        with open(coordsFn, 'w') as f:
+            f.write('image_name\tx_coord\ty_coord\tscore\n')
+        return folder, coordsFn
+
+    def testRetention(self):
+        space = ScratchSpace(KEEP_LAST, keepLast=1)
+        batches = [self._createBatch('last%d' % i) for i in range(3)]
+        for folder, coordsFn in batches:
+            space.startBatch(folder)
+            space.finishBatch(folder, keepFiles=[coordsFn])
+
+        # Only the coordinates are left in the older batches
+        for folder, coordsFn in batches[:2]:
+            self.assertEqual(os.listdir(folder), ['preprocess'])
+            self.assertEqual(os.listdir(os.path.dirname(coordsFn)),
+                             ['coordinates.txt'])
+        self.assertEqual(len(os.listdir(batches[2][0])), 2)
+
+        space = ScratchSpace(KEEP_COORDINATES)
+        folder, coordsFn = self._createBatch('failed')
+        space.startBatch(folder)
+        space.finishBatch(folder, keepFiles=[coordsFn], failed=True)
+        self.assertGreater(space.getUsage(), 1000)
+
+    def testQuota(self):
+        self.addCleanup(setattr, scratch, 'THROTTLE_CHECK',
+                        scratch.THROTTLE_CHECK)
+        scratch.THROTTLE_CHECK = 0.1
+        space = ScratchSpace(KEEP_COORDINATES, quota=500)
+        folder1, coordsFn1 = self._createBatch('quota1')
+        space.startBatch(folder1)
+
+        # The second batch waits until the first one is cleaned
+        def _finish():
+            time.sleep(0.5)
+            space.finishBatch(folder1, keepFiles=[coordsFn1])
+        thread = threading.Thread(target=_finish)
+        thread.start()
+        waited = space.startBatch(self.getOutputPath('quota2'))
+        thread.join()
+        self.assertGreater(waited, 0.4)
+        self.assertLess(space.getUsage(), 500)
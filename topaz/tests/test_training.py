@@ -0,0 +1,133 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+
+import numpy as np
+import mrcfile
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from topaz.convert import isCompleteMrc
+from topaz.evaluation import writeSweep
+from topaz.protocols import TopazProtTraining, TopazProtTrainingSweep
+
+
+class TestTrainingResume(BaseTest):
+    """ Recover the outputs of an interrupted training run. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def _newProtocol(self, name, protClass=TopazProtTraining):
+        prot = protClass()
+        prot.workingDir.set(self.getOutputPath(name))
+        prot._defineFileDict()
+        return prot
+
+    def _writeOutput(self, fn, epochs):
+        with open(fn, 'w') as f:
+            f.write('epoch\titer\tsplit\tloss\tauprc\n')
+            for epoch, auprc in epochs:
+                f.write('%d\t%d\ttest\t0.5\t%s\n' % (epoch, epoch * 10, auprc))
+
+    def testCollectCheckpoints(self):
+        prot = self._newProtocol('checkpoints')
+        modelsDir = prot._getExtraPath('model', 'fold0')
+        os.makedirs(modelsDir)
+        # First run saved 2 epochs, the resumed one saved 1 of 2 evaluated
+        for fn in ['model_epoch1.sav', 'model_epoch2.sav',
+                   'model_resume2_epoch1.sav']:
+            open(os.path.join(modelsDir, fn), 'w').close()
+        self._writeOutput(os.path.join(modelsDir, 'model_training.txt'),
+                          [(1, 0.2), (2, 0.3), (3, 0.9)])
+        self._writeOutput(os.path.join(modelsDir, 'model_training_resume2.txt'),
+                          [(1, 0.5), (2, 0.9)])
+
+        self.assertEqual(prot._collectCheckpoints(modelsDir), 3)
+        self.assertEqual(sorted(prot.getEpochModels(modelsDir)), [1, 2, 3])
+        log = np.loadtxt(prot.getTrainingLogFn(modelsDir), skiprows=1,
+                         usecols=(0, 4))
+        np.testing.assert_allclose(log, [[1, 0.2], [2, 0.3], [3, 0.5]])
+        self.assertTrue(prot.getOutputModelPath().endswith('model_epoch3.sav'))
+
+    def testPendingInput(self):
+        prot = self._newProtocol('pending')
+        inputDir, outputDir = self.getOutputPath('in'), self.getOutputPath('out')
+        os.makedirs(inputDir)
+        os.makedirs(outputDir)
+        for i in range(3):
+            for folder in [inputDir, outputDir]:
+                with mrcfile.new(os.path.join(folder, '%d.mrc' % i)) as mrc:
+                    mrc.set_data(np.zeros((16, 16), dtype=np.float32))
+        # Truncated output of an interrupted job
+        truncatedFn = os.path.join(outputDir, '2.mrc')
+        os.truncate(truncatedFn, 1100)
+        self.assertFalse(isCompleteMrc(truncatedFn))
+
+        pendingDir = prot.getPendingInput(inputDir, outputDir)
+        self.assertEqual(os.listdir(pendingDir), ['2.mrc'])
+        os.remove(truncatedFn)
+        os.symlink(os.path.join(inputDir, '2.mrc'), truncatedFn)
+        self.assertIsNone(prot.getPendingInput(inputDir, outputDir))
+
+
+class TestTrainingSweep(BaseTest):
+    """ Rank the models trained by a sweep over the training parameters. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    _newProtocol = TestTrainingResume._newProtocol
+    _writeOutput = TestTrainingResume._writeOutput
+
+    def testRankModels(self):
+        prot = self._newProtocol('sweep', TopazProtTrainingSweep)
+        prot.radiusList.set('2 4')
+        prot.methodList.set('GE-binomial PN')
+        prot.foldsToTrain.set(2)
+        combinations = prot.getCombinations()
+        self.assertEqual(len(combinations), 4)
+        self.assertEqual(combinations[1], (2, 300, 'resnet8', 'PN', 0.))
+
+        sweep = np.zeros(1, dtype=[('radius', int), ('threshold', float),
+                                   ('precision', float), ('recall', float),
+                                   ('f1', float)])
+        for i in range(len(combinations)):
+            for fold in range(2):
+                modelsDir = prot.getSweepModelsDir(i, fold)
+                os.makedirs(modelsDir)
+                open(os.path.join(modelsDir, 'model_epoch1.sav'), 'w').close()
+                self._writeOutput(prot.getTrainingLogFn(modelsDir), [(1, 0.5)])
+                sweep[0] = (8, 0.5, 0.8, 0.8, 0.1 * (i + 1) + 0.01 * fold)
+                writeSweep(os.path.join(modelsDir, 'threshold_sweep.txt'), sweep)
+
+        prot.rankModelsStep()
+        rows = prot.readSweepModels()
+        self.assertEqual(len(rows), 8)
+        self.assertEqual(rows[0][:2], ['3', '1'])
+        self.assertEqual(prot.getBestModel(), (1, prot.getSweepModelsDir(3, 1)))
+        self.assertTrue(prot.getOutputModelPath().endswith('model_epoch1.sav'))
@@ -0,0 +1,178 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import subprocess
+import sys
+from types import SimpleNamespace
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+from pwem.objects import Micrograph
+
+from topaz.convert import CsvMicrographList
+from topaz.protocols import TopazProtPicking
+from topaz.worker import TopazWorker, WORKER_SCRIPT
+
+
+class TestTopazWorker(BaseTest):
+    """ Test the persistent worker with its stub runner (no Topaz needed). """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def _newWorker(self):
+        return TopazWorker([sys.executable, WORKER_SCRIPT, 'serve', '--stub'])
+
+    def testJobs(self):
+        micDir = self.getOutputPath('micrographs')
+        preDir = self.getOutputPath('preprocess')
+        coordsFn = self.getOutputPath('coordinates.txt')
+        os.makedirs(micDir)
+        for micId in [1, 2]:
+            with open(os.path.join(micDir, '%d.mrc' % micId), 'w') as f:
+                f.write('mic')
+
+        worker = self._newWorker()
+        worker.run('preprocess', ' %s/*.mrc -o %s/ --scale 4' % (micDir, preDir))
+        pid = worker._process.pid
+        self.assertEqual(sorted(os.listdir(preDir)), ['1.mrc', '2.mrc'])
+
+        worker.run('extract', ' -r 8 -o %s %s/*.mrc' % (coordsFn, preDir))
+        self.assertEqual(worker._process.pid, pid,
+                         "The same process should run all the jobs")
+        with open(coordsFn) as f:
+            self.assertTrue(f.readline().startswith('image_name'))
+
+        pickedFn = self.getOutputPath('picked.txt')
+        listFn = self.getOutputPath('list.txt')
+        # The image list written by the picking protocol
+        csvMics = CsvMicrographList(listFn, 'w')
+        for micId in [1, 2]:
+            csvMics.addMic(micId, '%s/%d.mrc' % (micDir, micId))
+        csvMics.close()
+        worker.run('pick', " --images %s -o %s -m resnet16_u64 -r 8 "
+                           "--denoise --denoise-args ' --model unet'"
+                   % (listFn, pickedFn))
+        self.assertTrue(os.path.exists(pickedFn))
+
+        # Coordinates of each micrograph published in its own file
+        perMicDir = self.getOutputPath('coordinates')
+        worker.run('pick', " --images %s -o %s -m resnet16_u64 -r 8 "
+                           "--per-micrograph %s" % (listFn, pickedFn, perMicDir))
+        self.assertEqual(sorted(os.listdir(perMicDir)),
+                         ['000001.txt', '000002.txt'])
+        # The protocol looks for the same files
+        prot = SimpleNamespace(_getFileName=lambda key: perMicDir)
+        for micId in [1, 2]:
+            mic = Micrograph()
+            mic.setObjId(micId)
+            self.assertTrue(os.path.exists(
+                TopazProtPicking._getMicCoordsFn(prot, mic)))
+
+        # Other models picking the same micrographs, each to its own file
+        otherFn = self.getOutputPath('picked_model1.txt')
+        worker.run('pick', " --images %s -o %s -m resnet16_u64 -r 8 "
+                           "--extra-model resnet8_u32 %s 6 -3"
+                   % (listFn, pickedFn, otherFn))
+        with open(otherFn) as f:
+            self.assertTrue(f.readline().startswith('image_name'))
+
+        # Binary columns instead of text
+        storePath = self.getOutputPath('picked.cols')
+        worker.run('pick', " --images %s -o %s -m resnet16_u64 -r 8 --columns"
+                   % (listFn, storePath))
+        self.assertEqual(sorted(os.listdir(storePath)),
+                         ['index.npy', 'micId.npy', 'score.npy', 'x.npy',
+                          'y.npy'])
+
+        worker.stop()
+        self.assertFalse(worker.isAlive())
+
+    def testModelCache(self):
+        """ Models are loaded once even if the Topaz commands imported the
+        loading functions by name (a stub topaz package stands for it). """
+        stubDir = self.getOutputPath('stub_topaz')
+        loadsFn = self.getOutputPath('model_loads.txt')
+        loader = ("import os\n"
+                  "def load_model(path, *args, **kwargs):\n"
+                  "    with open(os.environ['STUB_MODEL_LOADS'], 'a') as f:\n"
+                  "        f.write(path + '\\n')\n"
+                  "    return object()\n")
+        command = ("from topaz.%s import load_model\n"
+                   "def add_arguments(parser):\n"
+                   "    parser.add_argument('-m', '--model')\n"
+                   "def main(args):\n"
+                   "    load_model(args.model)\n")
+        files = {
+            '__init__.py': '',
+            'model/__init__.py': '',
+            'model/factory.py': loader,
+            'denoising/__init__.py': '',
+            'denoising/models.py': loader,
+            'extract.py': 'from topaz.model.factory import load_model\n',
+            'denoise.py': 'from topaz.denoising.models import load_model\n',
+            'commands/__init__.py': '',
+            'commands/extract.py': command % 'model.factory',
+            'commands/denoise.py': command % 'denoising.models',
+            'commands/preprocess.py': command % 'model.factory',
+        }
+        for name, content in files.items():
+            fn = os.path.join(stubDir, 'topaz', name)
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            with open(fn, 'w') as f:
+                f.write(content)
+
+        env = dict(os.environ, PYTHONPATH=stubDir, STUB_MODEL_LOADS=loadsFn)
+        worker = TopazWorker([sys.executable, WORKER_SCRIPT, 'serve'], env=env)
+        for _ in range(3):
+            worker.run('extract', ' -m resnet16_u64')
+            worker.run('denoise', ' -m unet')
+        worker.stop()
+        with open(loadsFn) as f:
+            self.assertEqual(f.read().split(), ['resnet16_u64', 'unet'])
+
+    def testErrors(self):
+        worker = self._newWorker()
+        with self.assertRaises(Exception):
+            worker.run('segment', '')
+        # The worker survives a failed job
+        self.assertTrue(worker.isAlive())
+        worker.run('extract', ' -o %s' % self.getOutputPath('empty.txt'))
+        worker.stop()
+
+    def testTrainEarlyStopping(self):
+        outputDir = self.getOutputPath('train')
+        os.makedirs(outputDir)
+        # The stub training does not improve after the third epoch
+        subprocess.check_call([
+            sys.executable, WORKER_SCRIPT, 'train', '--patience', '2',
+            '--poll', '0.02', '--topaz', '%s %s stub' % (sys.executable,
+                                                       WORKER_SCRIPT),
+            '--num-epochs', '12', '--save-prefix', '%s/model' % outputDir,
+            '-o', '%s/model_training.txt' % outputDir])
+        models = [fn for fn in os.listdir(outputDir) if fn.endswith('.sav')]
+        self.assertIn('model_epoch3.sav', models)
+        self.assertNotIn('model_epoch12.sav', models)
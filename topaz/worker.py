@@ -0,0 +1,144 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import json
+import os
+import subprocess
+import threading
+
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(__file__), 'scripts',
+                             'topaz_worker.py')
+
+# Fused denoise, preprocess and extract, run by the worker script
+PICK_PROGRAM = 'python %s pick' % WORKER_SCRIPT
+
+# Topaz train with early stopping, run by the worker script
+TRAIN_PROGRAM = 'python %s train' % WORKER_SCRIPT
+
+# Map the topaz programs that can be sent to a persistent worker
+# to the name of the job in the worker script
+WORKER_JOBS = {
+    'topaz denoise': 'denoise',
+    'topaz preprocess': 'preprocess',
+    'topaz extract': 'extract',
+    PICK_PROGRAM: 'pick'
+}
+
+_workersLock = threading.Lock()
+
+
+class TopazWorker:
+    """ Client of a long-lived process running inside the Topaz environment.
+    Jobs are sent as JSON lines through the process stdin and the result of
+    each job is read from its stdout. Jobs sent from different threads are
+    executed one after the other.
+    """
+    def __init__(self, command, env=None, cwd=None):
+        """
+        Params:
+            command: command line (string) or argument list used to
+                launch the worker script with the 'serve' command.
+            env: environment for the worker process.
+            cwd: working directory for the worker process.
+        """
+        self._command = command
+        self._env = env
+        self._cwd = cwd
+        self._process = None
+        self._jobId = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._process = subprocess.Popen(self._command,
+                                         shell=isinstance(self._command, str),
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         env=self._env, cwd=self._cwd,
+                                         universal_newlines=True)
+
+    def isAlive(self):
+        return self._process is not None and self._process.poll() is None
+
+    def _send(self, job):
+        self._process.stdin.write(json.dumps(job) + '\n')
+        self._process.stdin.flush()
+        line = self._process.stdout.readline()
+        if not line:
+            raise Exception("Topaz worker exited unexpectedly (exit code: %s)"
+                            % self._process.wait())
+        return json.loads(line)
+
+    def run(self, command, args, cwd=None):
+        """ Run a topaz command (denoise, preprocess or extract) in the
+        worker, starting it if needed. The arguments are given as a string
+        as they would be passed in the command line.
+        """
+        with self._lock:
+            if not self.isAlive():
+                self.start()
+            self._jobId += 1
+            response = self._send({'id': self._jobId, 'command': command,
+                                   'args': args, 'cwd': cwd})
+
+        if response['status'] != 'ok':
+            raise Exception("Topaz worker failed running '%s %s':\n%s"
+                            % (command, args, response.get('error', '')))
+
+    def stop(self, timeout=30):
+        """ Ask the worker to finish and wait for it. """
+        with self._lock:
+            if self.isAlive():
+                try:
+                    self._send({'id': None, 'command': 'stop'})
+                    self._process.stdin.close()
+                    self._process.wait(timeout=timeout)
+                except Exception:
+                    self._process.kill()
+                    self._process.wait()
+            self._process = None
+
+
+def getProtocolWorker(protocol, device, command, env=None):
+    """ Return the worker of the protocol for the given device,
+    creating it (launched with command and env) if it does not exist yet.
+    """
+    with _workersLock:
+        workers = getattr(protocol, '_topazWorkers', None)
+        if workers is None:
+            workers = protocol._topazWorkers = {}
+        if device not in workers:
+            workers[device] = TopazWorker(command, env=env)
+        return workers[device]
+
+
+def stopProtocolWorkers(protocol):
+    """ Stop all workers started by the protocol. """
+    with _workersLock:
+        workers = getattr(protocol, '_topazWorkers', None) or {}
+        protocol._topazWorkers = {}
+    for worker in workers.values():
+        worker.stop()